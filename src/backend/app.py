@@ -1,21 +1,74 @@
+import decimal
+import os
 from pathlib import Path
 
+import click
 from flask import Flask
+from flask.json.provider import DefaultJSONProvider
 from flask_restful import Api
 from flask_cors import CORS
 
 
+class JSONProvider(DefaultJSONProvider):
+
+    """
+    Parses fractional numbers of requests as `Decimal`,
+    so prices are taken exactly, not rounded to float
+    """
+
+    def loads(self, s, **kwargs):
+        kwargs.setdefault('parse_float', decimal.Decimal)
+        return super().loads(s, **kwargs)
+
+
 app = Flask(__name__, static_folder=Path(__file__).parent / Path('static'))
+app.json = JSONProvider(app)
 api = Api(app)
 sqlite_file = Path(__file__).parent / Path('test_database.sqlite')
 
 
+def get_engine_options(database_uri: str) -> dict:
+    """
+    Builds SQLAlchemy engine options from environment variables
+    :param database_uri: database, which engine will connect to
+    :return:
+    """
+    options = {
+        'pool_pre_ping': True,
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 3600)),
+    }
+
+    if database_uri.startswith('sqlite'):
+        options['connect_args'] = {
+            # Seconds to wait for a lock of other writer ( busy_timeout )
+            'timeout': float(os.environ.get('SQLITE_BUSY_TIMEOUT', 30)),
+            'check_same_thread': False,
+        }
+
+    return options
+
+
+database_uri = os.environ.get('SQLALCHEMY_DATABASE_URI', f"sqlite:///{sqlite_file.as_posix()}")
+
+
 CORS(app)
 app.config.update(
-    SECRET_KEY="A\xacE\x94\x04\x12\x93\xef\xa4\xea\xdd>\xff\t\x06\x00<\xb6J\xc6n\xba=\x02\xbb",
+    SECRET_KEY=os.environ.get(
+        'SECRET_KEY',
+        "A\xacE\x94\x04\x12\x93\xef\xa4\xea\xdd>\xff\t\x06\x00<\xb6J\xc6n\xba=\x02\xbb"
+    ),
     SQLALCHEMY_TRACK_MODIFICATIONS=False,
-    DEBUG=True,
-    SQLALCHEMY_DATABASE_URI=f"sqlite:///{sqlite_file.as_posix()}",
+    DEBUG=os.environ.get('DEBUG', 'false').lower() == 'true',
+    SQLALCHEMY_DATABASE_URI=database_uri,
+    SQLALCHEMY_ENGINE_OPTIONS=get_engine_options(database_uri),
+    # Latency histograms of resources at `/metrics`
+    METRICS_ENABLED=os.environ.get('METRICS_ENABLED', 'false').lower() == 'true',
+    # `Server-Timing` header with SQL, handler and serialization time
+    SERVER_TIMING_ENABLED=os.environ.get('SERVER_TIMING_ENABLED', 'false').lower() == 'true',
+    # Stock of products is read from in-memory ledger instead of consignments
+    STOCK_LEDGER_ENABLED=os.environ.get('STOCK_LEDGER_ENABLED', 'false').lower() == 'true',
 )
 
 
@@ -23,8 +76,11 @@ from .resources.products import ProductsResource, ProductSingleResource
 from .resources.consignments import ConsignmentsResource
 from .resources.sale_invoice import SaleInvoiceResource, SaleInvoiceSingleResource
 from .resources.income_invoice import IncomeInvoiceResource, IncomeInvoiceSingleResource
-from .resources.reports import ReportResource
-from .models import init_db
+from .resources.reports import ReportResource, ReportJobResource
+from .resources.imports import ImportResource
+from .resources.metrics import MetricsResource
+from .models import db, init_db
+from .metrics import request_metrics
 
 
 with app.app_context():
@@ -41,5 +97,20 @@ with app.app_context():
     api.add_resource(IncomeInvoiceSingleResource, '/income_invoices/<int:invoice_id>')
 
     api.add_resource(ReportResource, '/report')
+    api.add_resource(ReportJobResource, '/report/<string:job_id>')
+
+    api.add_resource(ImportResource, '/import')
+
+    request_metrics.init_app(app, db.engine)
+
+    if app.config['METRICS_ENABLED']:
+        api.add_resource(MetricsResource, '/metrics')
+
 
-    init_db()
+@app.cli.command('init-db')
+@click.option('--reset', is_flag=True, help='Drop all data before creating tables')
+def init_db_command(reset: bool) -> None:
+    """
+    Creates missing tables and indexes of database
+    """
+    init_db(reset=reset)
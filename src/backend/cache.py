@@ -0,0 +1,150 @@
+import collections
+import hashlib
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Tuple, Union
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from .models import DataVersion, db
+
+
+# Body, status and headers of cached response
+CachedResponse = Tuple[bytes, int, List[Tuple[str, str]]]
+
+
+class DataVersionCache:
+
+    """
+    In-memory copy of `data_version` table.
+
+    Versions are read from database, when they are older than `ttl`
+    seconds or after this process committed changes of any table,
+    so versions of own writes are never stale and writes
+    of other processes are picked up in `ttl` seconds
+    """
+
+    def __init__(self, ttl: float = 1.0):
+        self.ttl = ttl
+        self.versions: Dict[str, int] = {}
+        self.loaded_at = None
+        # Increased by every expiration, so versions, which were
+        # being read while tables were changed, are not kept
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def expire(self) -> None:
+        with self.lock:
+            self.generation += 1
+            self.loaded_at = None
+
+    def get(self, tables: Iterable[str]) -> Dict[str, Union[int, None]]:
+        """
+        Returns versions of tables
+        :param tables: names of tables
+        :return: version by table name, None if table version is unknown
+        """
+        with self.lock:
+            generation = self.generation
+            versions = self.versions
+            is_fresh = self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl
+
+        if not is_fresh:
+            loaded_at = time.monotonic()
+            versions = dict(db.session.execute(select(DataVersion.table_name, DataVersion.version)).all())
+
+            with self.lock:
+                if generation == self.generation:
+                    self.versions = versions
+                    self.loaded_at = loaded_at
+
+        return {table: versions.get(table) for table in tables}
+
+
+class ResponseCache:
+
+    """
+    In-memory LRU cache of responses. Keys include data versions,
+    so changed data is never served and outdated responses
+    are just evicted by newer ones
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        :param max_bytes: max size of cached bodies
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.responses: Dict[str, CachedResponse] = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Union[CachedResponse, None]:
+        with self.lock:
+            cached = self.responses.get(key)
+
+            if cached is not None:
+                self.responses.move_to_end(key)
+
+            return cached
+
+    def set(self, key: str, response: CachedResponse) -> None:
+        """
+        Caches response, the least recently used responses
+        are evicted to keep size of cache
+        :param key: key of response
+        :param response: body, status and headers of response
+        :return:
+        """
+        if not self.max_bytes or len(response[0]) > self.max_bytes:
+            return
+
+        with self.lock:
+            previous = self.responses.pop(key, None)
+
+            if previous is not None:
+                self.size -= len(previous[0])
+
+            self.responses[key] = response
+            self.size += len(response[0])
+
+            while self.size > self.max_bytes:
+                _, evicted = self.responses.popitem(last=False)
+                self.size -= len(evicted[0])
+
+
+def get_response_key(path: str, arguments: Iterable[Tuple[str, str]], versions: Dict[str, int]) -> str:
+    """
+    Returns key of response, which is also its ETag.
+    Responses of the same request with the same data versions are the same
+    :param path: path of request
+    :param arguments: query string arguments
+    :param versions: data versions of tables, which response depends on
+    :return:
+    """
+    parameters = repr((path, sorted(arguments), sorted(versions.items())))
+    return hashlib.sha256(parameters.encode()).hexdigest()[:32]
+
+
+data_versions = DataVersionCache(ttl=float(os.environ.get('DATA_VERSION_TTL', 1)))
+
+# Zero size disables caching of responses, ETags are still sent
+response_cache = ResponseCache(max_bytes=int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024)))
+
+
+@event.listens_for(Session, 'after_commit')
+def expire_data_versions(session):
+    # Released savepoint is still a part of transaction
+    if session.in_nested_transaction():
+        return
+
+    if session.info.pop('increased_tables', None):
+        data_versions.expire()
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def discard_increased_tables(session, transaction):
+    # Tables of rolled back savepoint are kept, extra expiration is harmless
+    if transaction.parent is None:
+        session.info.pop('increased_tables', None)
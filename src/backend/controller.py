@@ -1,10 +1,22 @@
 import datetime
 import enum
+import random
+import time
+from collections import defaultdict
 from typing import (
+    Any,
+    Callable,
     Union,
     List,
+    Dict,
+    Iterable,
 )
 
+from sqlalchemy import bindparam, select, func
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm.util import identity_key
+
+from .ledger import WRITE_OFF, stock_ledger
 from .models import (
     db,
     SaleInvoice,
@@ -17,6 +29,39 @@ from .models import (
 from .utils import Money
 
 
+WRITE_OFF_WINDOW = 100
+
+WRITE_ATTEMPTS = 5
+# Seconds before the second attempt, every next wait is twice longer
+WRITE_BACKOFF = 0.02
+
+# Serialization failure and deadlock of PostgreSQL
+CONFLICT_CODES = ('40001', '40P01')
+
+
+class StockConflictError(Exception):
+    """
+    Consignments were changed by concurrent transaction
+    after write off was planned
+    """
+
+
+def is_conflict(error: Exception) -> bool:
+    """
+    Help function, which checks, that transaction failed
+    because of concurrent one and can be retried
+    :param error: error of transaction
+    :return:
+    """
+    if isinstance(error, StockConflictError):
+        return True
+
+    if isinstance(error, DBAPIError):
+        return getattr(error.orig, 'pgcode', None) in CONFLICT_CODES or 'database is locked' in str(error.orig)
+
+    return False
+
+
 class InvoiceType(str, enum.Enum):
     INCOME = 'income'
     SALE = 'sale'
@@ -30,103 +75,249 @@ class BusinessController:
     """
 
     @staticmethod
-    def write_off_from_consignments(product: Product, to_write_off: int) -> None:
+    def plan_write_off(product_id: int, to_write_off: int) -> List[dict]:
         """
-        Writes off some quantity from product consignments.
-        If consignment are fully writes off - marks as depreciated.
+        Plans a FIFO write off from not depreciated consignments of product.
+        Consignments are taken from stock ledger, when it is enabled,
+        otherwise they are read in order of arrival only until quantity is covered
+        :param product_id: product to write off
         :param to_write_off: quantity to write off
-        :param product: product to write off
-        :return:
+        :return: quantity to write off from every touched consignment
         """
         current_to_write_off = to_write_off
+        changes = []
 
-        for consignment in product.consignments:
+        consignments = stock_ledger.read_consignments(db.session, product_id)
 
-            current_cons_quantity = (
-                0 if consignment.current_quantity <= current_to_write_off
-                else consignment.current_quantity - current_to_write_off
+        if consignments is None:
+            consignments = db.session.execute(
+                select(Consignment.id, Consignment.current_quantity).
+                where(Consignment.product_id == product_id, Consignment.depreciated.is_(False)).
+                order_by(Consignment.arrival_date, Consignment.consignment_number).
+                execution_options(yield_per=WRITE_OFF_WINDOW)
             )
 
-            if current_cons_quantity == 0:
-                consignment.depreciated = True
-
-            if consignment.current_quantity >= current_to_write_off:
-                current_to_write_off = 0
+        for consignment_id, current_quantity in consignments:
 
-            elif current_to_write_off > consignment.current_quantity:
-                current_to_write_off -= consignment.current_quantity
+            written_off = min(current_quantity, current_to_write_off)
+            current_to_write_off -= written_off
 
-            consignment.current_quantity = current_cons_quantity
+            changes.append({
+                'consignment_id': consignment_id,
+                'written_off': written_off,
+            })
 
             if current_to_write_off == 0:
                 break
 
+        if not isinstance(consignments, list):
+            consignments.close()
+
+        return changes
+
+    @classmethod
+    def write_off_from_consignments(cls, product: Product, to_write_off: int) -> None:
+        """
+        Writes off some quantity from product consignments.
+        If consignment are fully writes off - marks as depreciated.
+        All touched consignments are updated with one statement, every
+        consignment is updated only if it still has planned quantity,
+        otherwise concurrent transaction has taken it and
+        `StockConflictError` is raised
+        :param to_write_off: quantity to write off
+        :param product: product to write off
+        :return:
+        """
+        changes = cls.plan_write_off(product_id=product.id, to_write_off=to_write_off)
+
+        if sum(change['written_off'] for change in changes) < to_write_off:
+            stock_ledger.expire([product.id])
+            raise StockConflictError(f'Stock of product {product.id} was changed while writing off')
+
+        if not changes:
+            return
+
+        consignments = Consignment.__table__
+        written_off = bindparam('written_off')
+        result = db.session.execute(
+            consignments.
+            update().
+            where(consignments.c.id == bindparam('consignment_id'), consignments.c.current_quantity >= written_off).
+            values(
+                current_quantity=consignments.c.current_quantity - written_off,
+                depreciated=consignments.c.current_quantity == written_off,
+            ),
+            changes
+        )
+
+        if result.rowcount != len(changes):
+            # Ledger, which the write off was planned from, is outdated
+            stock_ledger.expire([product.id])
+            raise StockConflictError(f'Stock of product {product.id} was changed while writing off')
+
+        db.session.info.setdefault('changed_tables', set()).add(Consignment.__tablename__)
+
+        if stock_ledger.enabled:
+            for change in changes:
+                stock_ledger.record(
+                    db.session,
+                    product.id,
+                    (WRITE_OFF, change['consignment_id'], change['written_off'])
+                )
+
+        # Already loaded consignments are read again
+        for change in changes:
+            consignment = db.session.identity_map.get(identity_key(Consignment, change['consignment_id']))
+
+            if consignment is not None:
+                db.session.expire(consignment, ['current_quantity', 'depreciated'])
+
     @classmethod
     def create_sale_invoice(
             cls,
             date: datetime.datetime,
-            invoice_items: List[SaleInvoiceItem]
+            invoice_items: List[SaleInvoiceItem],
+            commit: bool = True
     ) -> None:
         """
         Create a sale invoice with cargo subtraction
         from consignments
         :param date: invoice creation date
         :param invoice_items: items, which will be appended to this invoice
+        :param commit: commit session or only flush invoice to it
         :return:
         """
         invoice = SaleInvoice(date=date)
+        requested_quantities = defaultdict(int)
 
+        # Product can appear on several lines, so its stock is checked against all of them
         for invoice_item in invoice_items:
 
-            if invoice_item.quantity > invoice_item.product.quantity:
+            if invoice_item.quantity <= 0:
+                raise ValueError('Quantity of sold product must be positive')
+
+            requested_quantities[invoice_item.product] += invoice_item.quantity
+
+        available_quantities = cls.get_available_quantities(product.id for product in requested_quantities)
+
+        for product, quantity in requested_quantities.items():
+
+            if quantity > available_quantities.get(product.id, 0):
                 raise ValueError('Current supply of product is lower than requested quantity')
 
+        for product, quantity in requested_quantities.items():
             cls.write_off_from_consignments(
-                product=invoice_item.product,
-                to_write_off=invoice_item.quantity
+                product=product,
+                to_write_off=quantity
             )
 
         invoice.items = invoice_items
         db.session.add_all(invoice_items)
         db.session.add(invoice)
-        db.session.commit()
+        cls.save(commit=commit)
+
+    @staticmethod
+    def get_available_quantities(product_ids: Iterable[int]) -> Dict[int, int]:
+        """
+        Returns available quantities of products from stock ledger.
+        Products, which ledger can't answer for, are read from database
+        :param product_ids: products to check
+        :return: quantity by product id ( unknown products are missed )
+        """
+        product_ids = set(product_ids)
+        quantities = stock_ledger.read_quantities(db.session, product_ids)
+        missing_ids = product_ids - quantities.keys()
+
+        if missing_ids:
+            quantities.update(db.session.execute(
+                select(Product.id, Product.quantity).
+                where(Product.id.in_(missing_ids))
+            ).all())
+
+        return quantities
+
+    @staticmethod
+    def run_in_transaction(operation: Callable[[], Any], attempts: int = WRITE_ATTEMPTS) -> Any:
+        """
+        Runs operation in new writing transaction and commits it.
+        On SQLite writing transaction takes the write lock at once,
+        so concurrent writers wait for each other. Transaction, which
+        conflicted with concurrent one, is rolled back and run again
+        after exponential backoff with jitter
+        :param operation: function, which changes data in session
+        :param attempts: max count of runs
+        :return: result of operation
+        """
+        for attempt in range(attempts):
+            # Changes must be planned from data of the same transaction
+            db.session.rollback()
+            db.session.connection(execution_options={'write_transaction': True})
+
+            try:
+                result = operation()
+                db.session.commit()
+                return result
+
+            except Exception as error:
+                db.session.rollback()
+
+                if attempt == attempts - 1 or not is_conflict(error):
+                    raise
+
+            time.sleep(WRITE_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
 
     @staticmethod
-    def get_last_consignment(product: Product) -> Union[Consignment, None]:
+    def save(commit: bool) -> None:
         """
-        Returns a last consignment of product.
-        If product haven't consignments returns None
-        :param product: product to check
+        Commits session or only flushes it,
+        when changes are a part of bigger transaction
+        :param commit: commit or flush
         :return:
         """
-        try:
-            return product.consignments[-1]
-        except IndexError:
-            return
+        if commit:
+            db.session.commit()
+        else:
+            db.session.flush()
+
+    @staticmethod
+    def get_last_consignment_numbers(product_ids: Iterable[int]) -> Dict[int, int]:
+        """
+        Returns a last consignment number of every product.
+        Products without consignments are missed
+        :param product_ids: products to check
+        :return:
+        """
+        return dict(db.session.execute(
+            select(Consignment.product_id, func.max(Consignment.consignment_number)).
+            where(Consignment.product_id.in_(product_ids)).
+            group_by(Consignment.product_id)
+        ).all())
 
     @classmethod
     def create_income_invoice(
             cls,
             date: datetime.datetime,
-            invoice_items: List[IncomeInvoiceItem]
+            invoice_items: List[IncomeInvoiceItem],
+            commit: bool = True
     ) -> None:
         """
         Creates an income invoice and automatically manages a consignments
         :param date: invoice creation date
         :param invoice_items: items, which will be appended to this invoice and
         from which consignments will be made
+        :param commit: commit session or only flush invoice to it
         :return:
         """
         invoice = IncomeInvoice(date=date)
         consignments = []
+        last_consignment_numbers = cls.get_last_consignment_numbers(
+            product_ids={invoice_item.product.id for invoice_item in invoice_items}
+        )
 
         for invoice_item in invoice_items:
 
-            last_consignment = cls.get_last_consignment(product=invoice_item.product)
-            current_consignment_number = 1
-
-            if last_consignment:
-                current_consignment_number = last_consignment.consignment_number + 1
+            current_consignment_number = last_consignment_numbers.get(invoice_item.product.id, 0) + 1
+            last_consignment_numbers[invoice_item.product.id] = current_consignment_number
 
             consignments.append(
                 Consignment(
@@ -145,14 +336,15 @@ class BusinessController:
         db.session.add_all(consignments)
         db.session.add(invoice)
 
-        db.session.commit()
+        cls.save(commit=commit)
 
     @classmethod
     def create_invoice(
             cls,
             invoice_type: InvoiceType,
             creation_date: datetime.datetime,
-            invoice_items: List[Union[IncomeInvoiceItem, SaleInvoiceItem]]
+            invoice_items: List[Union[IncomeInvoiceItem, SaleInvoiceItem]],
+            commit: bool = True
     ) -> None:
         """
         Creates new invoice of that type with items
@@ -160,6 +352,8 @@ class BusinessController:
         :param creation_date: invoice creation date
         :param invoice_type: which invoice to create: 'sell' or 'income'
         :param invoice_items: items, which will be in that invoice items can't be []
+        :param commit: commit session or only flush invoice to it
+        ( for creating invoices in batches )
         :return:
         """
 
@@ -169,36 +363,63 @@ class BusinessController:
         if invoice_type == InvoiceType.INCOME:
             cls.create_income_invoice(
                 date=creation_date,
-                invoice_items=invoice_items
+                invoice_items=invoice_items,
+                commit=commit
             )
 
         elif invoice_type == InvoiceType.SALE:
             cls.create_sale_invoice(
                 date=creation_date,
-                invoice_items=invoice_items
+                invoice_items=invoice_items,
+                commit=commit
             )
         else:
             raise ValueError('Unknown invoice type')
 
     @classmethod
-    def create_item_from_json(cls, item_json: dict) -> Union[SaleInvoiceItem, IncomeInvoiceItem]:
+    def create_items_from_json(cls, items_json: List[dict]) -> List[Union[SaleInvoiceItem, IncomeInvoiceItem]]:
         """
-        Creating invoice item from json
-        :param item_json: item in json format
+        Creating invoice items from json.
+        Products of all items are loaded with one query
+        :param items_json: items in json format
         :return:
         """
+        product_ids = {item_json['product_id'] for item_json in items_json}
+        products = {
+            product.id: product
+            for product in Product.query.filter(Product.id.in_(product_ids))
+        }
+        items = []
+
+        for item_json in items_json:
+
+            # Arguments are converted in a copy, so the same json can be used again
+            item_json = dict(item_json)
+            creation_class = SaleInvoiceItem
 
-        creation_class = SaleInvoiceItem
+            if 'arrival_date' in item_json:
+                creation_class = IncomeInvoiceItem
+                item_json['arrival_date'] = cls.parse_time(item_json['arrival_date'])
 
-        if 'arrival_date' in item_json:
-            creation_class = IncomeInvoiceItem
-            item_json['arrival_date'] = cls.parse_time(item_json['arrival_date'])
+            item_json['total_price'] = Money.from_json(item_json['total_price'])
 
-        item_json['total_price'] = Money.from_string(str(float(item_json['total_price'])))
+            product = products.get(item_json['product_id'])
 
-        product = Product.query.get(item_json['product_id'])
+            if product is None:
+                raise ValueError(f'Unknown product - {item_json["product_id"]}')
 
-        return creation_class(**item_json, product=product)
+            items.append(creation_class(**item_json, product=product))
+
+        return items
+
+    @classmethod
+    def create_item_from_json(cls, item_json: dict) -> Union[SaleInvoiceItem, IncomeInvoiceItem]:
+        """
+        Creating invoice item from json
+        :param item_json: item in json format
+        :return:
+        """
+        return cls.create_items_from_json([item_json])[0]
 
     @staticmethod
     def parse_time(time_string: str) -> datetime.datetime:
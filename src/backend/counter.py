@@ -0,0 +1,158 @@
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Callable, Dict, Hashable, Iterable, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+class RowCounter:
+
+    """
+    In-memory row counts of models.
+
+    Total counts are kept up to date with committed inserts and deletes,
+    counts for filtered queries are cached until any committed change.
+    Every entry expires after `ttl` seconds, so writes, made
+    by other processes, are picked up too. Only `max_filters` least
+    recently used filtered counts are kept for every model
+    """
+
+    TOTAL = ()
+
+    def __init__(self, ttl: float = 60, max_filters: int = 256):
+        self.ttl = ttl
+        self.max_filters = max_filters
+        self.counts: Dict[type, Dict[Hashable, Tuple[int, float]]] = defaultdict(OrderedDict)
+        self.lock = threading.Lock()
+
+    def rebuild(self, models: Iterable[type]) -> None:
+        """
+        Counts all rows of passed models from the scratch
+        :param models: models to count
+        :return:
+        """
+        with self.lock:
+            self.counts.clear()
+
+        for model in models:
+            self.set(model, self.TOTAL, model.query.count())
+
+    def set(self, model: type, key: Hashable, count: int) -> None:
+        with self.lock:
+            counts = self.counts[model]
+            counts[key] = (count, time.monotonic())
+            counts.move_to_end(key)
+
+            # Total count is kept, it is the one, which commits adjust
+            while len(counts) > self.max_filters + (self.TOTAL in counts):
+                evicted = next(filter_key for filter_key in counts if filter_key != self.TOTAL)
+                del counts[evicted]
+
+    def count(self, model: type, key: Hashable, counter: Callable[[], int]) -> int:
+        """
+        Returns a cached count of model rows for filter key,
+        or counts it with `counter` and caches
+        :param model: counted model
+        :param key: active filter ( `RowCounter.TOTAL` for all rows )
+        :param counter: function, which counts rows in database
+        :return:
+        """
+        with self.lock:
+            cached = self.counts[model].get(key)
+
+            if cached is not None:
+                self.counts[model].move_to_end(key)
+
+        if cached is not None and time.monotonic() - cached[1] < self.ttl:
+            return cached[0]
+
+        count = counter()
+        self.set(model, key, count)
+        return count
+
+    def apply(self, deltas: Dict[type, int]) -> None:
+        """
+        Applies committed changes: adjusts total counts by deltas
+        and drops all filtered counts
+        :param deltas: inserted minus deleted rows per model,
+        None if total count of model must be recounted
+        :return:
+        """
+        with self.lock:
+            for model, counts in self.counts.items():
+                total = counts.get(self.TOTAL)
+                counts.clear()
+
+                if total is not None and deltas.get(model, 0) is not None:
+                    counts[self.TOTAL] = (total[0] + deltas.get(model, 0), total[1])
+
+
+row_counter = RowCounter()
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_count_deltas(session, flush_context):
+    deltas = session.info.setdefault('count_deltas', defaultdict(int))
+
+    for instance in session.new:
+        if deltas[type(instance)] is not None:
+            deltas[type(instance)] += 1
+
+    for instance in session.deleted:
+        if deltas[type(instance)] is not None:
+            deltas[type(instance)] -= 1
+
+    session.info['has_changes'] = True
+
+
+@event.listens_for(Session, 'after_bulk_update')
+def collect_bulk_update(update_context):
+    update_context.session.info['has_changes'] = True
+
+
+@event.listens_for(Session, 'after_bulk_delete')
+def collect_bulk_delete(delete_context):
+    # Count of deleted rows is unknown at this point, so total must be recounted
+    deltas = delete_context.session.info.setdefault('count_deltas', defaultdict(int))
+    deltas[delete_context.mapper.class_] = None
+    delete_context.session.info['has_changes'] = True
+
+
+@event.listens_for(Session, 'after_transaction_create')
+def save_count_deltas(session, transaction):
+    # Rolled back savepoint gives back deltas, collected before it
+    if transaction.nested:
+        session.info.setdefault('count_savepoints', {})[transaction] = (
+            session.info.get('has_changes', False),
+            dict(session.info.get('count_deltas', {}))
+        )
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_count_deltas(session):
+    # Released savepoint is still a part of transaction
+    if session.in_nested_transaction():
+        session.info.get('count_savepoints', {}).pop(session.get_nested_transaction(), None)
+        return
+
+    if session.info.pop('has_changes', False):
+        row_counter.apply(session.info.pop('count_deltas', {}))
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def restore_count_deltas(session, previous_transaction):
+    saved = session.info.get('count_savepoints', {}).pop(previous_transaction, None)
+
+    if saved is not None:
+        session.info['has_changes'], deltas = saved
+        session.info['count_deltas'] = defaultdict(int, deltas)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def discard_count_deltas(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('has_changes', None)
+        session.info.pop('count_deltas', None)
+        session.info.pop('count_savepoints', None)
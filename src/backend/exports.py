@@ -0,0 +1,206 @@
+import csv
+import datetime
+import decimal
+import enum
+import io
+import json
+import zipfile
+from abc import ABC, abstractmethod
+from typing import Any, Iterable, Iterator, Sequence
+from xml.sax.saxutils import escape
+
+from .report import iterate_windows
+
+
+EXPORT_WINDOW = 500
+
+
+class ExportFormat(str, enum.Enum):
+    PDF = 'pdf'
+    CSV = 'csv'
+    NDJSON = 'ndjson'
+    XLSX = 'xlsx'
+
+
+def to_text(value: Any) -> str:
+    """
+    Help function, which converts row value to text
+    :param value: value to convert
+    :return:
+    """
+    if value is None:
+        return ''
+
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+
+    return str(value)
+
+
+class ReportSerializer(ABC):
+    """
+    Serializes report rows to bytes of file format.
+    Rows are serialized by windows, so file is sent
+    while it is being serialized and never held in memory
+    """
+
+    __mimetype__ = None
+    __extension__ = None
+
+    @abstractmethod
+    def serialize(self, columns: Sequence[str], rows: Iterable[dict]) -> Iterator[bytes]:
+        """
+        Returns chunks of file
+        :param columns: names of row fields
+        :param rows: rows of report
+        :return:
+        """
+
+
+class CsvSerializer(ReportSerializer):
+    __mimetype__ = 'text/csv'
+    __extension__ = 'csv'
+
+    def serialize(self, columns: Sequence[str], rows: Iterable[dict]) -> Iterator[bytes]:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+
+        for window in iterate_windows(rows, size=EXPORT_WINDOW):
+            writer.writerows([to_text(row[column]) for column in columns] for row in window)
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+
+        yield buffer.getvalue().encode()
+
+
+class NdjsonSerializer(ReportSerializer):
+    __mimetype__ = 'application/x-ndjson'
+    __extension__ = 'ndjson'
+
+    @staticmethod
+    def to_json(value: Any) -> Any:
+        if value is None or isinstance(value, (int, str)):
+            return value
+
+        # Decimals are kept as strings, so amounts stay exact
+        return to_text(value)
+
+    def serialize(self, columns: Sequence[str], rows: Iterable[dict]) -> Iterator[bytes]:
+        for window in iterate_windows(rows, size=EXPORT_WINDOW):
+            yield ''.join(
+                json.dumps({column: self.to_json(row[column]) for column in columns}, ensure_ascii=False) + '\n'
+                for row in window
+            ).encode()
+
+
+class ZipStream(io.RawIOBase):
+    """
+    Not seekable file for `zipfile`,
+    written bytes are taken by chunks
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+class XlsxSerializer(ReportSerializer):
+    """
+    Writes a minimal SpreadsheetML workbook with one sheet.
+    Zip archive is written to not seekable stream,
+    so sheet is compressed and sent row by row
+    """
+
+    __mimetype__ = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    __extension__ = 'xlsx'
+
+    XML_HEADER = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+    PARTS = {
+        '[Content_Types].xml': (
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            '</Types>'
+        ),
+        '_rels/.rels': (
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+            'Target="xl/workbook.xml"/>'
+            '</Relationships>'
+        ),
+        'xl/workbook.xml': (
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            '<sheets><sheet name="Report" sheetId="1" r:id="rId1"/></sheets>'
+            '</workbook>'
+        ),
+        'xl/_rels/workbook.xml.rels': (
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+            'Target="worksheets/sheet1.xml"/>'
+            '</Relationships>'
+        ),
+    }
+
+    @staticmethod
+    def get_cell(value: Any) -> str:
+        if isinstance(value, (int, decimal.Decimal)) and not isinstance(value, bool):
+            return f'<c><v>{value}</v></c>'
+
+        return f'<c t="inlineStr"><is><t>{escape(to_text(value))}</t></is></c>'
+
+    def get_row(self, values: Iterable[Any]) -> str:
+        return '<row>' + ''.join(self.get_cell(value) for value in values) + '</row>'
+
+    def serialize(self, columns: Sequence[str], rows: Iterable[dict]) -> Iterator[bytes]:
+        stream = ZipStream()
+
+        with zipfile.ZipFile(stream, mode='w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for name, content in self.PARTS.items():
+                archive.writestr(name, self.XML_HEADER + content)
+
+            with archive.open('xl/worksheets/sheet1.xml', mode='w', force_zip64=True) as sheet:
+                sheet.write((
+                    self.XML_HEADER +
+                    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>' +
+                    self.get_row(columns)
+                ).encode())
+
+                for window in iterate_windows(rows, size=EXPORT_WINDOW):
+                    sheet.write(''.join(
+                        self.get_row(row[column] for column in columns)
+                        for row in window
+                    ).encode())
+                    yield stream.take()
+
+                sheet.write(b'</sheetData></worksheet>')
+
+        yield stream.take()
+
+
+SERIALIZERS = {
+    ExportFormat.CSV: CsvSerializer(),
+    ExportFormat.NDJSON: NdjsonSerializer(),
+    ExportFormat.XLSX: XlsxSerializer(),
+}
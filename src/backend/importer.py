@@ -0,0 +1,219 @@
+import csv
+import decimal
+import enum
+import functools
+import itertools
+import json
+from typing import (
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    TextIO,
+    Tuple,
+)
+
+import click
+
+from .app import app
+from .controller import BusinessController, InvoiceType
+from .models import db
+
+
+IMPORT_BATCH_SIZE = 500
+
+# Errors of the first bad rows are reported, the rest are only counted
+IMPORT_MAX_ERRORS = 100
+
+ImportRow = Tuple[int, Callable[[], dict]]
+
+CSV_COLUMNS = ('invoice', 'type', 'date', 'product_id', 'quantity', 'total_price')
+
+
+class ImportFormat(str, enum.Enum):
+    NDJSON = 'ndjson'
+    CSV = 'csv'
+
+
+def read_ndjson(lines: Iterable[str]) -> Iterator[ImportRow]:
+    """
+    Reads invoices from NDJSON, one invoice per line:
+    {"type": "sale", "date": "...", "items": [{"product_id": 1, ...}]}
+    :param lines: lines of file
+    :return: line numbers with invoice parsers
+    """
+    for row, line in enumerate(lines, start=1):
+        if line.strip():
+            yield row, functools.partial(json.loads, line, parse_float=decimal.Decimal)
+
+
+def invoice_from_csv(rows: List[dict]) -> dict:
+    """
+    Builds invoice json from CSV rows of its items
+    :param rows: rows of one invoice
+    :return:
+    """
+    items = []
+
+    for row in rows:
+        item = {
+            'product_id': int(row['product_id']),
+            'quantity': int(row['quantity']),
+            'total_price': row['total_price'],
+        }
+
+        if row.get('arrival_date'):
+            item['arrival_date'] = row['arrival_date']
+
+        items.append(item)
+
+    return {
+        'type': rows[0]['type'],
+        'date': rows[0]['date'],
+        'items': items,
+    }
+
+
+def read_csv(lines: Iterable[str]) -> Iterator[ImportRow]:
+    """
+    Reads invoices from CSV with one item per row and columns:
+    invoice,type,date,product_id,quantity,total_price,arrival_date.
+    Consecutive rows with the same `invoice` are items of one invoice
+    :param lines: lines of file
+    :return: row numbers with invoice parsers
+    """
+    reader = csv.DictReader(lines)
+    missing_columns = [column for column in CSV_COLUMNS if column not in (reader.fieldnames or ())]
+
+    if missing_columns:
+        raise ValueError(f'Missing CSV columns - {", ".join(missing_columns)}')
+
+    rows = enumerate(reader, start=2)
+
+    for _, invoice_rows in itertools.groupby(rows, key=lambda numbered_row: numbered_row[1]['invoice']):
+        invoice_rows = list(invoice_rows)
+        yield invoice_rows[0][0], functools.partial(invoice_from_csv, [row for _, row in invoice_rows])
+
+
+READERS = {
+    ImportFormat.NDJSON: read_ndjson,
+    ImportFormat.CSV: read_csv,
+}
+
+
+class InvoiceImporter:
+
+    """
+    Imports invoices with `BusinessController.create_invoice`.
+    Every invoice is created in own savepoint, so bad rows are reported
+    and skipped, and session is committed every `batch_size` invoices.
+    Not committed changes of session are dropped, when import starts
+    """
+
+    def __init__(self, batch_size: int = IMPORT_BATCH_SIZE, max_errors: int = IMPORT_MAX_ERRORS):
+        if batch_size < 1 or max_errors < 1:
+            raise ValueError('Batch size and max errors must be positive')
+
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+
+    @staticmethod
+    def import_invoice(invoice_json: dict) -> None:
+        BusinessController.create_invoice(
+            invoice_type=InvoiceType(invoice_json['type']),
+            creation_date=BusinessController.parse_time(invoice_json['date']),
+            invoice_items=BusinessController.create_items_from_json(invoice_json['items']),
+            commit=False
+        )
+
+    @staticmethod
+    def begin() -> None:
+        # Batch is a writing transaction, as in `BusinessController.run_in_transaction`,
+        # so on SQLite it doesn't fail to upgrade a read lock while API writers are active
+        db.session.rollback()
+        db.session.connection(execution_options={'write_transaction': True})
+
+    def commit(self) -> None:
+        db.session.commit()
+        # Imported objects aren't needed anymore, so memory stays flat
+        db.session.expunge_all()
+
+    def run(self, rows: Iterable[ImportRow]) -> dict:
+        """
+        Imports all invoices from rows
+        :param rows: row numbers with invoice parsers
+        :return: count of imported invoices, count of errors
+        and errors of the first `max_errors` bad rows. Error of file,
+        which can't be read further, has no row and is always reported
+        """
+        imported = 0
+        error_count = 0
+        errors = []
+        rows = iter(rows)
+        self.begin()
+
+        for index in itertools.count(start=1):
+            try:
+                row, read_invoice = next(rows)
+
+            except StopIteration:
+                break
+
+            # Bad encoding or header ends the file, imported rows are kept
+            except Exception as error:
+                error_count += 1
+                errors.append({'row': None, 'error': f'Bad file - {error}'})
+                break
+
+            savepoint = db.session.begin_nested()
+
+            try:
+                self.import_invoice(read_invoice())
+                savepoint.commit()
+                imported += 1
+
+            # Any bad row is reported without aborting the whole file
+            except Exception as error:
+                savepoint.rollback()
+                error_count += 1
+
+                if len(errors) < self.max_errors:
+                    errors.append({'row': row, 'error': str(error)})
+
+            if index % self.batch_size == 0:
+                self.commit()
+                self.begin()
+
+        self.commit()
+        return {'imported': imported, 'error_count': error_count, 'errors': errors}
+
+    def import_file(self, file: TextIO, file_format: ImportFormat) -> dict:
+        """
+        Imports invoices from text file of that format
+        :param file: file to read
+        :param file_format: format of file
+        :return:
+        """
+        return self.run(READERS[file_format](file))
+
+
+@app.cli.command('import-invoices')
+@click.argument('file', type=click.File(encoding='utf-8'))
+@click.option('--format', 'file_format', type=click.Choice([item.value for item in ImportFormat]), default='ndjson')
+@click.option('--batch-size', type=click.IntRange(min=1), default=IMPORT_BATCH_SIZE)
+@click.option('--max-errors', type=click.IntRange(min=1), default=IMPORT_MAX_ERRORS,
+              help='Count of reported errors, the rest are counted')
+def import_invoices_command(file: TextIO, file_format: str, batch_size: int, max_errors: int) -> None:
+    """
+    Imports sale and income invoices from NDJSON or CSV file
+    """
+    importer = InvoiceImporter(batch_size=batch_size, max_errors=max_errors)
+    result = importer.import_file(file, ImportFormat(file_format))
+
+    for error in result['errors']:
+        click.echo(f'Row {error["row"]}: {error["error"]}' if error['row'] else error['error'], err=True)
+
+    if result['error_count'] > len(result['errors']):
+        click.echo(f'... and {result["error_count"] - len(result["errors"])} more errors', err=True)
+
+    click.echo(f'Imported {result["imported"]} invoices, {result["error_count"]} errors')
@@ -0,0 +1,393 @@
+import contextlib
+import datetime
+import enum
+import fcntl
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, Union
+
+from sqlalchemy import delete, update
+
+from .app import app
+from .models import ReportJob, db, get_data_versions
+from .report import ReportType, REPORT_CLASSES, REPORTS_DIRECTORY
+
+
+# Lock files of rendering reports, shared by all workers of host
+RENDER_SLOTS_DIRECTORY = Path(tempfile.gettempdir()) / 'report-render-slots'
+
+# Seconds between attempts to take a free render slot
+RENDER_SLOT_WAIT = 0.2
+
+
+class JobStatus(str, enum.Enum):
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+def get_job_key(report_type: ReportType, arguments: dict, versions: Dict[str, Union[int, None]]) -> str:
+    """
+    Returns key of report parameters and data versions,
+    jobs with the same key render the same report
+    :param report_type: type of report
+    :param arguments: arguments of report creation
+    :param versions: data versions of report tables
+    :return:
+    """
+    parameters = json.dumps([
+        report_type.value,
+        sorted((name, str(value)) for name, value in arguments.items()),
+        sorted(versions.items()),
+    ])
+    return hashlib.sha256(parameters.encode()).hexdigest()
+
+
+def get_process_start(pid: int) -> Union[str, None]:
+    """
+    Returns start time of process. Together with pid it identifies
+    process, even when pid is taken by a new one after restart.
+    Without procfs only existence of process is checked
+    :param pid: id of process
+    :return: start time ( empty without procfs ), None if process isn't running
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as file:
+            stat = file.read()
+    except FileNotFoundError:
+        if os.path.isdir('/proc/self'):
+            return None
+
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return None
+        except PermissionError:
+            pass
+
+        return ''
+
+    # Name of process can contain spaces, start time is the 20th field after it
+    return stat[stat.rindex(')') + 2:].split()[19]
+
+
+def get_process_owner() -> str:
+    """
+    Returns owner of jobs, submitted by current process
+    :return:
+    """
+    pid = os.getpid()
+    return f'{socket.gethostname()}:{pid}:{get_process_start(pid)}'
+
+
+def is_owner_running(owner: Union[str, None]) -> bool:
+    """
+    Checks, whether process, which submitted job, is still running.
+    Processes of other hosts can't be checked, they are considered running
+    :param owner: owner of job
+    :return:
+    """
+    if owner is None:
+        return True
+
+    host, pid, start = owner.rsplit(':', 2)
+    return host != socket.gethostname() or get_process_start(int(pid)) == start
+
+
+@contextlib.contextmanager
+def render_slot(directory: Path, slots: int) -> Iterator[None]:
+    """
+    Waits for one of `slots` lock files, shared by all processes of host,
+    so count of reports, rendered at once, doesn't grow with count of
+    web workers. Lock is released by system, when process dies
+    :param directory: directory of lock files
+    :param slots: count of reports, rendered at once
+    :return:
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+
+    while True:
+        for slot in range(slots):
+            file = open(directory / f'{slot}.lock', 'w')
+
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                file.close()
+                continue
+
+            try:
+                yield
+            finally:
+                file.close()
+            return
+
+        time.sleep(RENDER_SLOT_WAIT)
+
+
+def render_report(filename: str, report_type: ReportType, arguments: dict, slots: int) -> str:
+    """
+    Renders report in pool process.
+    Report is written to temporary file first,
+    so not finished report is never visible under its filename
+    :param filename: filename of rendered report
+    :param report_type: type of report
+    :param arguments: arguments of report creation
+    :param slots: count of reports, rendered at once by all processes of host
+    :return: filename of rendered report
+    """
+    report_class = REPORT_CLASSES[report_type]
+
+    with render_slot(RENDER_SLOTS_DIRECTORY, slots), app.app_context():
+        path = report_class(filename=f'.{filename}.tmp').create(**arguments)
+
+    os.replace(path, REPORTS_DIRECTORY / filename)
+    return filename
+
+
+class ReportCache:
+
+    """
+    Rendered reports in reports directory.
+    Reports are named by key of parameters and data versions,
+    so the same report is never rendered twice.
+    Last use time is kept as file modification time,
+    least recently used reports are evicted
+    """
+
+    def __init__(self, directory: Path, max_bytes: int, max_age: float):
+        """
+        :param directory: directory of reports
+        :param max_bytes: max total size of reports
+        :param max_age: seconds, after which not used report is removed
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def get(self, filename: str) -> bool:
+        """
+        Checks, whether report is rendered and marks it as used
+        :param filename: filename of report
+        :return:
+        """
+        try:
+            os.utime(self.directory / filename)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def evict(self) -> List[str]:
+        """
+        Removes too old reports and least recently used ones,
+        while total size of reports is greater than limit
+        :return: filenames of removed reports
+        """
+        reports = []
+        evicted = []
+
+        for path in self.directory.glob('*.pdf'):
+            try:
+                reports.append((path.stat(), path))
+            except FileNotFoundError:
+                continue
+
+        reports.sort(key=lambda report: report[0].st_mtime)
+        total_size = sum(stat.st_size for stat, _ in reports)
+        oldest_time = time.time() - self.max_age
+
+        for stat, path in reports:
+            if stat.st_mtime >= oldest_time and total_size <= self.max_bytes:
+                break
+
+            path.unlink(missing_ok=True)
+            total_size -= stat.st_size
+            evicted.append(path.name)
+
+        return evicted
+
+
+class ReportJobs:
+
+    """
+    Renders reports in process pool.
+    State of jobs is kept in database, so any worker can report it.
+    Pending job with the same parameters is reused instead of new one.
+
+    Every web worker has own pool of `max_workers` processes,
+    reports, rendered at once by all pools of host, are limited
+    by `render_slots`. Pending job of stopped worker is never
+    finished, it is failed, when it is requested
+    """
+
+    def __init__(self, max_workers: int, render_slots: int, timeout: float, cache: ReportCache):
+        """
+        :param max_workers: count of processes of worker, which render reports
+        :param render_slots: count of reports, rendered at once by all workers of host
+        :param timeout: seconds, after which pending job is considered lost
+        :param cache: cache of rendered reports
+        """
+        self.max_workers = max_workers
+        self.render_slots = render_slots
+        self.timeout = timeout
+        self.cache = cache
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        # Pool is created on first job, so it is never inherited by forked workers
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return self.executor
+
+    def check(self, job: ReportJob) -> ReportJob:
+        """
+        Fails pending job, which is lost: its worker is stopped
+        or it isn't finished in `timeout` seconds
+        :param job: job to check
+        :return:
+        """
+        if job.status != JobStatus.PENDING:
+            return job
+
+        if job.created_at < datetime.datetime.now() - datetime.timedelta(seconds=self.timeout):
+            error = 'Report job is not finished in time'
+        elif not is_owner_running(job.owner):
+            error = 'Worker of report job is stopped'
+        else:
+            return job
+
+        # Job, finished meanwhile, keeps its result
+        db.session.execute(
+            update(ReportJob).
+            where(ReportJob.id == job.id, ReportJob.status == JobStatus.PENDING).
+            values(status=JobStatus.FAILED, error=error)
+        )
+        db.session.commit()
+        db.session.refresh(job)
+        return job
+
+    def get_pending(self, key: str) -> Union[ReportJob, None]:
+        """
+        Returns not lost pending job with the same key
+        :param key: key of report parameters
+        :return:
+        """
+        jobs = ReportJob.query.filter(ReportJob.key == key, ReportJob.status == JobStatus.PENDING).all()
+        return next((job for job in jobs if self.check(job).status == JobStatus.PENDING), None)
+
+    def submit(self, report_type: ReportType, arguments: dict) -> ReportJob:
+        """
+        Enqueues report rendering
+        :param report_type: type of report
+        :param arguments: arguments of report creation
+        :return: new, already pending or finished with cached report job
+        """
+        report_class = REPORT_CLASSES[report_type]
+        versions = get_data_versions(model.__tablename__ for model in report_class.__tables__)
+        key = get_job_key(report_type, arguments, versions)
+        job_id = uuid.uuid4().hex
+        # Without known data versions report can't be reused
+        is_cacheable = None not in versions.values()
+        filename = f'{key[:32] if is_cacheable else job_id}_{report_class().get_filename(**arguments)}'
+
+        if is_cacheable and self.cache.get(filename):
+            job = ReportJob(
+                id=job_id,
+                key=key,
+                report_type=report_type.value,
+                status=JobStatus.DONE,
+                filename=filename,
+            )
+            db.session.add(job)
+            db.session.commit()
+            return job
+
+        job = self.get_pending(key)
+
+        if job is not None:
+            return job
+
+        job = ReportJob(
+            id=job_id,
+            key=key,
+            report_type=report_type.value,
+            status=JobStatus.PENDING,
+            owner=get_process_owner(),
+        )
+        db.session.add(job)
+        db.session.commit()
+
+        future = self.get_executor().submit(render_report, filename, report_type, arguments, self.render_slots)
+        future.add_done_callback(functools.partial(self.finish, job.id))
+        return job
+
+    def finish(self, job_id: str, future: Future) -> None:
+        """
+        Saves result of rendering to job
+        :param job_id: finished job
+        :param future: future of rendering
+        :return:
+        """
+        with app.app_context():
+            job = db.session.get(ReportJob, job_id)
+            error = future.exception()
+
+            if error is None:
+                job.status = JobStatus.DONE
+                job.filename = future.result()
+            else:
+                job.status = JobStatus.FAILED
+                job.error = str(error)
+
+            db.session.commit()
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Evicts rendered reports. Finished jobs of removed reports are failed,
+        jobs, which are older than max age of reports, are deleted
+        :return:
+        """
+        evicted = self.cache.evict()
+
+        if evicted:
+            db.session.execute(
+                update(ReportJob).
+                where(ReportJob.filename.in_(evicted), ReportJob.status == JobStatus.DONE).
+                values(status=JobStatus.FAILED, error='Report is removed from cache, create it again')
+            )
+
+        # Pending job of that age is lost too
+        max_age = max(self.cache.max_age, self.timeout)
+        db.session.execute(
+            delete(ReportJob).
+            where(ReportJob.created_at < datetime.datetime.now() - datetime.timedelta(seconds=max_age))
+        )
+        db.session.commit()
+
+
+report_jobs = ReportJobs(
+    max_workers=int(os.environ.get('REPORT_WORKERS', 2)),
+    render_slots=int(os.environ.get('REPORT_RENDER_SLOTS', 2)),
+    timeout=float(os.environ.get('REPORT_JOB_TIMEOUT', 3600)),
+    cache=ReportCache(
+        directory=REPORTS_DIRECTORY,
+        max_bytes=int(os.environ.get('REPORT_CACHE_MAX_BYTES', 512 * 1024 * 1024)),
+        max_age=float(os.environ.get('REPORT_CACHE_MAX_AGE', 7 * 24 * 60 * 60)),
+    ),
+)
@@ -0,0 +1,462 @@
+import bisect
+import datetime
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import click
+from sqlalchemy import event, func, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+
+from .app import app
+from .cache import data_versions
+from .models import Consignment, DataVersion, Product, SaleInvoiceItem, db, register_versioned_tables
+
+
+CONSIGNMENT_TABLE = Consignment.__tablename__
+
+# Ledger is refreshed by version of consignments
+register_versioned_tables([Consignment])
+
+# Open consignment: arrival date, consignment number, id and current quantity.
+# Consignments of product are kept in order of write off
+LedgerEntry = Tuple[datetime.datetime, int, int, int]
+
+ADD = 'add'
+WRITE_OFF = 'write_off'
+
+
+class StockLedger:
+
+    """
+    In-memory stock of products: available quantity and open
+    ( not depreciated ) consignments in order of write off.
+
+    Ledger follows version of `consignment` table. Committed changes
+    of this process are applied to it, changes of other processes
+    ( version, which ledger hasn't seen ) reload it from database.
+    Writing transactions check version in database, so stock is planned
+    from actual data, other reads use versions of `data_versions` cache.
+    Ledger is refreshed with connection of reading transaction, until
+    it has changed stock. Products, which are changed by transaction,
+    are read by it from database, as ledger has only committed stock
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.loaded = False
+        self.version: Optional[int] = None
+        self.entries: Dict[int, List[LedgerEntry]] = {}
+        self.quantities: Dict[int, int] = {}
+        # Products, which are read from database by the next refresh
+        self.expired: Set[int] = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def read_version(connection: Connection) -> Optional[int]:
+        return connection.scalar(select(DataVersion.version).where(DataVersion.table_name == CONSIGNMENT_TABLE))
+
+    @staticmethod
+    def read_entries(connection: Connection, product_ids: Optional[Iterable[int]] = None) -> Dict[int, List[LedgerEntry]]:
+        """
+        Reads open consignments from database
+        :param connection: connection to read with
+        :param product_ids: products to read, all products by default
+        :return: consignments by product id ( products without them are missed )
+        """
+        query = select(
+            Consignment.product_id,
+            Consignment.arrival_date,
+            Consignment.consignment_number,
+            Consignment.id,
+            Consignment.current_quantity,
+        ).where(Consignment.depreciated.is_(False))
+
+        if product_ids is not None:
+            query = query.where(Consignment.product_id.in_(product_ids))
+
+        entries = defaultdict(list)
+
+        for product_id, *entry in connection.execute(
+                query.order_by(Consignment.product_id, Consignment.arrival_date, Consignment.consignment_number)
+        ):
+            entries[product_id].append(tuple(entry))
+
+        return entries
+
+    def set_entries(self, product_id: int, entries: List[LedgerEntry]) -> None:
+        if entries:
+            self.entries[product_id] = entries
+            self.quantities[product_id] = sum(entry[3] for entry in entries)
+        else:
+            self.entries.pop(product_id, None)
+            self.quantities.pop(product_id, None)
+
+    def refresh(self, connection: Connection) -> None:
+        """
+        Brings ledger to committed data: reloads it, if version has changed,
+        otherwise reloads only expired products. Lock must be held
+        :param connection: connection to read with
+        :return:
+        """
+        version = self.read_version(connection)
+
+        if not self.loaded or version != self.version:
+            self.entries, self.quantities = {}, {}
+
+            for product_id, entries in self.read_entries(connection).items():
+                self.set_entries(product_id, entries)
+
+        elif self.expired:
+            entries = self.read_entries(connection, self.expired)
+
+            for product_id in self.expired:
+                self.set_entries(product_id, entries.get(product_id, []))
+
+        self.expired.clear()
+        self.version = version
+        self.loaded = True
+
+    def ensure(self, version: Optional[int], connection: Optional[Connection]) -> bool:
+        """
+        Refreshes ledger, if it is older than version or has expired products.
+        Lock must be held
+        :param version: version of consignments, which is expected
+        :param connection: connection to refresh with, None if it sees
+        not committed stock and ledger can't be refreshed now
+        :return: is ledger fresh
+        """
+        is_fresh = self.loaded and not self.expired and (
+            version == self.version or
+            version is not None and self.version is not None and version < self.version
+        )
+
+        if not is_fresh and connection is not None:
+            self.refresh(connection)
+            return True
+
+        return is_fresh
+
+    def load(self) -> None:
+        """
+        Reads all open consignments from database ( warming of ledger )
+        :return:
+        """
+        with self.lock, db.engine.connect() as connection:
+            self.loaded = False
+            self.refresh(connection)
+
+    def expire(self, product_ids: Iterable[int]) -> None:
+        with self.lock:
+            if self.loaded:
+                self.expired.update(product_ids)
+
+    def get_quantities(self, product_ids: Iterable[int]) -> Dict[int, int]:
+        """
+        Returns available quantities of products for reading,
+        committed changes are seen in `data_versions` ttl
+        :param product_ids: products to check
+        :return: quantity by product id
+        """
+        product_ids = list(product_ids)
+        version = data_versions.get([CONSIGNMENT_TABLE])[CONSIGNMENT_TABLE]
+
+        with self.lock:
+            if self.ensure(version, self.get_session_connection(db.session)):
+                return {product_id: self.quantities.get(product_id, 0) for product_id in product_ids}
+
+        return dict(db.session.execute(select(Product.id, Product.quantity).where(Product.id.in_(product_ids))).all())
+
+    def set_quantities(self, products: Iterable[Product]) -> None:
+        """
+        Sets available quantities of loaded products from ledger,
+        so `Product.quantity` doesn't sum their consignments
+        :param products: products without loaded quantity
+        :return:
+        """
+        products = list(products)
+        quantities = self.get_quantities(product.id for product in products)
+
+        for product in products:
+            set_committed_value(product, 'loaded_quantity', quantities.get(product.id, 0))
+
+    @staticmethod
+    def get_session_version(session: Session) -> Optional[int]:
+        """
+        Returns version of consignments, which transaction has started with.
+        Version is read once by transaction
+        :param session: session of transaction
+        :return:
+        """
+        increased = session.info.get('increased_versions', {}).get(CONSIGNMENT_TABLE)
+
+        if increased is not None:
+            return increased[0]
+
+        if 'stock_version' not in session.info:
+            session.info['stock_version'] = session.scalar(
+                select(DataVersion.version).where(DataVersion.table_name == CONSIGNMENT_TABLE)
+            )
+
+        return session.info['stock_version']
+
+    @staticmethod
+    def get_session_connection(session: Session) -> Optional[Connection]:
+        """
+        Returns connection of transaction, if it hasn't changed stock yet,
+        so ledger can be refreshed with it without additional connection
+        :param session: session of transaction
+        :return:
+        """
+        has_changes = (
+            session.info.get('stock_changes', {}) != {} or
+            CONSIGNMENT_TABLE in session.info.get('increased_versions', {})
+        )
+        return None if has_changes else session.connection()
+
+    def is_readable(self, session: Session, product_id: int) -> bool:
+        """
+        Checks, that stock of product can be read from ledger in transaction
+        :param session: session of transaction
+        :param product_id: product to read
+        :return:
+        """
+        changes = session.info.get('stock_changes', {})
+        return self.enabled and changes is not None and product_id not in changes
+
+    def read_quantities(self, session: Session, product_ids: Iterable[int]) -> Dict[int, int]:
+        """
+        Returns available quantities of products, which can be read
+        from ledger in transaction
+        :param session: session of transaction
+        :param product_ids: products to check
+        :return: quantity by product id ( products, which must be read from database, are missed )
+        """
+        product_ids = [product_id for product_id in product_ids if self.is_readable(session, product_id)]
+
+        if not product_ids:
+            return {}
+
+        version = self.get_session_version(session)
+
+        with self.lock:
+            if not self.ensure(version, self.get_session_connection(session)):
+                return {}
+
+            return {product_id: self.quantities.get(product_id, 0) for product_id in product_ids}
+
+    def read_consignments(self, session: Session, product_id: int) -> Optional[List[Tuple[int, int]]]:
+        """
+        Returns open consignments of product in order of write off
+        :param session: session of transaction
+        :param product_id: product to read
+        :return: ids and current quantities of consignments,
+        None if product must be read from database
+        """
+        if not self.is_readable(session, product_id):
+            return None
+
+        version = self.get_session_version(session)
+
+        with self.lock:
+            if not self.ensure(version, self.get_session_connection(session)):
+                return None
+
+            return [(entry[2], entry[3]) for entry in self.entries.get(product_id, ())]
+
+    @staticmethod
+    def record(session: Session, product_id: int, operation: Optional[tuple]) -> None:
+        """
+        Records change of product stock in transaction
+        :param session: session of transaction
+        :param product_id: changed product
+        :param operation: `(ADD, entry)` or `(WRITE_OFF, consignment_id, quantity)`,
+        None if product must be reloaded
+        :return:
+        """
+        changes = session.info.setdefault('stock_changes', {})
+
+        if changes is None:
+            return
+
+        if operation is None or product_id in changes and changes[product_id] is None:
+            changes[product_id] = None
+        else:
+            changes.setdefault(product_id, []).append(operation)
+
+    def apply_operations(self, product_id: int, operations: list) -> bool:
+        """
+        Applies committed operations to product stock
+        :param product_id: changed product
+        :param operations: operations of product
+        :return: were operations applied ( otherwise product must be reloaded )
+        """
+        entries = list(self.entries.get(product_id, ()))
+
+        for operation in operations:
+            if operation[0] == ADD:
+                bisect.insort(entries, operation[1])
+                continue
+
+            _, consignment_id, written_off = operation
+            index = next((index for index, entry in enumerate(entries) if entry[2] == consignment_id), None)
+
+            if index is None or entries[index][3] < written_off:
+                return False
+
+            arrival_date, consignment_number, _, current_quantity = entries[index]
+
+            # Fully written off consignment is depreciated
+            if current_quantity == written_off:
+                del entries[index]
+            else:
+                entries[index] = (arrival_date, consignment_number, consignment_id, current_quantity - written_off)
+
+        self.set_entries(product_id, entries)
+        return True
+
+    def apply(
+            self,
+            versions: Optional[Tuple[int, int]],
+            changes: Optional[Dict[int, Optional[list]]]
+    ) -> None:
+        """
+        Applies changes of committed transaction. Ledger is reloaded,
+        if they can't be applied exactly
+        :param versions: versions of consignments before and after transaction
+        :param changes: operations by product id, None if they are unknown
+        :return:
+        """
+        with self.lock:
+            if not self.loaded:
+                return
+
+            # Changes of other transactions were missed or changes are unknown
+            if versions is None or not changes or versions[0] != self.version:
+                self.loaded = False
+                return
+
+            for product_id, operations in changes.items():
+                if operations is None or product_id in self.expired or not self.apply_operations(product_id, operations):
+                    self.expired.add(product_id)
+
+            self.version = versions[1]
+
+    def check(self) -> List[dict]:
+        """
+        Compares ledger with consignments in database.
+        Ledger is brought to committed data first
+        :return: products, which stock differs
+        """
+        with self.lock, db.engine.connect() as connection:
+            self.refresh(connection)
+            entries = self.read_entries(connection)
+            quantities = dict(connection.execute(
+                select(Consignment.product_id, func.sum(Consignment.current_quantity)).
+                group_by(Consignment.product_id)
+            ).all())
+            differences = []
+
+            for product_id in sorted(set(entries) | set(quantities) | set(self.entries)):
+                ledger = self.entries.get(product_id, [])
+                database = entries.get(product_id, [])
+
+                if ledger != database or self.quantities.get(product_id, 0) != quantities.get(product_id, 0):
+                    differences.append({
+                        'product_id': product_id,
+                        'ledger_quantity': self.quantities.get(product_id, 0),
+                        'database_quantity': quantities.get(product_id, 0),
+                        'ledger_consignments': [entry[2:] for entry in ledger],
+                        'database_consignments': [entry[2:] for entry in database],
+                    })
+
+            return differences
+
+
+stock_ledger = StockLedger(enabled=app.config['STOCK_LEDGER_ENABLED'])
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_flushed_consignments(session, flush_context):
+    if not stock_ledger.enabled:
+        return
+
+    for instance in session.new:
+        if isinstance(instance, Consignment) and not instance.depreciated:
+            stock_ledger.record(session, instance.product_id, (ADD, (
+                instance.arrival_date,
+                instance.consignment_number,
+                instance.id,
+                instance.current_quantity,
+            )))
+
+    for instance in session.dirty | session.deleted:
+        if isinstance(instance, Consignment):
+            stock_ledger.record(session, instance.product_id, None)
+
+
+@event.listens_for(SaleInvoiceItem, 'after_delete')
+def collect_restocked_product(mapper, connection, target):
+    # Consignments are restocked by `restock_consignments` with planning from database
+    if stock_ledger.enabled:
+        stock_ledger.record(db.session, target.product_id, None)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def collect_bulk_consignments(orm_execute_state):
+    is_changing = orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete
+    mapper = orm_execute_state.bind_mapper
+
+    # Rows of bulk statement are unknown
+    if stock_ledger.enabled and is_changing and mapper is not None and mapper.class_ is Consignment:
+        orm_execute_state.session.info['stock_changes'] = None
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_stock_changes(session):
+    # Released savepoint is still a part of transaction
+    if not stock_ledger.enabled or session.in_nested_transaction():
+        return
+
+    changes = session.info.pop('stock_changes', {})
+    versions = session.info.get('increased_versions', {}).get(CONSIGNMENT_TABLE)
+
+    if changes != {} or versions is not None:
+        stock_ledger.apply(versions, changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def expire_rolled_back_stock(session):
+    # Rolled back savepoint can hold some of changes and versions
+    if session.info.get('stock_changes'):
+        session.info['stock_changes'] = None
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def discard_stock_changes(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('stock_changes', None)
+        session.info.pop('stock_version', None)
+
+
+@app.cli.command('check-stock-ledger')
+def check_stock_ledger_command() -> None:
+    """
+    Loads stock ledger and compares it with consignments in database
+    """
+    differences = stock_ledger.check()
+
+    for difference in differences:
+        click.echo(
+            f'Product {difference["product_id"]}: ledger {difference["ledger_quantity"]} '
+            f'{difference["ledger_consignments"]}, database {difference["database_quantity"]} '
+            f'{difference["database_consignments"]}',
+            err=True
+        )
+
+    click.echo(f'Ledger is at version {stock_ledger.version}, {len(stock_ledger.entries)} products in stock')
+
+    if differences:
+        raise click.ClickException(f'Stock of {len(differences)} products differs from database')
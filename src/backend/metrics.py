@@ -0,0 +1,309 @@
+import bisect
+import contextlib
+import functools
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from flask import Flask, Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# Upper bounds of latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Phases of request in order of Server-Timing header
+PHASES = ('db', 'count', 'handler', 'serialize')
+
+
+class RequestTimings:
+
+    """
+    Timings of one request. Phases may be nested ( SQL is executed
+    inside handler ), time of a nested phase is not counted
+    in the outer one, so phases don't overlap
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stack: List[list] = []
+        self.durations: Dict[str, float] = defaultdict(float)
+        self.queries = 0
+
+    def enter(self, phase: str) -> None:
+        self.stack.append([phase, time.perf_counter(), 0.0])
+
+    def exit(self, phase: str) -> None:
+        """
+        Finishes the last started phase
+        :param phase: finished phase, unbalanced calls are ignored
+        :return:
+        """
+        if not self.stack or self.stack[-1][0] != phase:
+            return
+
+        _, started, nested = self.stack.pop()
+        duration = time.perf_counter() - started
+        self.durations[phase] += duration - nested
+
+        if self.stack:
+            self.stack[-1][2] += duration
+
+    def get_server_timing(self, total: float) -> str:
+        """
+        Returns value of `Server-Timing` header
+        :param total: time of request in seconds
+        :return:
+        """
+        metrics = [
+            f'{phase};dur={self.durations[phase] * 1000:.2f}'
+            for phase in PHASES
+            if phase in self.durations
+        ]
+        metrics.append(f'total;dur={total * 1000:.2f}')
+        metrics.append(f'queries;desc="{self.queries}"')
+        return ', '.join(metrics)
+
+
+class Histogram:
+
+    """
+    Prometheus histogram without labels
+    """
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+
+        if index < len(self.buckets):
+            self.counts[index] += 1
+
+        self.sum += value
+        self.count += 1
+
+    def get_samples(self) -> List[Tuple[str, str, float]]:
+        """
+        Returns samples of histogram with cumulative buckets
+        :return: suffix of metric name, `le` label and value
+        """
+        samples = []
+        cumulative = 0
+
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            samples.append(('_bucket', f'{bound}', cumulative))
+
+        samples.append(('_bucket', '+Inf', self.count))
+        samples.append(('_sum', None, self.sum))
+        samples.append(('_count', None, self.count))
+        return samples
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    """
+    Help function, which formats labels of Prometheus sample
+    :param labels: names and values of labels
+    :return:
+    """
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels.items()
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class RequestMetrics:
+
+    """
+    Measures time of SQL, handler and serialization of every request
+    and keeps latency histograms by resource.
+
+    Nothing is registered until `init_app` is called with metrics enabled,
+    so disabled metrics cost one flag check in `timed` blocks.
+    Every process keeps its own metrics, so with several gunicorn
+    workers every scrape returns metrics of one worker
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.enabled = False
+        self.server_timing = False
+        self.lock = threading.Lock()
+        self.latencies: Dict[Tuple[str, str], Histogram] = {}
+        self.phases: Dict[Tuple[str, str, str], float] = defaultdict(float)
+        self.queries: Dict[Tuple[str, str], int] = defaultdict(int)
+        self.responses: Dict[Tuple[str, str, int], int] = defaultdict(int)
+
+    def init_app(self, app: Flask, engine: Engine) -> None:
+        """
+        Registers request hooks and SQL listeners,
+        if `METRICS_ENABLED` or `SERVER_TIMING_ENABLED` is set
+        :param app: instrumented application
+        :param engine: engine, which SQL is measured
+        :return:
+        """
+        self.server_timing = app.config.get('SERVER_TIMING_ENABLED', False)
+        self.enabled = app.config.get('METRICS_ENABLED', False) or self.server_timing
+
+        if not self.enabled:
+            return
+
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        event.listen(engine, 'before_cursor_execute', self.start_query)
+        event.listen(engine, 'after_cursor_execute', self.finish_query)
+        event.listen(engine, 'handle_error', self.fail_query)
+
+    @staticmethod
+    def get_timings():
+        if not has_request_context():
+            return None
+
+        return g.get('request_timings')
+
+    @contextlib.contextmanager
+    def timer(self, phase: str):
+        """
+        Measures a block of code as phase of current request
+        :param phase: name of phase
+        :return:
+        """
+        timings = self.get_timings() if self.enabled else None
+
+        if timings is None:
+            yield
+            return
+
+        timings.enter(phase)
+
+        try:
+            yield
+        finally:
+            timings.exit(phase)
+
+    def timed(self, phase: str):
+        """
+        Decorator, which measures function as phase of current request
+        :param phase: name of phase
+        :return:
+        """
+        def wrapper(fn):
+            @functools.wraps(fn)
+            def timed_wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+
+                with self.timer(phase):
+                    return fn(*args, **kwargs)
+
+            return timed_wrapper
+        return wrapper
+
+    def start_query(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        timings = self.get_timings()
+
+        if timings is not None:
+            timings.queries += 1
+            timings.enter('db')
+
+    def finish_query(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        timings = self.get_timings()
+
+        if timings is not None:
+            timings.exit('db')
+
+    def fail_query(self, context) -> None:
+        self.finish_query(None, None, None, None, None, None)
+
+    @staticmethod
+    def start_request() -> None:
+        g.request_timings = RequestTimings()
+
+    def finish_request(self, response: Response) -> Response:
+        """
+        Records timings of finished request, streamed responses
+        are measured before their body is sent
+        :param response: response of request
+        :return:
+        """
+        timings = self.get_timings()
+
+        if timings is None:
+            return response
+
+        total = time.perf_counter() - timings.started
+        resource = request.url_rule.rule if request.url_rule is not None else 'unknown'
+        key = (resource, request.method)
+
+        with self.lock:
+            if key not in self.latencies:
+                self.latencies[key] = Histogram(self.buckets)
+
+            self.latencies[key].observe(total)
+            self.queries[key] += timings.queries
+            self.responses[(*key, response.status_code)] += 1
+
+            for phase, duration in timings.durations.items():
+                self.phases[(*key, phase)] += duration
+
+        if self.server_timing:
+            response.headers['Server-Timing'] = timings.get_server_timing(total)
+            # Frontend is served from other origin
+            response.headers['Timing-Allow-Origin'] = '*'
+
+        return response
+
+    def export(self) -> str:
+        """
+        Returns metrics in Prometheus text format
+        :return:
+        """
+        lines = [
+            '# HELP http_request_duration_seconds Latency of requests by resource',
+            '# TYPE http_request_duration_seconds histogram',
+        ]
+
+        with self.lock:
+            for (resource, method), histogram in sorted(self.latencies.items()):
+                for suffix, bound, value in histogram.get_samples():
+                    labels = {'resource': resource, 'method': method}
+
+                    if bound is not None:
+                        labels['le'] = bound
+
+                    lines.append(f'http_request_duration_seconds{suffix}{format_labels(labels)} {value}')
+
+            lines.append('# HELP http_request_phase_seconds_total Time of requests by phase')
+            lines.append('# TYPE http_request_phase_seconds_total counter')
+            lines.extend(
+                f'http_request_phase_seconds_total'
+                f'{format_labels({"resource": resource, "method": method, "phase": phase})} {duration}'
+                for (resource, method, phase), duration in sorted(self.phases.items())
+            )
+
+            lines.append('# HELP http_request_queries_total SQL statements, executed by requests')
+            lines.append('# TYPE http_request_queries_total counter')
+            lines.extend(
+                f'http_request_queries_total{format_labels({"resource": resource, "method": method})} {count}'
+                for (resource, method), count in sorted(self.queries.items())
+            )
+
+            lines.append('# HELP http_requests_total Finished requests by status')
+            lines.append('# TYPE http_requests_total counter')
+            lines.extend(
+                f'http_requests_total'
+                f'{format_labels({"resource": resource, "method": method, "status": status})} {count}'
+                for (resource, method, status), count in sorted(self.responses.items())
+            )
+
+        return '\n'.join(lines) + '\n'
+
+
+request_metrics = RequestMetrics()
@@ -1,14 +1,46 @@
-from sqlalchemy import event
+import datetime
+import itertools
+from collections import defaultdict
+from typing import List, Union, Iterable, Dict
+
+from sqlalchemy import event, func, select, inspect, bindparam
 from sqlalchemy.ext.hybrid import hybrid_property
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import Session, with_expression
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.orm.attributes import set_committed_value
 
 from .app import app
+from .counter import row_counter
 
 
 with app.app_context():
     db = SQLAlchemy(app, session_options={'autoflush': False})
 
+    if db.engine.dialect.name == 'sqlite':
+
+        @event.listens_for(db.engine, 'connect')
+        def configure_sqlite(dbapi_connection, connection_record):
+            # Transactions are started by SQLAlchemy ( `begin` below ),
+            # so savepoints and batched commits work as expected
+            dbapi_connection.isolation_level = None
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.close()
+
+        @event.listens_for(db.engine, 'begin')
+        def begin_sqlite(connection):
+            # Writing transactions take the write lock at once, so concurrent writers
+            # wait for each other ( busy_timeout ) instead of failing to upgrade a read lock
+            if connection.get_execution_options().get('write_transaction'):
+                connection.exec_driver_sql('BEGIN IMMEDIATE')
+            else:
+                connection.exec_driver_sql('BEGIN')
+
+
+RESTOCK_WINDOW = 100
+
 
 class Product(db.Model):
     """
@@ -36,10 +68,31 @@ class Product(db.Model):
         cascade='all, delete-orphan'
     )
 
+    loaded_quantity = db.query_expression()
+
     @hybrid_property
     def quantity(self) -> int:
+        # Already loaded consignments can hold not flushed write-offs,
+        # so they are preferred over the aggregate from the query
+        if 'consignments' in inspect(self).unloaded and self.loaded_quantity is not None:
+            return self.loaded_quantity
         return sum(map(lambda consignment: consignment.current_quantity, self.consignments))
 
+    @quantity.expression
+    def quantity(cls):
+        return select(func.coalesce(func.sum(Consignment.current_quantity), 0)). \
+            where(Consignment.product_id == cls.id). \
+            scalar_subquery()
+
+    @classmethod
+    def query_with_quantity(cls):
+        """
+        Returns a products query, which loads `quantity`
+        with a single aggregate instead of loading consignments
+        :return:
+        """
+        return cls.query.options(with_expression(cls.loaded_quantity, cls.quantity))
+
 
 class IncomeInvoice(db.Model):
     """
@@ -49,7 +102,7 @@ class IncomeInvoice(db.Model):
     __tablename__ = 'income_invoice'
 
     id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.DateTime, nullable=False)
+    date = db.Column(db.DateTime, nullable=False, index=True)
 
     items = db.relationship(
         'IncomeInvoiceItem',
@@ -62,11 +115,22 @@ class IncomeInvoice(db.Model):
     def total_price(self) -> int:
         return sum(map(lambda item: item.total_price, self.items))
 
+    @total_price.expression
+    def total_price(cls):
+        return select(func.coalesce(func.sum(IncomeInvoiceItem.total_price), 0)). \
+            where(IncomeInvoiceItem.invoice_id == cls.id). \
+            scalar_subquery()
+
 
 class IncomeInvoiceItem(db.Model):
 
+    __table_args__ = (
+        # Covers items of invoice for stock on date, without reading of table
+        db.Index('ix_income_invoice_item_invoice', 'invoice_id', 'product_id', 'quantity'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='CASCADE'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='CASCADE'), nullable=False, index=True)
     invoice_id = db.Column(db.Integer, db.ForeignKey('income_invoice.id', ondelete='CASCADE'), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
     arrival_date = db.Column(db.DateTime, nullable=False)
@@ -91,7 +155,7 @@ class SaleInvoice(db.Model):
     __tablename__ = 'sale_invoice'
 
     id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.DateTime, nullable=False)
+    date = db.Column(db.DateTime, nullable=False, index=True)
 
     items = db.relationship(
         'SaleInvoiceItem',
@@ -104,11 +168,22 @@ class SaleInvoice(db.Model):
     def total_price(self) -> int:
         return sum(map(lambda item: item.total_price, self.items))
 
+    @total_price.expression
+    def total_price(cls):
+        return select(func.coalesce(func.sum(SaleInvoiceItem.total_price), 0)). \
+            where(SaleInvoiceItem.sale_id == cls.id). \
+            scalar_subquery()
+
 
 class SaleInvoiceItem(db.Model):
 
+    __table_args__ = (
+        # Covers items of invoice for stock on date, without reading of table
+        db.Index('ix_sale_invoice_item_sale', 'sale_id', 'product_id', 'quantity'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='CASCADE'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='CASCADE'), nullable=False, index=True)
     sale_id = db.Column(db.Integer, db.ForeignKey('sale_invoice.id', ondelete='CASCADE'), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
     total_price = db.Column(db.Integer, nullable=False)
@@ -127,13 +202,55 @@ class Consignment(db.Model):
     income_invoice_item_id = db.Column(
         db.Integer,
         db.ForeignKey('income_invoice_item.id', ondelete='CASCADE'),
-        nullable=False
+        nullable=False,
+        index=True
     )
     quantity = db.Column(db.Integer, nullable=False)
     current_quantity = db.Column(db.Integer, nullable=False)
     depreciated = db.Column(db.Boolean, default=False)
     total_price = db.Column(db.Integer, nullable=False)
 
+    __table_args__ = (
+        # Consignments of product in order of arrival: quantity of product,
+        # restock from the latest consignments and last consignment number.
+        # Quantities are included, so these queries don't read the table
+        db.Index(
+            'ix_consignment_product',
+            'product_id',
+            'arrival_date',
+            'consignment_number',
+            'quantity',
+            'current_quantity',
+        ),
+        # FIFO write off reads only not depreciated consignments,
+        # which are a small part of all consignments
+        db.Index(
+            'ix_consignment_available',
+            'product_id',
+            'arrival_date',
+            'consignment_number',
+            sqlite_where=depreciated.is_(False),
+            postgresql_where=depreciated.is_(False),
+        ),
+    )
+
+
+class StockSnapshot(db.Model):
+    """
+    Stock of product ( income minus sales ) for all invoices
+    with date lower or equal to snapshot date
+    """
+
+    __tablename__ = 'stock_snapshot'
+
+    date = db.Column(db.DateTime, primary_key=True)
+    product_id = db.Column(
+        db.Integer,
+        db.ForeignKey('product.id', ondelete='CASCADE'),
+        primary_key=True
+    )
+    quantity = db.Column(db.Integer, nullable=False)
+
 
 @event.listens_for(IncomeInvoiceItem, 'after_delete')
 def delete_empty_income_invoice(mapper, connection, target):
@@ -146,48 +263,301 @@ def delete_empty_income_invoice(mapper, connection, target):
 @event.listens_for(SaleInvoiceItem, 'after_delete')
 def delete_empty_sale_invoice(mapper, connection, target):
     invoice = target.sale_invoice
-    to_add = target.quantity
 
-    for consignment in target.product.consignments[::-1]:
+    # Consignments are restocked once for all deleted items in `restock_consignments`
+    to_restock = db.session.info.setdefault('restock', defaultdict(int))
+    to_restock[target.product_id] += target.quantity
+
+    if not invoice.items:
+        db.session.delete(invoice)
 
-        if not (consignment.current_quantity >= consignment.quantity):
 
-            current_to_add = (
-                to_add if to_add + consignment.current_quantity <= consignment.quantity
-                else to_add - ((consignment.current_quantity + to_add) - consignment.quantity)
-            )
+def plan_restock(connection, product_id: int, to_add: int) -> List[dict]:
+    """
+    Plans returning of quantity to consignments of product,
+    starting from the latest arrived ones, which are not full.
+    Consignments are read only until quantity is returned
+    :param connection: connection of flushing session
+    :param product_id: product to restock
+    :param to_add: quantity to return
+    :return: new state of every touched consignment
+    """
+    changes = []
+    consignments = connection.execute(
+        select(Consignment.id, Consignment.quantity, Consignment.current_quantity).
+        where(Consignment.product_id == product_id, Consignment.current_quantity < Consignment.quantity).
+        order_by(Consignment.arrival_date.desc(), Consignment.consignment_number.desc()).
+        execution_options(yield_per=RESTOCK_WINDOW)
+    )
 
-            set_committed_value(
-                consignment, 'current_quantity', consignment.current_quantity + current_to_add
-            )
+    for consignment_id, quantity, current_quantity in consignments:
 
-            connection.execute(
-                Consignment.__table__.
-                update().
-                values(
-                    current_quantity=consignment.current_quantity,
-                    depreciated=consignment.current_quantity == 0
-                ).
-                where(Consignment.id == consignment.id)
-            )
+        current_to_add = min(to_add, quantity - current_quantity)
+        to_add -= current_to_add
 
-            to_add -= current_to_add
+        changes.append({
+            'consignment_id': consignment_id,
+            'current_quantity': current_quantity + current_to_add,
+            'depreciated': current_quantity + current_to_add == 0,
+        })
 
         if to_add == 0:
             break
 
-    if not invoice.items:
-        db.session.delete(invoice)
+    consignments.close()
+    return changes
+
+
+@event.listens_for(Session, 'after_flush')
+def restock_consignments(session, flush_context):
+    to_restock = session.info.pop('restock', None)
+
+    if not to_restock:
+        return
+
+    connection = session.connection()
+    changes = []
+
+    for product_id, to_add in to_restock.items():
+        changes.extend(plan_restock(connection=connection, product_id=product_id, to_add=to_add))
 
+    if not changes:
+        return
 
-def init_db() -> None:
+    connection.execute(
+        Consignment.__table__.
+        update().
+        where(Consignment.__table__.c.id == bindparam('consignment_id')),
+        changes
+    )
+    session.info.setdefault('changed_tables', set()).add(Consignment.__tablename__)
+
+    # Keeps already loaded consignments in sync with database
+    for change in changes:
+        consignment = session.identity_map.get(identity_key(Consignment, change['consignment_id']))
+
+        if consignment is not None:
+            set_committed_value(consignment, 'current_quantity', change['current_quantity'])
+            set_committed_value(consignment, 'depreciated', change['depreciated'])
+
+
+class ReportJob(db.Model):
+    """
+    Report, which is rendering in background
     """
-    Puts some initialization data to database
+
+    __tablename__ = 'report_job'
+
+    id = db.Column(db.String(32), primary_key=True)
+    key = db.Column(db.String(64), nullable=False, index=True)
+    report_type = db.Column(db.String(32), nullable=False)
+    status = db.Column(db.String(16), nullable=False)
+    filename = db.Column(db.String(256))
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.now)
+    # Process, which renders pending report, as `host:pid:start time`
+    owner = db.Column(db.String(256))
+
+
+class DataVersion(db.Model):
+    """
+    Version of table data, which is increased
+    by every flush, which changes table
+    """
+
+    __tablename__ = 'data_version'
+
+    table_name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Tables, which data versions are read by caches and reports.
+# Changes of other tables don't increase versions
+versioned_tables = set()
+
+
+def register_versioned_tables(models: Iterable[type]) -> None:
+    """
+    Marks tables of models as read by versions, so their changes
+    increase data versions. Readers register tables on import
+    :param models: models, which versions are read
+    :return:
+    """
+    versioned_tables.update(model.__tablename__ for model in models)
+
+
+def get_data_versions(tables: Iterable[str]) -> Dict[str, Union[int, None]]:
+    """
+    Returns current data versions of tables
+    :param tables: names of tables
+    :return: version by table name, None if table version is unknown
+    """
+    tables = list(tables)
+    versions = dict(db.session.execute(
+        select(DataVersion.table_name, DataVersion.version).
+        where(DataVersion.table_name.in_(tables))
+    ).all())
+    return {table: versions.get(table) for table in tables}
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def collect_executed_tables(orm_execute_state):
+    is_changing = orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete
+
+    if is_changing and orm_execute_state.bind_mapper is not None:
+        orm_execute_state.session.info.setdefault('changed_tables', set()).add(
+            orm_execute_state.bind_mapper.local_table.name
+        )
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_flushed_tables(session, flush_context):
+    tables = session.info.setdefault('changed_tables', set())
+
+    for instance in itertools.chain(session.new, session.dirty, session.deleted):
+        tables.add(instance.__table__.name)
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def increase_flushed_data_versions(session, flush_context):
+    increase_data_versions(session)
+
+
+@event.listens_for(Session, 'before_commit')
+def increase_executed_data_versions(session):
+    # Bulk statements, executed after last flush, are versioned here
+    increase_data_versions(session)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def discard_changed_tables(session, transaction):
+    # Tables of rolled back savepoint are kept, extra increase is harmless
+    if transaction.parent is None:
+        session.info.pop('changed_tables', None)
+
+
+def increase_data_versions(session) -> None:
+    """
+    Increases versions of tables, changed in session.
+    Versions of transaction are kept in `increased_versions`
+    of session info, until transaction ends.
+
+    Version row of table is updated by every transaction, which changes
+    table, and stays locked until its commit. So on PostgreSQL writers of
+    the same table wait for each other, even if they change different rows.
+    It is paid for checking data of cached responses and reports with one
+    small query, only tables, which are read by versions, are increased
+    :param session: session, which changed tables
     :return:
     """
-    db.drop_all()
+    tables = session.info.pop('changed_tables', set()) & versioned_tables
+
+    if tables:
+        # Cached versions of process are expired after commit
+        session.info.setdefault('increased_tables', set()).update(tables)
+        versions = session.info.setdefault('increased_versions', {})
+        data_version = DataVersion.__table__
+        connection = session.connection()
+        statement = data_version. \
+            update(). \
+            where(data_version.c.table_name.in_(tables)). \
+            values(version=data_version.c.version + 1)
+
+        if connection.dialect.update_returning:
+            increased = connection.execute(
+                statement.returning(data_version.c.table_name, data_version.c.version)
+            ).all()
+        else:
+            # SQLite before 3.35 has no RETURNING, updated rows are locked by transaction
+            connection.execute(statement)
+            increased = connection.execute(
+                select(data_version.c.table_name, data_version.c.version).
+                where(data_version.c.table_name.in_(tables))
+            ).all()
+
+        # Version before the first increase of transaction and the last one
+        for table_name, version in increased:
+            versions[table_name] = (versions.get(table_name, (version - 1,))[0], version)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def discard_increased_versions(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('increased_versions', None)
+
+
+def get_invoice_date(instance) -> Union[datetime.datetime, None]:
+    """
+    Returns date of invoice or invoice of item,
+    if instance is not an invoice or item returns None
+    :param instance: any model instance
+    :return:
+    """
+    if isinstance(instance, (SaleInvoice, IncomeInvoice)):
+        return instance.date
+
+    invoice = None
+
+    if isinstance(instance, SaleInvoiceItem):
+        invoice = instance.sale_invoice
+
+    elif isinstance(instance, IncomeInvoiceItem):
+        invoice = instance.income_invoice
+
+    return invoice.date if invoice is not None else None
+
+
+@event.listens_for(Session, 'after_flush')
+def invalidate_stock_snapshots(session, flush_context):
+    dates = [
+        date for date in map(get_invoice_date, itertools.chain(session.new, session.deleted))
+        if date is not None
+    ]
+
+    # Snapshots, which include changed invoices, are outdated now
+    if dates:
+        session.connection().execute(
+            StockSnapshot.__table__.
+            delete().
+            where(StockSnapshot.__table__.c.date >= min(dates))
+        )
+
+
+def init_db(reset: bool = False) -> None:
+    """
+    Creates missing tables and indexes and puts some initialization data
+    to empty database. Existing data is kept, unless `reset` is passed
+    :param reset: drop all tables before creating
+    :return:
+    """
+    if reset:
+        db.drop_all()
+
     db.create_all()
+
+    # Indexes, added to existing tables, aren't created by `create_all`
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+    if Product.query.first() is None:
+        db.session.add(Product(name='Wheel', cost_price=5000))
+        db.session.add(Product(name='Engine', cost_price=10000))
+
+    existing_versions = set(db.session.scalars(select(DataVersion.table_name)))
+    db.session.add_all(
+        DataVersion(table_name=table_name, version=0)
+        for table_name in db.metadata.tables
+        if table_name not in existing_versions
+    )
+
     db.session.commit()
-    db.session.add(Product(name='Wheel', cost_price=5000))
-    db.session.add(Product(name='Engine', cost_price=10000))
-    db.session.commit()
+    rebuild_row_counter()
+
+
+def rebuild_row_counter() -> None:
+    """
+    Counts rows of all models into in-memory row counter of process
+    :return:
+    """
+    row_counter.rebuild(mapper.class_ for mapper in db.Model.registry.mappers)
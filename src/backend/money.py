@@ -0,0 +1,159 @@
+import decimal
+import functools
+import json
+import re
+from typing import Union
+
+from flask_restful import fields
+
+
+# Count of formatted prices, which are kept for list rendering
+FORMAT_CACHE_SIZE = 65536
+
+PRICE_PATTERN = re.compile(r'([+-]?)(\d*)(?:\.(\d*))?')
+
+# Scaling of decimals must not round big amounts
+EXACT_CONTEXT = decimal.Context(prec=decimal.MAX_PREC)
+
+
+class Money:
+
+    """
+    Represents a money in integer format.
+
+    Prices are parsed and formatted exactly, without float:
+    digits after `decimals` are dropped, formatted price has
+    the same text as float division gave for usual amounts
+    """
+
+    __slots__ = ('value',)
+
+    sign = u"\u20B4"
+    decimals = 2
+
+    def __init__(self, price: Union[int, str]):
+
+        if isinstance(price, str):
+            self.value = self.from_string(price=price)
+
+        elif isinstance(price, int) and not isinstance(price, bool):
+            self.value = price
+
+        else:
+            raise ValueError(f'Bad money type for value - {repr(price)}')
+
+    @classmethod
+    def from_string(cls, price: str) -> int:
+        """
+        Takes a price as integer from string
+        :param price: price to take
+        :return:
+        """
+        text = price.replace(cls.sign, '').replace(' ', '')
+        match = PRICE_PATTERN.fullmatch(text)
+
+        # Exponent and other forms of decimal are parsed by `Decimal`
+        if match is None or not (match[2] or match[3]):
+            try:
+                return cls.from_decimal(decimal.Decimal(text))
+            except decimal.InvalidOperation:
+                raise ValueError(f'Bad money value - {repr(price)}') from None
+
+        sign, units, fraction = match.groups()
+        value = int(units + (fraction or '')[:cls.decimals].ljust(cls.decimals, '0'))
+        return -value if sign == '-' else value
+
+    @classmethod
+    def from_decimal(cls, price: decimal.Decimal) -> int:
+        """
+        Takes a price as integer from decimal amount
+        :param price: price to take
+        :return:
+        """
+        if not price.is_finite():
+            raise ValueError(f'Bad money value - {repr(price)}')
+
+        return int(price.scaleb(cls.decimals, EXACT_CONTEXT))
+
+    @classmethod
+    def from_json(cls, price: Union[int, float, str, decimal.Decimal]) -> int:
+        """
+        Takes a price as integer from amount in JSON:
+        number ( integer, decimal or float ) or string
+        :param price: price to take
+        :return:
+        """
+        if isinstance(price, bool):
+            raise ValueError(f'Bad money type for value - {repr(price)}')
+
+        if isinstance(price, int):
+            return price * 10 ** cls.decimals
+
+        if isinstance(price, decimal.Decimal):
+            return cls.from_decimal(price)
+
+        if isinstance(price, float):
+            # Shortest representation of float is the number, which was written in JSON
+            return cls.from_string(repr(price))
+
+        if isinstance(price, str):
+            return cls.from_string(price)
+
+        raise ValueError(f'Bad money type for value - {repr(price)}')
+
+    @classmethod
+    @functools.lru_cache(maxsize=FORMAT_CACHE_SIZE)
+    def format_price(cls, price: int) -> str:
+        """
+        Formats price related to sign and decimals.
+        Prices repeat in lists, so formatted ones are cached
+        :param price: price to format
+        :return:
+        """
+        units, fraction = divmod(abs(price), 10 ** cls.decimals)
+        fraction = f'{fraction:0{cls.decimals}d}'.rstrip('0') or '0'
+        return f'{"-" if price < 0 else ""}{units}.{fraction} {cls.sign}'
+
+    @classmethod
+    @functools.lru_cache(maxsize=FORMAT_CACHE_SIZE)
+    def encode_price(cls, price: int) -> str:
+        """
+        Formats price as JSON string
+        :param price: price to format
+        :return:
+        """
+        return json.dumps(cls.format_price(price))
+
+    @classmethod
+    def to_decimal(cls, price: int) -> decimal.Decimal:
+        """
+        Converts integer price to exact decimal amount
+        :param price: price to convert
+        :return:
+        """
+        return decimal.Decimal(price).scaleb(-cls.decimals)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Money):
+            return self.value == other.value
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash(self.value)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.value})'
+
+    def __str__(self):
+        return self.format_price(price=self.value)
+
+
+class MoneyField(fields.Raw):
+
+    """
+    Field for marshal_with decorator
+    ( easier serialization )
+    """
+
+    def format(self, value):
+        return Money.format_price(price=value)
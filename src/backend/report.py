@@ -1,14 +1,17 @@
 import datetime
 import enum
-import os
 import pathlib
+import threading
 from abc import ABC, abstractmethod
 from pathlib import Path
-from typing import List, Any, Union, Tuple
+import itertools
+from typing import List, Any, Union, Tuple, Dict, Iterator, Iterable
 import platform
 
+import fpdf.fpdf
 from fpdf import FPDF
-from sqlalchemy import func
+from sqlalchemy import func, select
+from sqlalchemy.orm import selectinload
 
 from .models import (
     SaleInvoice,
@@ -17,25 +20,130 @@ from .models import (
     SaleInvoiceItem,
     Product,
     Consignment,
-    db
+    db,
+    register_versioned_tables
 )
+from .ledger import stock_ledger
+from .stock import get_stock_on_date
 from .utils import Money
 
 
 if platform.system() == 'Linux':
     pathlib.WindowsPath = pathlib.PosixPath
 
+# Font is parsed once per process by `ReportRenderer`,
+# so fpdf must not write its font cache next to the font file
+fpdf.fpdf.FPDF_CACHE_MODE = 1
+
+
+REPORT_WINDOW = 500
+
+REPORTS_DIRECTORY = Path(__file__).parent / Path('static') / Path('reports')
+
+
+class ReportRenderer:
+    """
+    Writes strings to PDF files.
+
+    TrueType font is parsed once and shared by all documents,
+    only set of used characters is collected per document.
+    Renderer keeps no state of documents, so it can be used
+    from several threads at once
+    """
+
+    def __init__(self, font: Path, font_family: str, font_size: int):
+        """
+        :param font: path to TrueType font file
+        :param font_family: name of font in documents
+        :param font_size: size of text
+        """
+        self.font = font
+        self.font_family = font_family
+        self.font_size = font_size
+        self.fonts = None
+        self.font_files = None
+        self.lock = threading.Lock()
+
+    def load_font(self) -> Tuple[dict, dict]:
+        """
+        Returns fpdf font entries, font is parsed on first call
+        :return: fonts and font files of fpdf document
+        """
+        with self.lock:
+            if self.fonts is None:
+                pdf = FPDF()
+                pdf.add_font(self.font_family, '', str(self.font), uni=True)
+                self.fonts, self.font_files = pdf.fonts, pdf.font_files
+
+        return self.fonts, self.font_files
+
+    def create_document(self) -> FPDF:
+        """
+        Creates new document with loaded font
+        :return:
+        """
+        fonts, font_files = self.load_font()
+        pdf = FPDF()
+        # Character widths are shared, subset is filled by every document
+        pdf.fonts = {key: dict(font, subset=list(font['subset'])) for key, font in fonts.items()}
+        pdf.font_files = {key: dict(font_file) for key, font_file in font_files.items()}
+
+        pdf.add_page()
+        pdf.set_font(self.font_family, '', size=self.font_size)
+        return pdf
+
+    def render(self, strings: Iterable[str], path: Path) -> Path:
+        """
+        Writes strings to PDF file
+        :param strings: text of document
+        :param path: absolute path of PDF file
+        :return:
+        """
+        pdf = self.create_document()
+
+        for string in strings:
+            pdf.write(10, string)
+
+        pdf.output(str(path), 'F')
+        return path
+
+
+renderer = ReportRenderer(
+    font=Path(__file__).parent / Path('FreeSans.ttf'),
+    font_family='FreeSans',
+    font_size=15,
+)
+
 
 class Report(ABC):
     """
     Represents any report
     """
 
+    # Models, which data is used by report
+    __tables__ = ()
+    # Names of row fields, which `iterate_rows` returns
+    __columns__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Rendered reports are reused by versions of their tables
+        register_versioned_tables(cls.__tables__)
+
+    def __init__(self, filename: Union[str, None] = None):
+        """
+        :param filename: PDF filename to save,
+        `get_filename` is used by default
+        """
+        self.filename = filename
+
     @abstractmethod
-    def serialize(self, *args, **kwargs) -> List[str]:
+    def serialize(self, *args, **kwargs) -> Iterator[str]:
         """
         Serialize a report data to string format.
-        This function uses for get pdf data
+        This function uses for get pdf data,
+        strings are generated one by one, so report
+        data is never held in memory at once
         :return:
         """
 
@@ -46,6 +154,22 @@ class Report(ABC):
         :return:
         """
 
+    @abstractmethod
+    def get_formatters(self, *args, **kwargs) -> Iterator['Formatter']:
+        """
+        Returns formatters of report items one by one
+        :return:
+        """
+
+    def iterate_rows(self, *args, **kwargs) -> Iterator[dict]:
+        """
+        Returns report data as rows with `__columns__` fields,
+        used by table formats ( CSV, NDJSON, XLSX )
+        :return:
+        """
+        for formatter in self.get_formatters(*args, **kwargs):
+            yield from formatter.get_rows()
+
     def create(self, *args, **kwargs) -> str:
         """
         Creates report from input data in PDF format.
@@ -53,25 +177,28 @@ class Report(ABC):
         :return:
         """
 
-        pdf = FPDF()
-        root = Path(__file__).parent
-        font = root / Path('FreeSans.ttf')
-        reports = root / Path('static') / Path('reports')
-        filename = self.get_filename(*args, **kwargs)
+        filename = self.filename or self.get_filename(*args, **kwargs)
+        return renderer.render(self.serialize(*args, **kwargs), REPORTS_DIRECTORY / Path(filename))
 
-        pdf.add_page()
-        pdf.add_font('FreeSans', '', font, uni=True)
-        pdf.set_font('FreeSans', '', size=15)
 
-        for string in self.serialize(*args, **kwargs):
-            pdf.write(10, string)
-
-        prev_dir = os.getcwd()
-        os.chdir(reports)
-        pdf.output(filename)
-        os.chdir(prev_dir)
+def get_products_quantity_on_date(
+        date: datetime.datetime,
+        product_ids: Union[List[int], None] = None
+) -> Dict[int, int]:
+    """
+    Help function, which get quantity of products for certain date
+    with one grouped query: income minus sales per product,
+    starting from the nearest stock snapshot
+    :param date: date, by which will sum
+    :param product_ids: products to check, all products by default
+    :return: quantity by product id ( products without invoices are missed )
+    """
+    quantities = get_stock_on_date(date=date, product_ids=product_ids).items()
 
-        return reports / Path(filename)
+    return {
+        product_id: quantity if quantity > 0 else 0
+        for product_id, quantity in quantities
+    }
 
 
 def get_product_quantity_on_date(
@@ -84,18 +211,49 @@ def get_product_quantity_on_date(
     :param date: date, by which will sum
     :return:
     """
-    total_income = db.session.query(func.sum(IncomeInvoiceItem.quantity)). \
-        join(IncomeInvoiceItem.consignment). \
-        join(Consignment.product). \
-        filter(Product.id == product_id, IncomeInvoice.date <= date).scalar() or 0
+    return get_products_quantity_on_date(date=date, product_ids=[product_id]).get(product_id, 0)
 
-    total_sales = db.session.query(func.sum(SaleInvoiceItem.quantity)). \
-        join(SaleInvoiceItem.product). \
-        filter(Product.id == product_id, SaleInvoice.date <= date).scalar() or 0
 
-    current_quantity = total_income - total_sales
+def iterate_windows(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """
+    Help function, which splits items to lists of `size` items
+    :param items: items to split
+    :param size: size of window
+    :return:
+    """
+    items = iter(items)
+    window = list(itertools.islice(items, size))
+
+    while window:
+        yield window
+        window = list(itertools.islice(items, size))
+
+
+def iterate_by_id(query: Any, model: Any, size: int) -> Iterator[Any]:
+    """
+    Help function, which loads rows of query by windows of `size` rows
+    ordered by id, so eager loaders run once per window
+    and loaded rows are never held in memory at once
+    :param query: query of model
+    :param model: model with `id` column
+    :param size: size of window
+    :return:
+    """
+    last_id = None
 
-    return current_quantity if current_quantity > 0 else 0
+    while True:
+        window_query = query
+
+        if last_id is not None:
+            window_query = window_query.filter(model.id > last_id)
+
+        window = window_query.order_by(model.id).limit(size).all()
+        yield from window
+
+        if len(window) < size:
+            return
+
+        last_id = window[-1].id
 
 
 class Formatter(ABC):
@@ -114,6 +272,13 @@ class Formatter(ABC):
         :return:
         """
 
+    @abstractmethod
+    def get_rows(self) -> Iterator[dict]:
+        """
+        Returns data of formatted item as table rows
+        :return:
+        """
+
 
 class InvoiceFormatter(Formatter):
     item_to_format: Union[SaleInvoice, IncomeInvoice]
@@ -129,6 +294,15 @@ class InvoiceFormatter(Formatter):
                 f'Items: \n'
                 f'\n{items}')
 
+    def get_rows(self) -> Iterator[dict]:
+        for item in self.item_to_format.items:
+            for row in InvoiceItemFormatter(item).get_rows():
+                yield {
+                    'invoice_id': self.item_to_format.id,
+                    'date': self.item_to_format.date,
+                    **row
+                }
+
 
 class InvoiceItemFormatter(Formatter):
     item_to_format: Union[IncomeInvoiceItem, SaleInvoiceItem]
@@ -143,25 +317,50 @@ class InvoiceItemFormatter(Formatter):
                 f'---- Total price - {Money.format_price(self.item_to_format.total_price)}\n'
                 f'---- Quantity - {self.item_to_format.quantity}\n') + arrival_date
 
+    def get_rows(self) -> Iterator[dict]:
+        yield {
+            'product_id': self.item_to_format.product_id,
+            'product_name': self.item_to_format.product.name,
+            'quantity': self.item_to_format.quantity,
+            'total_price': Money.to_decimal(self.item_to_format.total_price),
+            'arrival_date': getattr(self.item_to_format, 'arrival_date', None),
+        }
+
 
 class ProductFormatter(Formatter):
     item_to_format: Product
 
-    def __init__(self, date: datetime.datetime, *args, **kwargs):
+    def __init__(self, date: datetime.datetime, *args, date_quantity: Union[int, None] = None, **kwargs):
         super().__init__(*args, **kwargs)
         self.date = date
+        self.date_quantity = date_quantity
+
+    def get_date_quantity(self) -> int:
+        if self.date_quantity is None:
+            self.date_quantity = get_product_quantity_on_date(
+                product_id=self.item_to_format.id,
+                date=self.date
+            )
+
+        return self.date_quantity
 
     def format(self) -> str:
         date = self.date.strftime('%Y/%m/%d %H:%M:%S')
-        date_quantity = get_product_quantity_on_date(
-            product_id=self.item_to_format.id,
-            date=self.date
-        )
+
         return (f'---- Product name - {self.item_to_format.name}\n'
                 f'---- Current quantity - {self.item_to_format.quantity}\n'
-                f'---- Quantity for date {date} - {date_quantity}\n'
+                f'---- Quantity for date {date} - {self.get_date_quantity()}\n'
                 f'---- Product price - {Money.format_price(self.item_to_format.cost_price)}\n')
 
+    def get_rows(self) -> Iterator[dict]:
+        yield {
+            'product_id': self.item_to_format.id,
+            'product_name': self.item_to_format.name,
+            'current_quantity': self.item_to_format.quantity,
+            'date_quantity': self.get_date_quantity(),
+            'cost_price': Money.to_decimal(self.item_to_format.cost_price),
+        }
+
 
 class ModelPeriodicalReport(Report, ABC):
     """
@@ -173,16 +372,22 @@ class ModelPeriodicalReport(Report, ABC):
     """
 
     __model__ = None
-
-    REPORT_INDEX = 1
+    __item_model__ = None
+    __columns__ = (
+        'invoice_id',
+        'date',
+        'product_id',
+        'product_name',
+        'quantity',
+        'total_price',
+        'arrival_date',
+    )
 
     def create(self, *args, **kwargs) -> str:
-        path = super().create(
+        return super().create(
             start_time=kwargs['start_time'],
             end_time=kwargs['end_time'],
         )
-        self.__class__.REPORT_INDEX += 1
-        return path
 
     @staticmethod
     def get_dates(
@@ -197,36 +402,65 @@ class ModelPeriodicalReport(Report, ABC):
 
     def get_filename(self, *args, **kwargs) -> str:
         start_time, end_time = self.get_dates(kwargs['start_time'], kwargs['end_time'])
-        start_part = f'{self.__model__.__name__}Report{self.REPORT_INDEX}'
+        start_part = f'{self.__model__.__name__}Report'
         filename = f"{start_part}_{start_time}_to_{end_time}.pdf"
         return filename
 
-    def serialize(self, *args, **kwargs) -> List[str]:
+    def serialize(self, *args, **kwargs) -> Iterator[str]:
         start_time = kwargs['start_time']
         end_time = kwargs['end_time']
-        sales = self.__model__.query \
-            .filter(self.__model__.date.between(start_time, end_time)) \
-            .all()
-        total_money = sum(sale.total_price for sale in sales)
+        period = self.__model__.date.between(start_time, end_time)
+        total_money = db.session.scalar(
+            select(func.coalesce(func.sum(self.__item_model__.total_price), 0)).
+            join(self.__model__).
+            where(period)
+        )
         start_date, end_date = self.get_dates(start_time, end_time)
-        formatted_sales = [InvoiceFormatter(sale).format() for sale in sales]
-        return [
-            f'Report{self.REPORT_INDEX}\n'
-            f'From period {start_date} to {end_date}\n'
-            f'Total money - {Money.format_price(total_money)}\n\n',
-            *formatted_sales
-        ]
+
+        yield ('Report\n'
+               f'From period {start_date} to {end_date}\n'
+               f'Total money - {Money.format_price(total_money)}\n\n')
+
+        for formatter in self.get_formatters(start_time=start_time, end_time=end_time):
+            yield formatter.format()
+
+    def get_formatters(self, *args, **kwargs) -> Iterator[Formatter]:
+        sales = self.__model__.query \
+            .options(selectinload(self.__model__.items).joinedload(self.__item_model__.product)) \
+            .filter(self.__model__.date.between(kwargs['start_time'], kwargs['end_time']))
+
+        for sale in iterate_by_id(sales, self.__model__, size=REPORT_WINDOW):
+            yield InvoiceFormatter(sale)
 
 
 class SaleReport(ModelPeriodicalReport):
     __model__ = SaleInvoice
+    __item_model__ = SaleInvoiceItem
+    __tables__ = (SaleInvoice, SaleInvoiceItem, Product)
 
 
 class IncomeReport(ModelPeriodicalReport):
     __model__ = IncomeInvoice
+    __item_model__ = IncomeInvoiceItem
+    __tables__ = (IncomeInvoice, IncomeInvoiceItem, Product)
 
 
 class RestOfProductReport(Report):
+    __tables__ = (
+        Product,
+        Consignment,
+        SaleInvoice,
+        SaleInvoiceItem,
+        IncomeInvoice,
+        IncomeInvoiceItem,
+    )
+    __columns__ = (
+        'product_id',
+        'product_name',
+        'current_quantity',
+        'date_quantity',
+        'cost_price',
+    )
 
     def create(self, *args, **kwargs) -> str:
         return super().create(date=kwargs['date'])
@@ -234,17 +468,39 @@ class RestOfProductReport(Report):
     def get_filename(self, *args, **kwargs) -> str:
         return f'ProductRestReport_{kwargs["date"].strftime("%y_%m_%d")}.pdf'
 
-    def serialize(self, *args, **kwargs) -> List[str]:
+    def serialize(self, *args, **kwargs) -> Iterator[str]:
         date = kwargs['date']
-        products = '\n'.join([
-            ProductFormatter(date=date, item_to_format=product).format()
-            for product in Product.query.all()
-        ])
-        return [
-            f'Report\n'
-            f'Until the date - {date.strftime("%y_%m_%d")}\n\n',
-            *products
-        ]
+
+        yield ('Report\n'
+               f'Until the date - {date.strftime("%y_%m_%d")}\n\n')
+
+        separator = ''
+
+        for formatter in self.get_formatters(date=date):
+            yield separator + formatter.format()
+            separator = '\n'
+
+    def get_formatters(self, *args, **kwargs) -> Iterator[Formatter]:
+        date = kwargs['date']
+        products = (Product.query if stock_ledger.enabled else Product.query_with_quantity()) \
+            .order_by(Product.id) \
+            .yield_per(REPORT_WINDOW)
+
+        for window in iterate_windows(products, size=REPORT_WINDOW):
+            if stock_ledger.enabled:
+                stock_ledger.set_quantities(window)
+
+            date_quantities = get_products_quantity_on_date(
+                date=date,
+                product_ids=[product.id for product in window]
+            )
+
+            for product in window:
+                yield ProductFormatter(
+                    date=date,
+                    item_to_format=product,
+                    date_quantity=date_quantities.get(product.id, 0)
+                )
 
 
 class ReportType(str, enum.Enum):
@@ -252,3 +508,10 @@ class ReportType(str, enum.Enum):
     SALE = 'sale'
     INCOME = 'income'
     PRODUCT = 'product'
+
+
+REPORT_CLASSES = {
+    ReportType.SALE: SaleReport,
+    ReportType.INCOME: IncomeReport,
+    ReportType.PRODUCT: RestOfProductReport,
+}
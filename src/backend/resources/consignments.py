@@ -1,9 +1,9 @@
-from typing import List
-
 from flask import Response, make_response
-from flask_restful import Resource, marshal_with_field, fields
+from flask_restful import fields
+from sqlalchemy.orm import Query
 from ..models import Consignment
-from ..utils import with_count, MoneyField
+from ..utils import with_count, MoneyField, list_query
+from .versioned import VersionedResource
 
 
 consignment_fields = {
@@ -18,12 +18,12 @@ consignment_fields = {
 }
 
 
-class ConsignmentsResource(Resource):
+class ConsignmentsResource(VersionedResource):
+    __tables__ = (Consignment,)
 
     def options(self) -> Response:
         return make_response()
 
-    @with_count(Consignment)
-    @marshal_with_field(fields.List(fields.Nested(consignment_fields)))
-    def get(self) -> List[Consignment]:
-        return Consignment.query.all()
+    @with_count(Consignment, consignment_fields)
+    def get(self) -> Query:
+        return list_query(Consignment)
@@ -0,0 +1,41 @@
+import io
+
+from flask import Response, make_response, request
+from flask_restful import Resource, inputs, reqparse
+
+from ..importer import InvoiceImporter, ImportFormat, IMPORT_BATCH_SIZE, IMPORT_MAX_ERRORS
+
+
+import_parser = reqparse.RequestParser()\
+.add_argument(
+    'format',
+    dest='file_format',
+    type=ImportFormat,
+    default=ImportFormat.NDJSON,
+    location='args'
+).add_argument(
+    'batch_size',
+    dest='batch_size',
+    type=inputs.positive,
+    default=IMPORT_BATCH_SIZE,
+    location='args'
+).add_argument(
+    'max_errors',
+    dest='max_errors',
+    type=inputs.positive,
+    default=IMPORT_MAX_ERRORS,
+    location='args'
+)
+
+
+class ImportResource(Resource):
+
+    def options(self) -> Response:
+        return make_response()
+
+    def post(self) -> dict:
+        arguments = import_parser.parse_args()
+        # Request body is read line by line, never as a whole
+        file = io.TextIOWrapper(request.stream, encoding='utf-8')
+        importer = InvoiceImporter(batch_size=arguments.batch_size, max_errors=arguments.max_errors)
+        return importer.import_file(file, arguments.file_format)
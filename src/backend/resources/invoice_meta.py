@@ -10,23 +10,34 @@ from flask import (
     request
 )
 from flask_restful import (
-    Resource,
+    abort,
     fields,
     marshal_with,
     marshal_with_field
 )
+from sqlalchemy.orm import Query, selectinload
 
 from ..controller import BusinessController, InvoiceType
 from ..models import db
-from ..utils import with_count
+from ..utils import with_count, list_query, timed_marshal
+from .versioned import VersionedResource
 
 
 class InvoiceMeta:
     __model__ = None
     __invoice_type__ = None
 
+    @classmethod
+    def get_query(cls) -> Query:
+        """
+        Returns a model query, which loads items
+        of all selected invoices with one additional query
+        :return:
+        """
+        return cls.__model__.query.options(selectinload(cls.__model__.items))
 
-class ListInvoiceResourceMeta(Resource, InvoiceMeta):
+
+class ListInvoiceResourceMeta(VersionedResource, InvoiceMeta):
     """
     Represents a list of model.
     Can add new items to model
@@ -35,34 +46,40 @@ class ListInvoiceResourceMeta(Resource, InvoiceMeta):
     def options(self) -> Response:
         return make_response()
 
-    def get(self):
-        return self.__model__.query.all()
+    def get(self) -> Query:
+        return list_query(self.__model__, self.get_query())
 
     def post(self) -> str:
-        BusinessController.create_invoice(
-            invoice_type=self.__invoice_type__,
-            creation_date=BusinessController.parse_time(request.json['date']),
-            invoice_items=list(map(BusinessController.create_item_from_json, request.json['items']))
-        )
+        # Items are created again by every attempt, objects of failed one are gone with its rollback
+        try:
+            BusinessController.run_in_transaction(lambda: BusinessController.create_invoice(
+                invoice_type=self.__invoice_type__,
+                creation_date=BusinessController.parse_time(request.json['date']),
+                invoice_items=BusinessController.create_items_from_json(request.json['items']),
+                commit=False
+            ))
+        except ValueError as error:
+            abort(400, message=str(error))
+
         return 'OK'
 
 
-class SingleInvoiceResourceMeta(Resource, InvoiceMeta):
+class SingleInvoiceResourceMeta(VersionedResource, InvoiceMeta):
     """
     Represents a resource, which will send only 1 item by id
     and manages model changes
     """
 
     def get(self, invoice_id: int):
-        return self.__model__.query.get(invoice_id)
+        return self.get_query().filter(self.__model__.id == invoice_id).first()
 
     def options(self, invoice_id: int) -> Response:
         return make_response()
 
     def delete(self, invoice_id: int) -> int:
-        product = self.__model__.query.get(invoice_id)
-        db.session.delete(product)
-        db.session.commit()
+        BusinessController.run_in_transaction(
+            lambda: db.session.delete(self.__model__.query.get(invoice_id))
+        )
         return invoice_id
 
 
@@ -79,8 +96,8 @@ def use_marshal(
     :return:
     """
     if with_field:
-        return marshal_with_field(field)(function)
-    return marshal_with(field)(function)
+        return timed_marshal(marshal_with_field(field))(function)
+    return timed_marshal(marshal_with(field))(function)
 
 
 def create_invoice_resource(
@@ -100,6 +117,7 @@ def create_invoice_resource(
     vars_dict = {
         "__invoice_type__": invoice_type,
         "__model__": invoice_model,
+        "__tables__": (invoice_model, invoice_model.items.property.mapper.class_),
     }
 
     list_resource = type(
@@ -113,13 +131,7 @@ def create_invoice_resource(
         vars_dict,
     )
 
-    list_resource.get = with_count(invoice_model)(
-        use_marshal(
-            field=fields.List(fields.Nested(model_fields)),
-            function=list_resource.get,
-            with_field=True
-        )
-    )
+    list_resource.get = with_count(invoice_model, model_fields)(list_resource.get)
     list_resource.post = use_marshal(field=model_fields, function=list_resource.post)
 
     single_resource.get = use_marshal(field=model_fields, function=single_resource.get)
@@ -0,0 +1,14 @@
+from flask import Response
+from flask_restful import Resource
+
+from ..metrics import request_metrics
+
+
+class MetricsResource(Resource):
+
+    def get(self) -> Response:
+        """
+        Returns request metrics in Prometheus text format
+        :return:
+        """
+        return Response(request_metrics.export(), mimetype='text/plain; version=0.0.4')
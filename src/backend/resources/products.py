@@ -1,9 +1,10 @@
-from typing import List
-
 from flask import Response, make_response, request
-from flask_restful import Resource, marshal_with_field, fields, marshal_with
-from ..models import Product, db
-from ..utils import MoneyField, with_count, Money
+from flask_restful import fields, marshal_with
+from sqlalchemy.orm import Query
+from ..ledger import stock_ledger
+from ..models import Consignment, Product, db
+from ..utils import MoneyField, with_count, Money, list_query, timed_marshal
+from .versioned import VersionedResource
 
 
 product_fields = {
@@ -21,7 +22,7 @@ def get_product_json() -> dict:
     """
 
     product_in_json = request.json
-    product_in_json['cost_price'] = Money.from_string(str(float(product_in_json['cost_price'])))
+    product_in_json['cost_price'] = Money.from_json(product_in_json['cost_price'])
 
     for key in ['quantity', 'id']:
         if key in product_in_json:
@@ -30,7 +31,8 @@ def get_product_json() -> dict:
     return product_in_json
 
 
-class ProductsResource(Resource):
+class ProductsResource(VersionedResource):
+    __tables__ = (Product, Consignment)
 
     def options(self) -> Response:
         """
@@ -39,12 +41,15 @@ class ProductsResource(Resource):
         """
         return make_response()
 
-    @with_count(Product)
-    @marshal_with_field(fields.List(fields.Nested(product_fields)))
-    def get(self) -> List[Product]:
-        return Product.query.all()
+    @with_count(
+        Product,
+        product_fields,
+        computed={'quantity': stock_ledger.get_quantities} if stock_ledger.enabled else None
+    )
+    def get(self) -> Query:
+        return list_query(Product, Product.query_with_quantity())
 
-    @marshal_with(product_fields)
+    @timed_marshal(marshal_with(product_fields))
     def post(self) -> Product:
         product_in_json = get_product_json()
         product = Product(**product_in_json)
@@ -53,16 +58,25 @@ class ProductsResource(Resource):
         return product
 
 
-class ProductSingleResource(Resource):
+class ProductSingleResource(VersionedResource):
+    __tables__ = (Product, Consignment)
 
     def options(self, **_) -> Response:
         return make_response()
 
-    @marshal_with(product_fields)
+    @timed_marshal(marshal_with(product_fields))
     def get(self, product_id: int) -> Product:
-        return Product.query.filter(Product.id == product_id).first()
+        if not stock_ledger.enabled:
+            return Product.query_with_quantity().filter(Product.id == product_id).first()
+
+        product = Product.query.filter(Product.id == product_id).first()
+
+        if product is not None:
+            stock_ledger.set_quantities([product])
+
+        return product
 
-    @marshal_with(product_fields)
+    @timed_marshal(marshal_with(product_fields))
     def put(self, product_id: int) -> Product:
         product_in_json = get_product_json()
         product = Product.query\
@@ -1,14 +1,12 @@
-import os.path
+from pathlib import Path
 
-from flask import url_for
-from flask_restful import Resource, reqparse
+from flask import Response, stream_with_context, url_for
+from flask_restful import Resource, reqparse, abort
 from ..controller import BusinessController
-from ..report import (
-    ReportType,
-    RestOfProductReport,
-    IncomeReport,
-    SaleReport,
-)
+from .. import jobs
+from ..exports import ExportFormat, SERIALIZERS
+from ..models import ReportJob, db
+from ..report import ReportType, REPORT_CLASSES
 
 report_type_parser = reqparse.RequestParser()\
 .add_argument(
@@ -18,6 +16,15 @@ report_type_parser = reqparse.RequestParser()\
 
 )
 
+export_parser = reqparse.RequestParser()\
+.add_argument(
+    'format',
+    dest='export_format',
+    type=ExportFormat,
+    default=ExportFormat.PDF,
+    location='args'
+)
+
 period_report_parser = reqparse.RequestParser()\
 .add_argument(
     'start_time',
@@ -40,18 +47,66 @@ products_rest_parser = reqparse.RequestParser()\
 )
 
 
+def get_job_json(job: ReportJob) -> dict:
+    """
+    Help function, which converts job to response
+    :param job: job to convert
+    :return:
+    """
+    url = None
+
+    if job.status == jobs.JobStatus.DONE:
+        url = url_for('static', filename=f'reports/{job.filename}')
+
+    return {'id': job.id, 'status': job.status, 'url': url, 'error': job.error}
+
+
+def stream_report(report_type: ReportType, arguments: dict, export_format: ExportFormat) -> Response:
+    """
+    Help function, which streams report rows in table format,
+    file is sent while rows are read from database
+    :param report_type: type of report
+    :param arguments: arguments of report creation
+    :param export_format: format of file
+    :return:
+    """
+    report = REPORT_CLASSES[report_type]()
+    serializer = SERIALIZERS[export_format]
+    filename = f'{Path(report.get_filename(**arguments)).stem}.{serializer.__extension__}'
+    chunks = serializer.serialize(report.__columns__, report.iterate_rows(**arguments))
+
+    return Response(
+        stream_with_context(chunks),
+        mimetype=serializer.__mimetype__,
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+
 class ReportResource(Resource):
 
-    def post(self) -> str:
+    def post(self) -> dict:
         report_type = report_type_parser.parse_args().report_type
+        export_format = export_parser.parse_args().export_format
 
         if report_type in [ReportType.INCOME, ReportType.SALE]:
-            report_class = SaleReport if report_type == ReportType.SALE else IncomeReport
             arguments = period_report_parser.parse_args()
-            path = report_class().create(**arguments)
 
         else:
             arguments = products_rest_parser.parse_args()
-            path = RestOfProductReport().create(**arguments)
 
-        return {'url': url_for('static', filename=f'reports/{os.path.basename(path)}')}
+        if export_format != ExportFormat.PDF:
+            return stream_report(report_type, dict(arguments), export_format)
+
+        job = jobs.report_jobs.submit(report_type=report_type, arguments=dict(arguments))
+        return get_job_json(job), 202
+
+
+class ReportJobResource(Resource):
+
+    def get(self, job_id: str) -> dict:
+        job = db.session.get(ReportJob, job_id)
+
+        if job is None:
+            abort(404, message=f'Unknown report job - {job_id}')
+
+        return get_job_json(jobs.report_jobs.check(job))
@@ -0,0 +1,74 @@
+from flask import Response, request
+from flask_restful import Resource, unpack
+
+from ..app import api
+from ..cache import data_versions, get_response_key, response_cache
+from ..models import register_versioned_tables
+from ..utils import add_total_count
+
+
+class VersionedResource(Resource):
+    """
+    Resource, which GET responses are versioned by data versions
+    of `__tables__`. Response has ETag of request and versions,
+    request with matching `If-None-Match` is answered with 304
+    without touching data, repeated requests are served
+    from in-memory response cache
+    """
+
+    __tables__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        register_versioned_tables(cls.__tables__)
+
+    def dispatch_request(self, *args, **kwargs) -> Response:
+        if request.method != 'GET' or not self.__tables__:
+            return super().dispatch_request(*args, **kwargs)
+
+        versions = data_versions.get(model.__tablename__ for model in self.__tables__)
+
+        # Tables without versions aren't created by `init-db` yet
+        if None in versions.values():
+            return super().dispatch_request(*args, **kwargs)
+
+        etag = get_response_key(request.path, request.args.items(multi=True), versions)
+
+        # Row count isn't versioned, so it is taken again for every response
+        count_model = getattr(getattr(self, 'get', None), '__count_model__', None)
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304, headers={'Cache-Control': 'no-cache'})
+            response.set_etag(etag)
+
+            if count_model is not None:
+                add_total_count(response, count_model)
+
+            return response
+
+        cached = response_cache.get(etag)
+
+        if cached is not None:
+            data, status, headers = cached
+            response = Response(data, status=status, headers=headers)
+
+            if count_model is not None:
+                add_total_count(response, count_model)
+
+            return response
+
+        response = super().dispatch_request(*args, **kwargs)
+
+        # Marshalled data is made a response here, so its body can be cached
+        if not isinstance(response, Response):
+            data, code, headers = unpack(response)
+            response = api.make_response(data, code, headers=headers)
+
+        if response.status_code == 200 and not response.is_streamed:
+            # Browsers keep response, but revalidate it by every request
+            response.headers['Cache-Control'] = 'no-cache'
+            response.set_etag(etag)
+            headers = [(name, value) for name, value in response.headers.items() if name != 'X-Total-Count']
+            response_cache.set(etag, (response.get_data(), response.status_code, headers))
+
+        return response
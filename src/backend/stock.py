@@ -0,0 +1,135 @@
+import datetime
+import enum
+from typing import Dict, List, Union
+
+import click
+from sqlalchemy import func, insert, select, union_all
+
+from .app import app
+from .models import (
+    IncomeInvoice,
+    IncomeInvoiceItem,
+    SaleInvoice,
+    SaleInvoiceItem,
+    StockSnapshot,
+    db,
+)
+
+
+class SnapshotPeriod(str, enum.Enum):
+    DAY = 'day'
+    MONTH = 'month'
+
+
+def get_next_boundary(date: datetime.datetime, period: SnapshotPeriod) -> datetime.datetime:
+    """
+    Returns start of next period after date
+    :param date: date inside of period
+    :param period: length of period
+    :return:
+    """
+    day = datetime.datetime(date.year, date.month, date.day)
+
+    if period == SnapshotPeriod.DAY:
+        return day + datetime.timedelta(days=1)
+
+    return datetime.datetime(date.year + date.month // 12, date.month % 12 + 1, 1)
+
+
+def get_stock_on_date(
+        date: datetime.datetime,
+        product_ids: Union[List[int], None] = None
+) -> Dict[int, int]:
+    """
+    Returns stock ( income minus sales ) of products for certain date.
+    Nearest snapshot before date is used as start,
+    so only invoices after it are summed
+    :param date: date, by which will sum
+    :param product_ids: products to check, all products by default
+    :return: stock by product id ( products without invoices are missed )
+    """
+    snapshot_date = db.session.scalar(
+        select(func.max(StockSnapshot.date)).where(StockSnapshot.date <= date)
+    )
+
+    income = select(IncomeInvoiceItem.product_id, IncomeInvoiceItem.quantity.label('quantity')). \
+        join(IncomeInvoice, IncomeInvoiceItem.invoice_id == IncomeInvoice.id). \
+        where(IncomeInvoice.date <= date)
+
+    sales = select(SaleInvoiceItem.product_id, (-SaleInvoiceItem.quantity).label('quantity')). \
+        join(SaleInvoice, SaleInvoiceItem.sale_id == SaleInvoice.id). \
+        where(SaleInvoice.date <= date)
+
+    snapshot = None
+
+    if snapshot_date is not None:
+        income = income.where(IncomeInvoice.date > snapshot_date)
+        sales = sales.where(SaleInvoice.date > snapshot_date)
+        snapshot = select(StockSnapshot.product_id, StockSnapshot.quantity). \
+            where(StockSnapshot.date == snapshot_date)
+
+    if product_ids is not None:
+        income = income.where(IncomeInvoiceItem.product_id.in_(product_ids))
+        sales = sales.where(SaleInvoiceItem.product_id.in_(product_ids))
+
+        if snapshot is not None:
+            snapshot = snapshot.where(StockSnapshot.product_id.in_(product_ids))
+
+    movements = union_all(*filter(lambda part: part is not None, [snapshot, income, sales])).subquery()
+
+    return dict(db.session.execute(
+        select(movements.c.product_id, func.sum(movements.c.quantity)).
+        group_by(movements.c.product_id)
+    ).all())
+
+
+def take_stock_snapshots(until: datetime.datetime, period: SnapshotPeriod) -> int:
+    """
+    Takes snapshots of stock at every period boundary after last snapshot
+    ( or first invoice ) until passed date
+    :param until: last date, which can be a boundary
+    :param period: length of period between snapshots
+    :return: count of taken snapshots
+    """
+    last_date = db.session.scalar(select(func.max(StockSnapshot.date)))
+
+    if last_date is None:
+        invoice_dates = [
+            db.session.scalar(select(func.min(IncomeInvoice.date))),
+            db.session.scalar(select(func.min(SaleInvoice.date))),
+        ]
+        invoice_dates = [date for date in invoice_dates if date is not None]
+
+        if not invoice_dates:
+            return 0
+
+        last_date = min(invoice_dates)
+
+    boundary = get_next_boundary(last_date, period)
+    taken = 0
+
+    while boundary <= until:
+        stock = get_stock_on_date(boundary)
+
+        if stock:
+            db.session.execute(insert(StockSnapshot), [
+                {'date': boundary, 'product_id': product_id, 'quantity': quantity}
+                for product_id, quantity in stock.items()
+            ])
+            taken += 1
+
+        boundary = get_next_boundary(boundary, period)
+
+    db.session.commit()
+    return taken
+
+
+@app.cli.command('snapshot-stock')
+@click.option('--period', type=click.Choice([item.value for item in SnapshotPeriod]), default='month')
+@click.option('--until', type=click.DateTime(), default=None, help='Last boundary date, now by default')
+def snapshot_stock_command(period: str, until: Union[datetime.datetime, None]) -> None:
+    """
+    Takes missing stock snapshots, run it periodically ( e.g. from cron )
+    """
+    taken = take_stock_snapshots(until=until or datetime.datetime.now(), period=SnapshotPeriod(period))
+    click.echo(f'Taken {taken} snapshots')
@@ -1,83 +1,311 @@
+import datetime
 import functools
-from typing import Union, Callable
-import json
+from typing import Callable, Any, Dict, List, Tuple, Union
 
-from flask_restful import fields
-from flask import Response, make_response
+from flask_restful import abort
+from flask import Response, make_response, request
+from sqlalchemy import inspect, Column
+from sqlalchemy.ext.hybrid import HybridExtensionType
+from sqlalchemy.orm import Query
+from sqlalchemy.sql import ColumnElement
 
+from .counter import row_counter
+from .encoders import RowEncoder
+from .metrics import request_metrics
+from .money import Money, MoneyField
 
-class Money:
 
+def with_count(
+        count_model: object,
+        model_fields: dict,
+        computed: Dict[str, Callable[[List[int]], Dict[int, Any]]] = None
+) -> Callable:
     """
-    Represents a money in integer format
+    Create Response and add to him additional count header.
+    Route returns a query of listed rows, they are encoded to the same JSON
+    as `marshal_with_field(fields.List(fields.Nested(model_fields)))` makes,
+    but by compiled `RowEncoder`. If all fields are columns, only their
+    values are selected, without building model objects
+
+    :param count_model: from which model count will be taken
+    :param model_fields: fields of listed rows
+    :param computed: columns, which values are taken by ids of selected rows
+    from memory instead of database ( only when values are selected )
+    :return:
     """
+    encoder = RowEncoder(model_fields)
+    computed = computed or {}
 
-    sign = u"\u20B4"
-    decimals = 2
+    def wrapper(fn) -> Callable:
+        @functools.wraps(fn)
+        def argument_wrapper(*args, **kwargs) -> Response:
+            response = make_response()
+            add_total_count(response, count_model)
 
-    def __init__(self, price: Union[int, str]):
+            with request_metrics.timer('handler'):
+                query = fn(*args, **kwargs)
 
-        if isinstance(price, str):
-            self.value = self.from_string(price=price)
+                if encoder.columns is None:
+                    rows = query.all()
+                else:
+                    # Id of row is selected in place of computed column
+                    rows = query.with_entities(*[
+                        count_model.id if column in computed else getattr(count_model, column)
+                        for column in encoder.columns
+                    ]).all()
 
-        elif isinstance(price, int):
-            self.value = price
+                    if computed:
+                        rows = fill_computed_columns(rows, encoder.columns, computed)
 
-        else:
-            raise ValueError(f'Bad money type for value - {repr(price)}')
+            with request_metrics.timer('serialize'):
+                response.data = encoder.dumps(rows, by_position=encoder.columns is not None)
 
-    @classmethod
-    def from_string(cls, price: str) -> int:
-        """
-        Takes a price as integer from string
-        :param price: price to take
-        :return:
-        """
-        prefix, suffix = price.replace(cls.sign, '').replace(' ', '').split('.')
-        extra_zeros = ''.join('0' for _ in range(cls.decimals - len(suffix)))
-        suffix = suffix + extra_zeros if len(suffix) < cls.decimals else suffix
-        return int(prefix) * (10 ** cls.decimals) + int(suffix[:cls.decimals])
+            return response
+        # Cached responses are stored without count, it is added again by every hit
+        argument_wrapper.__count_model__ = count_model
+        return argument_wrapper
+    return wrapper
 
-    @classmethod
-    def format_price(cls, price: int) -> str:
-        """
-        Formats price related to sign and decimals
-        :param price: price to format
-        :return:
-        """
-        return f'{price / (10 ** cls.decimals):0{cls.decimals}} {cls.sign}'
 
-    def __str__(self):
-        return self.format_price(price=self.value)
+def add_total_count(response: Response, count_model: object) -> None:
+    """
+    Sets `X-Total-Count` header of list response to count
+    of model rows, which match filters of request
+    :param response: response of list resource
+    :param count_model: counted model
+    :return:
+    """
+    with request_metrics.timer('count'):
+        total_count = row_counter.count(
+            model=count_model,
+            key=get_filter_key(count_model),
+            counter=lambda: filter_query(count_model.query, count_model).count()
+        )
 
+    response.headers.update({
+        'Access-Control-Expose-Headers': 'X-Total-Count',
+        'X-Total-Count': total_count,
+    })
 
-class MoneyField(fields.Raw, Money):
 
+def fill_computed_columns(
+        rows: List[tuple],
+        columns: Tuple[str, ...],
+        computed: Dict[str, Callable[[List[int]], Dict[int, Any]]]
+) -> List[tuple]:
     """
-    Field for marshal_with decorator
-    ( easier serialization )
+    Replaces ids in computed columns of rows with their values
+    :param rows: selected values of columns
+    :param columns: names of columns
+    :param computed: functions, which return values of column by ids
+    :return:
     """
+    values = [
+        (index, computed[column]([row[index] for row in rows]))
+        for index, column in enumerate(columns)
+        if column in computed
+    ]
+    filled = []
+
+    for row in rows:
+        row = list(row)
+
+        for index, column_values in values:
+            row[index] = column_values[row[index]]
 
-    def format(self, value):
-        return self.format_price(price=value)
+        filled.append(tuple(row))
 
+    return filled
 
-def with_count(count_model: object) -> Callable:
+
+def timed_marshal(marshaller: Callable) -> Callable:
     """
-    Create Response and add to him additional count header
+    Wraps `marshal_with` or `marshal_with_field` decorator,
+    so time of handler and time of serialization are measured separately
 
-    :param count_model: from which model count will be taken
+    :param marshaller: decorator, which marshals result of route
     :return:
     """
     def wrapper(fn) -> Callable:
-        @functools.wraps(fn)
-        def argument_wrapper(*args, **kwargs) -> Response:
-            response = make_response()
-            response.headers.update({
-                'Access-Control-Expose-Headers': 'X-Total-Count',
-                'X-Total-Count': count_model.query.count()
-            })
-            response.data = json.dumps(fn(*args, **kwargs))
-            return response
-        return argument_wrapper
+        return request_metrics.timed('serialize')(marshaller(request_metrics.timed('handler')(fn)))
     return wrapper
+
+
+RANGE_SUFFIXES = {
+    '_gte': lambda column, value: column >= value,
+    '_lte': lambda column, value: column <= value,
+}
+
+
+def parse_column_value(column: Column, value: str) -> Any:
+    """
+    Converts request argument to python type of column
+    :param column: column, which will be filtered
+    :param value: raw value from query string
+    :return:
+    """
+    python_type = column.type.python_type
+
+    if python_type is bool:
+        return value.lower() in ('true', '1')
+
+    if python_type is datetime.datetime:
+        return datetime.datetime.fromisoformat(value.rstrip('Z'))
+
+    return python_type(value)
+
+
+def get_filter_column(argument: str, columns: Any) -> Tuple[Union[str, None], Union[str, None]]:
+    """
+    Gives name of filtered column and range suffix of request argument
+    :param argument: name of request argument
+    :param columns: columns of filtered model
+    :return: column name and suffix ( None for equality ),
+    None instead of name if argument isn't a filter
+    """
+    if argument.startswith('_'):
+        return None, None
+
+    for range_suffix in RANGE_SUFFIXES:
+        if argument.endswith(range_suffix) and argument[:-len(range_suffix)] in columns:
+            return argument[:-len(range_suffix)], range_suffix
+
+    if argument in columns:
+        return argument, None
+
+    return None, None
+
+
+def get_filter_key(model: object) -> tuple:
+    """
+    Returns hashable key of filters in request arguments.
+    Only arguments, which filter by model columns, are a part of key
+    :param model: filtered model
+    :return:
+    """
+    columns = inspect(model).columns
+    return tuple(sorted(
+        (argument, tuple(request.args.getlist(argument)))
+        for argument in request.args
+        if get_filter_column(argument, columns)[0] is not None
+    ))
+
+
+def filter_query(query: Query, model: object) -> Query:
+    """
+    Applies filters from request arguments to query.
+    `field=value` filters by equality ( repeated field - by any of values ),
+    `field_gte=value` and `field_lte=value` filters by range.
+    Arguments, which are not model columns are ignored
+    :param query: query to filter
+    :param model: model, which columns are used for filtering
+    :return:
+    """
+    columns = inspect(model).columns
+
+    for argument in request.args:
+        name, suffix = get_filter_column(argument, columns)
+
+        if name is None:
+            continue
+
+        column = getattr(model, name)
+
+        try:
+            values = [parse_column_value(columns[name], value) for value in request.args.getlist(argument)]
+        except ValueError:
+            abort(400, message=f'Bad value for filter - {argument}')
+
+        if suffix is not None:
+            for value in values:
+                query = query.filter(RANGE_SUFFIXES[suffix](column, value))
+
+        elif len(values) == 1:
+            query = query.filter(column == values[0])
+
+        else:
+            query = query.filter(column.in_(values))
+
+    return query
+
+
+def get_sort_attribute(model: object, field: str) -> Any:
+    """
+    Gives model attribute, which query can be sorted by:
+    column or hybrid property with SQL expression.
+    Relationships and other attributes give None
+    :param model: sorted model
+    :param field: name of attribute
+    :return:
+    """
+    mapper = inspect(model)
+
+    if field in mapper.column_attrs:
+        return getattr(model, field)
+
+    descriptor = mapper.all_orm_descriptors.get(field)
+    if descriptor is None or descriptor.extension_type is not HybridExtensionType.HYBRID_PROPERTY:
+        return None
+
+    # Hybrid without expression runs Python getter on class
+    try:
+        attribute = getattr(model, field)
+        clause = attribute.__clause_element__()
+    except Exception:
+        return None
+
+    return attribute if isinstance(clause, ColumnElement) else None
+
+
+def paginate_query(query: Query, model: object) -> Query:
+    """
+    Applies `_sort`, `_order`, `_start` and `_end`
+    request arguments to query. Sorting by id is used as default
+    and as tiebreaker to keep pages stable
+    :param query: query to paginate
+    :param model: model, which attributes are used for sorting
+    :return:
+    """
+    order = request.args.get('_order', 'ASC').upper()
+    sort_fields = [field for field in request.args.get('_sort', '').split(',') if field]
+    ordering = []
+
+    for field in sort_fields:
+        attribute = get_sort_attribute(model, field)
+        if attribute is None:
+            abort(400, message=f'Unknown sort field - {field}')
+        if field != 'id':
+            ordering.append(attribute)
+
+    ordering.append(model.id)
+    query = query.order_by(*[
+        attribute.desc() if order == 'DESC' else attribute.asc()
+        for attribute in ordering
+    ])
+
+    try:
+        start = int(request.args.get('_start', 0))
+        end = request.args.get('_end', None)
+        end = None if end is None else int(end)
+    except ValueError:
+        abort(400, message='Bad pagination range')
+
+    if start:
+        query = query.offset(start)
+
+    if end is not None:
+        query = query.limit(max(end - start, 0))
+
+    return query
+
+
+def list_query(model: object, query: Query = None) -> Query:
+    """
+    Returns a filtered, sorted and paginated query
+    for list resources
+    :param model: listed model
+    :param query: base query, `model.query` by default
+    :return:
+    """
+    query = model.query if query is None else query
+    return paginate_query(filter_query(query, model), model)
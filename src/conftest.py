@@ -0,0 +1,9 @@
+import os
+import tempfile
+from pathlib import Path
+
+
+# Application reads its database from environment on import,
+# so tests point it to own file before `backend.app` is loaded
+os.environ['SQLALCHEMY_DATABASE_URI'] = \
+    f"sqlite:///{(Path(tempfile.mkdtemp()) / 'test.sqlite').as_posix()}"
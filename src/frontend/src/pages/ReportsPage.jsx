@@ -16,6 +16,40 @@ import {apiUrl} from "../dataProvider";
 import dayjs from "dayjs";
 
 
+const REPORT_POLL_INTERVAL = 1000
+
+// Report, which isn't rendered in 10 minutes, isn't waited anymore
+const REPORT_POLL_ATTEMPTS = 600
+
+
+const waitReport = (job, attempt = 0) => {
+    if (job.status === 'done') {
+        return job
+    }
+
+    if (job.status === 'failed') {
+        throw new Error(job.error)
+    }
+
+    if (attempt >= REPORT_POLL_ATTEMPTS) {
+        throw new Error('Report is not rendered in time')
+    }
+
+    return new Promise(resolve => setTimeout(resolve, REPORT_POLL_INTERVAL)).then(
+        () => fetch(apiUrl + '/report/' + job.id)
+    ).then(
+        res => {
+            if (!res.ok) {
+                throw new Error(`Report job request failed with ${res.status}`)
+            }
+            return res.json()
+        }
+    ).then(
+        nextJob => waitReport(nextJob, attempt + 1)
+    )
+}
+
+
 const ReportForm = () => {
     const [loading, setLoading] = useState(false)
     const [reportType, setReportType] = useState('product')
@@ -43,11 +77,18 @@ const ReportForm = () => {
                 }
             }
         ).then(
-            res => res.json()
+            res => {
+                if (!res.ok) {
+                    throw new Error('Fields missing')
+                }
+                return res.json()
+            }
+        ).then(
+            job => waitReport(job)
         ).then(
-            data => window.open(apiUrl + data.url, '_blank').focus()
+            job => window.open(apiUrl + job.url, '_blank').focus()
         ).catch(e => {
-            notify(`Error: cant't create report. Fields missing`, {type: 'error'})
+            notify(`Error: cant't create report. ${e.message}`, {type: 'error'})
         }).finally(() => {
             setLoading(false)
         })
@@ -0,0 +1,34 @@
+import multiprocessing
+import os
+
+
+bind = os.environ.get('BIND', '0.0.0.0:80')
+# Every worker starts own pool of REPORT_WORKERS processes for PDF reports,
+# all of them render at most REPORT_RENDER_SLOTS reports at once
+workers = int(os.environ.get('WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('THREADS', 4))
+worker_class = 'gthread'
+timeout = int(os.environ.get('WORKER_TIMEOUT', 120))
+max_requests = int(os.environ.get('MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.environ.get('MAX_REQUESTS_JITTER', 1000))
+accesslog = '-'
+
+# Application is imported once in master process, workers are forked from it
+preload_app = True
+
+
+def post_fork(server, worker):
+    from backend.app import app
+    from backend.ledger import stock_ledger
+    from backend.models import db, rebuild_row_counter
+
+    # Connections, opened in master, mustn't be shared between workers
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+        # Counts of `init-db` process don't reach workers
+        rebuild_row_counter()
+
+        # Every worker keeps own stock ledger
+        if stock_ledger.enabled:
+            stock_ledger.load()
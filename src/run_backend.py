@@ -1,3 +1,16 @@
+import os
+
 from backend.app import app
+from backend.ledger import stock_ledger
+from backend.models import init_db
+
+
+if __name__ == '__main__':
+
+    with app.app_context():
+        init_db()
+
+        if stock_ledger.enabled:
+            stock_ledger.load()
 
-app.run('0.0.0.0', 80)
+    app.run(os.environ.get('HOST', '0.0.0.0'), int(os.environ.get('PORT', 80)))
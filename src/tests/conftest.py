@@ -0,0 +1,17 @@
+import pytest
+
+from backend.app import app as flask_app
+from backend.models import db, init_db
+
+
+@pytest.fixture
+def app():
+    with flask_app.app_context():
+        init_db(reset=True)
+        yield flask_app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,92 @@
+import pytest
+from sqlalchemy import insert, update
+
+from backend.cache import data_versions
+from backend.counter import row_counter
+from backend.models import db, DataVersion, Product, ReportJob, get_data_versions
+
+
+def list_product_names(client):
+    response = client.get('/products?_start=0&_end=100')
+    assert response.status_code == 200
+    return [product['name'] for product in response.get_json(force=True)]
+
+
+def test_commit_after_rolled_back_savepoint_expires_cached_list(client):
+    assert list_product_names(client) == ['Wheel', 'Engine']
+
+    db.session.add(Product(name='Gear', cost_price=100))
+    db.session.flush()
+
+    savepoint = db.session.begin_nested()
+    db.session.add(Product(name='Rolled back', cost_price=100))
+    db.session.flush()
+    savepoint.rollback()
+
+    db.session.commit()
+
+    assert list_product_names(client) == ['Wheel', 'Engine', 'Gear']
+
+
+def test_cached_list_takes_count_again(client, monkeypatch):
+    assert client.get('/products').headers['X-Total-Count'] == '2'
+
+    # Other process adds a product, which row counter of this one doesn't see
+    with db.engine.begin() as connection:
+        connection.execute(insert(Product).values(name='Gear', cost_price=100))
+        connection.execute(
+            update(DataVersion).
+            where(DataVersion.table_name == 'product').
+            values(version=DataVersion.version + 1)
+        )
+    data_versions.expire()
+    # Requests share session of test, which still reads the old snapshot
+    db.session.rollback()
+
+    assert len(client.get('/products').get_json(force=True)) == 3
+
+    # Counted rows expire, cached response must not keep the old count
+    monkeypatch.setattr(row_counter, 'ttl', 0)
+    response = client.get('/products')
+    assert len(response.get_json(force=True)) == 3
+    assert response.headers['X-Total-Count'] == '3'
+
+
+def test_rolled_back_savepoint_keeps_bulk_changes_of_transaction(app):
+    version = get_data_versions(['product'])['product']
+
+    db.session.execute(update(Product).values(cost_price=Product.cost_price + 100))
+    savepoint = db.session.begin_nested()
+    savepoint.rollback()
+    db.session.commit()
+
+    assert get_data_versions(['product'])['product'] == version + 1
+
+
+def test_tables_not_read_by_versions_are_not_increased(app):
+    versions = get_data_versions(['report_job', 'product'])
+
+    db.session.add(ReportJob(id='job', key='key', report_type='product', status='pending'))
+    db.session.add(Product(name='Gear', cost_price=100))
+    db.session.commit()
+
+    assert get_data_versions(['report_job', 'product']) == {
+        'report_job': versions['report_job'],
+        'product': versions['product'] + 1,
+    }
+
+
+@pytest.mark.parametrize('update_returning', [True, False])
+def test_increased_versions_of_transaction(app, monkeypatch, update_returning):
+    # SQLite before 3.35 can't return updated rows
+    monkeypatch.setattr(db.engine.dialect, 'update_returning', update_returning)
+    version = get_data_versions(['product'])['product']
+
+    db.session.add(Product(name='Gear', cost_price=100))
+    db.session.flush()
+    db.session.add(Product(name='Shaft', cost_price=100))
+    db.session.flush()
+
+    assert db.session.info['increased_versions']['product'] == (version, version + 2)
+    db.session.commit()
+    assert get_data_versions(['product'])['product'] == version + 2
@@ -0,0 +1,79 @@
+import io
+import json
+
+import pytest
+
+from backend.importer import InvoiceImporter, ImportFormat
+from backend.models import Product, IncomeInvoice, SaleInvoice
+from tests.test_invoice_queries import count_statements
+
+
+CSV_HEADER = 'invoice,type,date,product_id,quantity,total_price,arrival_date\n'
+
+
+def income_csv_row(invoice: int, product_id: int) -> str:
+    return f'{invoice},income,2021-01-01T10:00:00.000Z,{product_id},5,10,2021-01-01T10:00:00.000Z\n'
+
+
+def test_errors_of_bad_rows_are_capped(app):
+    product_id = Product.query.first().id
+    sale = {
+        'type': 'sale',
+        'date': '2021-01-02T10:00:00.000Z',
+        'items': [{'product_id': product_id, 'quantity': 1, 'total_price': 20}]
+    }
+    # There is no stock yet, so every sale fails
+    file = io.StringIO('\n'.join(json.dumps(sale) for _ in range(7)))
+
+    result = InvoiceImporter(max_errors=3).import_file(file, ImportFormat.NDJSON)
+
+    assert result['imported'] == 0
+    assert result['error_count'] == 7
+    assert [error['row'] for error in result['errors']] == [1, 2, 3]
+    assert SaleInvoice.query.count() == 0
+
+
+@pytest.mark.parametrize('argument', ['batch_size=0', 'batch_size=-1', 'max_errors=0', 'batch_size=x'])
+def test_import_arguments_must_be_positive(client, argument):
+    response = client.post(f'/import?{argument}', data='')
+
+    assert response.status_code == 400
+
+
+def test_csv_without_columns_is_file_error(client):
+    response = client.post('/import?format=csv', data='type,date\nincome,2021-01-01T10:00:00.000Z\n')
+
+    assert response.status_code == 200
+    assert response.get_json(force=True) == {
+        'imported': 0,
+        'error_count': 1,
+        'errors': [{'row': None, 'error': 'Bad file - Missing CSV columns - invoice, product_id, quantity, total_price'}],
+    }
+
+
+def test_bad_encoding_keeps_imported_rows(client):
+    product_id = Product.query.first().id
+    # Body is decoded by chunks, so bad bytes come after the first one
+    rows = ''.join(income_csv_row(invoice, product_id) for invoice in range(1, 301))
+    data = (CSV_HEADER + rows).encode() + b'301,income,\xff\xfe\n'
+
+    response = client.post('/import?format=csv&batch_size=50', data=data)
+
+    assert response.status_code == 200
+    result = response.get_json(force=True)
+    assert 0 < result['imported'] < 300
+    assert result['error_count'] == 1
+    assert result['errors'][0]['row'] is None
+    assert 'codec' in result['errors'][0]['error']
+    assert IncomeInvoice.query.count() == result['imported']
+
+
+def test_every_batch_is_writing_transaction(app):
+    product_id = Product.query.first().id
+    file = io.StringIO(CSV_HEADER + ''.join(income_csv_row(invoice, product_id) for invoice in range(1, 6)))
+
+    with count_statements() as statements:
+        result = InvoiceImporter(batch_size=2).import_file(file, ImportFormat.CSV)
+
+    assert result['imported'] == 5
+    assert [statement for statement in statements if statement.startswith('BEGIN')] == ['BEGIN IMMEDIATE'] * 3
@@ -0,0 +1,75 @@
+import datetime
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+from backend.models import (
+    db,
+    Product,
+    IncomeInvoice,
+    IncomeInvoiceItem,
+    SaleInvoice,
+    SaleInvoiceItem
+)
+
+
+@contextmanager
+def count_statements():
+    """
+    Counts SQL statements, which are executed inside of block
+    :return:
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def add_invoices(count: int) -> None:
+    """
+    Adds income and sale invoices with 3 items each
+    :param count: count of invoices of each type
+    :return:
+    """
+    products = Product.query.all()
+    date = datetime.datetime(2021, 1, 1)
+
+    for _ in range(count):
+        db.session.add(IncomeInvoice(date=date, items=[
+            IncomeInvoiceItem(product_id=products[index % len(products)].id, quantity=10,
+                              arrival_date=date, total_price=1000)
+            for index in range(3)
+        ]))
+        db.session.add(SaleInvoice(date=date, items=[
+            SaleInvoiceItem(product_id=products[index % len(products)].id, quantity=1, total_price=150)
+            for index in range(3)
+        ]))
+
+    db.session.commit()
+
+
+@pytest.mark.parametrize('resource', ['/income_invoices', '/sale_invoices'])
+def test_listing_invoices_does_not_query_per_invoice(client, resource):
+    add_invoices(5)
+    with count_statements() as statements:
+        response = client.get(f'{resource}?_start=0&_end=1000')
+    assert response.status_code == 200
+    assert len(response.get_json(force=True)) == 5
+    small_count = len(statements)
+
+    add_invoices(45)
+    with count_statements() as statements:
+        response = client.get(f'{resource}?_start=0&_end=1000')
+    assert response.status_code == 200
+    invoices = response.get_json(force=True)
+    assert len(invoices) == 50
+    assert all(len(invoice['items']) == 3 for invoice in invoices)
+
+    assert len(statements) == small_count
@@ -0,0 +1,74 @@
+import pytest
+
+from backend.models import db, Product
+
+
+@pytest.fixture
+def products(client):
+    # Wheel ( 5000 ) and Engine ( 10000 ) are added by `init_db`
+    db.session.add_all([
+        Product(name='Gear', cost_price=2000),
+        Product(name='Shaft', cost_price=7500),
+        Product(name='Bolt', cost_price=7500),
+    ])
+    db.session.commit()
+
+    ids = {product.name: product.id for product in Product.query}
+
+    for name, quantity in [('Gear', 7), ('Bolt', 3), ('Engine', 5)]:
+        response = client.post('/income_invoices', json={'date': '2021-01-01T10:00:00.000Z', 'items': [{
+            'product_id': ids[name],
+            'quantity': quantity,
+            'arrival_date': '2021-01-01T10:00:00.000Z',
+            'total_price': 10
+        }]})
+        assert response.status_code == 200
+
+    return ids
+
+
+def list_products(client, query_string):
+    response = client.get(f'/products?{query_string}')
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return [product['name'] for product in response.get_json(force=True)], response.headers['X-Total-Count']
+
+
+def test_page_of_default_order(client, products):
+    assert list_products(client, '_start=1&_end=3') == (['Engine', 'Gear'], '5')
+    assert list_products(client, '_start=4&_end=10') == (['Bolt'], '5')
+
+
+def test_sort_by_column_with_id_tiebreaker(client, products):
+    names, _ = list_products(client, '_sort=cost_price&_order=DESC')
+
+    assert names == ['Engine', 'Bolt', 'Shaft', 'Wheel', 'Gear']
+
+
+def test_sort_by_hybrid_property(client, products):
+    names, _ = list_products(client, '_sort=quantity,id&_order=ASC')
+
+    assert names == ['Wheel', 'Shaft', 'Bolt', 'Engine', 'Gear']
+
+
+@pytest.mark.parametrize('field', ['consignments', 'query_with_quantity', 'unknown'])
+def test_sort_by_not_sql_attribute_is_rejected(client, products, field):
+    response = client.get(f'/products?_sort={field}')
+
+    assert response.status_code == 400
+    assert response.get_json(force=True)['message'] == f'Unknown sort field - {field}'
+
+
+def test_range_and_repeated_filters(client, products):
+    assert list_products(client, 'cost_price_gte=5000&cost_price_lte=7500') == (['Wheel', 'Shaft', 'Bolt'], '3')
+    assert list_products(client, 'name=Gear&name=Bolt&name=Nut') == (['Gear', 'Bolt'], '2')
+
+
+def test_count_of_filtered_list_is_not_limited_by_page(client, products):
+    assert list_products(client, 'cost_price=7500&_start=0&_end=1') == (['Shaft'], '2')
+
+
+@pytest.mark.parametrize('query_string', ['cost_price=cheap', 'cost_price_gte=1.5', 'id=x&id=1', '_start=a', '_end=b'])
+def test_bad_values_are_rejected(client, products, query_string):
+    response = client.get(f'/products?{query_string}')
+
+    assert response.status_code == 400
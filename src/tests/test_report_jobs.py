@@ -0,0 +1,103 @@
+import datetime
+import fcntl
+import os
+import socket
+import subprocess
+import sys
+
+from backend import jobs
+from backend.jobs import JobStatus, ReportCache, get_process_owner, render_slot, report_jobs
+from backend.models import db, ReportJob
+
+
+def add_pending_job(owner: str, created_at: datetime.datetime = None) -> ReportJob:
+    job = ReportJob(
+        id=f'job{ReportJob.query.count()}',
+        key='key',
+        report_type='product',
+        status=JobStatus.PENDING,
+        owner=owner,
+        created_at=created_at or datetime.datetime.now(),
+    )
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def get_stopped_owner() -> str:
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return f'{socket.gethostname()}:{process.pid}:{jobs.get_process_start(process.pid)}'
+
+
+def test_job_of_running_worker_stays_pending(app):
+    job = add_pending_job(get_process_owner())
+    assert report_jobs.check(job).status == JobStatus.PENDING
+    assert report_jobs.get_pending('key') is job
+
+
+def test_job_of_stopped_worker_is_failed(app):
+    job = add_pending_job(get_stopped_owner())
+
+    assert report_jobs.get_pending('key') is None
+    assert job.status == JobStatus.FAILED
+    assert job.error == 'Worker of report job is stopped'
+
+
+def test_job_of_restarted_worker_with_the_same_pid_is_failed(app):
+    host, pid, start = get_process_owner().rsplit(':', 2)
+    job = add_pending_job(f'{host}:{pid}:{start}0')
+    assert report_jobs.check(job).status == JobStatus.FAILED
+
+
+def test_job_of_other_host_is_failed_only_by_timeout(app):
+    job = add_pending_job('other-host:1:1')
+    assert report_jobs.check(job).status == JobStatus.PENDING
+
+    job.created_at = datetime.datetime.now() - datetime.timedelta(seconds=report_jobs.timeout + 1)
+    db.session.commit()
+    assert report_jobs.check(job).status == JobStatus.FAILED
+    assert job.error == 'Report job is not finished in time'
+
+
+def test_render_slot_is_not_shared(tmp_path):
+    with render_slot(tmp_path, slots=2):
+        with render_slot(tmp_path, slots=2):
+            for slot in range(2):
+                with open(tmp_path / f'{slot}.lock', 'w') as file:
+                    try:
+                        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        taken = False
+                    except BlockingIOError:
+                        taken = True
+                assert taken
+
+    with open(tmp_path / '0.lock', 'w') as file:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def test_evicted_reports_fail_their_jobs_and_old_jobs_are_deleted(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(report_jobs, 'cache', ReportCache(tmp_path, max_bytes=4, max_age=60))
+    (tmp_path / 'old.pdf').write_bytes(b'old')
+    (tmp_path / 'new.pdf').write_bytes(b'new')
+    old_time = datetime.datetime.now() - datetime.timedelta(seconds=30)
+    os.utime(tmp_path / 'old.pdf', (old_time.timestamp(), old_time.timestamp()))
+
+    for job_id, filename in [('evicted', 'old.pdf'), ('kept', 'new.pdf')]:
+        db.session.add(ReportJob(id=job_id, key=job_id, report_type='product', status=JobStatus.DONE, filename=filename))
+
+    db.session.add(ReportJob(
+        id='outdated',
+        key='outdated',
+        report_type='product',
+        status=JobStatus.FAILED,
+        created_at=datetime.datetime.now() - datetime.timedelta(seconds=report_jobs.timeout + 1),
+    ))
+    db.session.commit()
+
+    report_jobs.evict()
+
+    assert not (tmp_path / 'old.pdf').exists()
+    assert db.session.get(ReportJob, 'evicted').status == JobStatus.FAILED
+    assert db.session.get(ReportJob, 'kept').status == JobStatus.DONE
+    assert db.session.get(ReportJob, 'outdated') is None
@@ -0,0 +1,61 @@
+import csv
+import datetime
+import io
+
+import pytest
+
+from backend import exports, report
+from backend.exports import ExportFormat, SERIALIZERS
+from backend.models import db, Product, SaleInvoice, SaleInvoiceItem
+from backend.report import SaleReport, iterate_by_id
+
+
+START = datetime.datetime(2021, 1, 1)
+
+
+@pytest.fixture
+def sales(app, monkeypatch):
+    # Small window makes a report of several windows
+    monkeypatch.setattr(report, 'REPORT_WINDOW', 4)
+    products = Product.query.all()
+
+    for day in range(10):
+        db.session.add(SaleInvoice(date=START + datetime.timedelta(days=day), items=[
+            SaleInvoiceItem(product_id=product.id, quantity=day + 1, total_price=100 * (day + 1))
+            for product in products
+        ]))
+
+    # Invoice out of period is skipped
+    db.session.add(SaleInvoice(date=START - datetime.timedelta(days=1), items=[
+        SaleInvoiceItem(product_id=products[0].id, quantity=1, total_price=100)
+    ]))
+    db.session.commit()
+    return products
+
+
+def test_report_of_several_windows_has_all_invoices_with_items(sales):
+    period = {'start_time': START, 'end_time': START + datetime.timedelta(days=30)}
+    text = ''.join(SaleReport().serialize(**period))
+
+    assert text.count('SaleInvoice#') == 10
+    assert text.count('Product name') == 10 * len(sales)
+    assert 'Total money - 110.0' in text
+
+
+def test_iterate_by_id_filters_every_window(sales):
+    in_period = SaleInvoice.query.filter(SaleInvoice.date >= START)
+    invoices = list(iterate_by_id(in_period, SaleInvoice, size=3))
+
+    assert [invoice.id for invoice in invoices] == [invoice.id for invoice in in_period.order_by(SaleInvoice.id)]
+    assert len(invoices) == 10
+
+
+def test_csv_export_of_several_windows_has_all_rows(sales, monkeypatch):
+    monkeypatch.setattr(exports, 'EXPORT_WINDOW', 3)
+    period = {'start_time': START, 'end_time': START + datetime.timedelta(days=30)}
+    report_instance = SaleReport()
+    chunks = SERIALIZERS[ExportFormat.CSV].serialize(report_instance.__columns__, report_instance.iterate_rows(**period))
+    rows = list(csv.DictReader(io.StringIO(b''.join(chunks).decode())))
+
+    assert len(rows) == 10 * len(sales)
+    assert len({row['invoice_id'] for row in rows}) == 10
@@ -0,0 +1,77 @@
+from backend.counter import row_counter
+from backend.importer import InvoiceImporter
+from backend.models import db, Product, IncomeInvoice, SaleInvoice, Consignment
+
+
+def counted_models():
+    return Product, IncomeInvoice, SaleInvoice, Consignment
+
+
+def assert_counts_match():
+    for model in counted_models():
+        cached = row_counter.count(model, row_counter.TOTAL, counter=lambda: None)
+        assert cached == model.query.count(), model.__name__
+
+
+def test_rolled_back_savepoint_keeps_counts_of_transaction(app):
+    db.session.add(Product(name='Kept', cost_price=100))
+    db.session.flush()
+
+    savepoint = db.session.begin_nested()
+    db.session.add(Product(name='Rolled back', cost_price=100))
+    db.session.flush()
+    savepoint.rollback()
+
+    db.session.add(Product(name='Released', cost_price=100))
+    db.session.commit()
+
+    assert Product.query.count() == 4
+    assert_counts_match()
+
+
+def test_import_with_bad_rows_keeps_counts(app):
+    product_id = Product.query.first().id
+    income = {
+        'type': 'income',
+        'date': '2021-01-01T10:00:00.000Z',
+        'items': [{'product_id': product_id, 'quantity': 5, 'arrival_date': '2021-01-01T10:00:00.000Z', 'total_price': 10}]
+    }
+    sale = {
+        'type': 'sale',
+        'date': '2021-01-02T10:00:00.000Z',
+        'items': [{'product_id': product_id, 'quantity': 4, 'total_price': 20}]
+    }
+    unknown_product = dict(income, items=[dict(income['items'][0], product_id=-1)])
+    rows = [income, sale, unknown_product, income, sale, sale, income]
+
+    result = InvoiceImporter(batch_size=4).run(
+        (row, lambda invoice=invoice: invoice) for row, invoice in enumerate(rows, start=1)
+    )
+
+    # Row of unknown product and the third sale, which oversells, are rolled back
+    assert result['imported'] == 5
+    assert [error['row'] for error in result['errors']] == [3, 6]
+    assert_counts_match()
+
+
+def test_arguments_which_are_not_filters_share_count(client):
+    for value in range(10):
+        response = client.get(f'/products?x={value}&_start=0&_end={value + 1}')
+        assert response.headers['X-Total-Count'] == '2'
+
+    assert list(row_counter.counts[Product]) == [row_counter.TOTAL]
+
+    response = client.get('/products?name=Wheel&x=1')
+    assert response.headers['X-Total-Count'] == '1'
+    assert (('name', ('Wheel',)),) in row_counter.counts[Product]
+
+
+def test_filtered_counts_are_limited(client, monkeypatch):
+    monkeypatch.setattr(row_counter, 'max_filters', 3)
+
+    for value in range(10):
+        client.get(f'/products?cost_price_gte={value}')
+
+    assert list(row_counter.counts[Product]) == [row_counter.TOTAL] + [
+        (('cost_price_gte', (str(value),)),) for value in range(7, 10)
+    ]
@@ -0,0 +1,91 @@
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from sqlalchemy import func, select
+
+from backend.ledger import stock_ledger
+from backend.models import db, Product, Consignment, SaleInvoiceItem
+
+
+THREADS = 8
+SALES = 10
+STOCK = 60
+
+
+def post_invoice(client, items):
+    return client.post(
+        '/sale_invoices' if 'arrival_date' not in items[0] else '/income_invoices',
+        json={'date': '2021-01-02T10:00:00.000Z', 'items': items}
+    )
+
+
+@pytest.mark.parametrize('ledger_enabled', [False, True])
+def test_concurrent_sales_never_oversell(app, monkeypatch, ledger_enabled):
+    monkeypatch.setattr(stock_ledger, 'enabled', ledger_enabled)
+    monkeypatch.setattr(stock_ledger, 'loaded', False)
+    client = app.test_client()
+    product_id = Product.query.first().id
+
+    # Stock is split into consignments, so sales write off several of them
+    for quantity in (STOCK // 3, STOCK // 3, STOCK - 2 * (STOCK // 3)):
+        response = post_invoice(client, [{
+            'product_id': product_id,
+            'quantity': quantity,
+            'arrival_date': '2021-01-01T10:00:00.000Z',
+            'total_price': 10
+        }])
+        assert response.status_code == 200
+
+    if ledger_enabled:
+        stock_ledger.load()
+
+    # Threads together ask about twice more, than it is in stock
+    rng = random.Random(0)
+    quantities = [[rng.randint(0, 2 * STOCK // (THREADS * SALES) + 1) for _ in range(SALES)] for _ in range(THREADS)]
+    db.session.remove()
+
+    def sell(thread_quantities):
+        # Every request pushes own app context, so threads don't share session
+        thread_client = app.test_client()
+        sold = 0
+
+        for quantity in thread_quantities:
+            response = post_invoice(thread_client, [{'product_id': product_id, 'quantity': quantity, 'total_price': 1}])
+            # Sale, which stock isn't enough for, and empty sale are rejected
+            assert response.status_code in (200, 400), response.get_data(as_text=True)
+            assert quantity > 0 or response.status_code == 400
+
+            if response.status_code == 200:
+                sold += quantity
+
+        return sold
+
+    with ThreadPoolExecutor(max_workers=THREADS) as executor:
+        sold = sum(executor.map(sell, quantities))
+
+    received, left, broken = db.session.execute(
+        select(
+            func.sum(Consignment.quantity),
+            func.sum(Consignment.current_quantity),
+            func.count().filter(
+                (Consignment.current_quantity < 0) |
+                (Consignment.depreciated != (Consignment.current_quantity == 0))
+            ),
+        ).
+        where(Consignment.product_id == product_id)
+    ).one()
+    invoiced = db.session.scalar(
+        select(func.coalesce(func.sum(SaleInvoiceItem.quantity), 0)).
+        where(SaleInvoiceItem.product_id == product_id)
+    )
+
+    assert received == STOCK
+    assert broken == 0
+    assert sold == invoiced
+    assert invoiced + left == received
+    assert 0 < sold <= STOCK
+
+    if ledger_enabled:
+        assert stock_ledger.check() == []
+        stock_ledger.loaded = False
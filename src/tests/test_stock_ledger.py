@@ -0,0 +1,44 @@
+import datetime
+
+import pytest
+
+from backend.ledger import stock_ledger
+from backend.models import Product
+from backend.report import RestOfProductReport
+from tests.test_invoice_queries import count_statements
+
+
+@pytest.fixture
+def ledger(app, monkeypatch):
+    monkeypatch.setattr(stock_ledger, 'enabled', True)
+    stock_ledger.load()
+    yield stock_ledger
+    stock_ledger.loaded = False
+
+
+def post_invoice(client, items):
+    response = client.post(
+        '/sale_invoices' if 'arrival_date' not in items[0] else '/income_invoices',
+        json={'date': '2021-01-02T10:00:00.000Z', 'items': items}
+    )
+    assert response.status_code == 200
+
+
+def test_product_and_report_quantities_follow_sales(client, ledger):
+    product_id = Product.query.first().id
+    post_invoice(client, [
+        {'product_id': product_id, 'quantity': 7, 'arrival_date': '2021-01-01T10:00:00.000Z', 'total_price': 10}
+    ])
+    post_invoice(client, [{'product_id': product_id, 'quantity': 3, 'total_price': 20}])
+
+    with count_statements() as statements:
+        assert client.get(f'/products/{product_id}').get_json()['quantity'] == 4
+
+    # Quantity is taken from ledger, not summed from consignments
+    assert not any('FROM consignment' in statement for statement in statements)
+
+    rows = list(RestOfProductReport().iterate_rows(date=datetime.datetime(2021, 1, 3)))
+    quantities = {row['product_id']: row['current_quantity'] for row in rows}
+    assert quantities == {product.id: product.quantity for product in Product.query_with_quantity()}
+    assert quantities[product_id] == 4
+    assert ledger.check() == []
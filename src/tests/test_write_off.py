@@ -0,0 +1,29 @@
+import pytest
+
+from backend.controller import BusinessController
+from backend.models import db, Product, Consignment
+
+
+def post_sale(client, product_id, quantity):
+    return client.post('/sale_invoices', json={
+        'date': '2021-01-02T10:00:00.000Z',
+        'items': [{'product_id': product_id, 'quantity': quantity, 'total_price': 10}],
+    })
+
+
+def test_write_off_of_nothing_runs_no_update(app):
+    product = Product.query.first()
+    assert Consignment.query.filter_by(product_id=product.id).count() == 0
+
+    BusinessController.write_off_from_consignments(product=product, to_write_off=0)
+    db.session.commit()
+
+
+@pytest.mark.parametrize('quantity', [0, -1])
+def test_sale_of_not_positive_quantity_is_rejected(client, quantity):
+    product_id = Product.query.first().id
+
+    response = post_sale(client, product_id, quantity)
+
+    assert response.status_code == 400
+    assert response.get_json(force=True)['message'] == 'Quantity of sold product must be positive'
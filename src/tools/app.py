@@ -0,0 +1,6 @@
+# Application with benchmark, stress test and data generator commands.
+# They aren't a part of the service, so its workers never import them:
+#   flask --app tools.app benchmark-api
+from backend.app import app
+
+from . import benchmark, generator  # noqa: F401
@@ -0,0 +1,1219 @@
+import contextlib
+import datetime
+import decimal
+import json
+import math
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Tuple, Union
+
+import click
+from flask_restful import marshal
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import selectinload
+
+from backend.app import app
+from backend.controller import BusinessController, InvoiceType
+from backend.encoders import RowEncoder
+from backend.exports import SERIALIZERS
+from backend.ledger import stock_ledger
+from backend.money import Money, MoneyField
+from backend.models import (
+    Consignment,
+    IncomeInvoice,
+    IncomeInvoiceItem,
+    Product,
+    SaleInvoice,
+    SaleInvoiceItem,
+    db,
+    plan_restock,
+)
+from backend.report import IncomeReport, Report, RestOfProductReport, SaleReport
+from backend.resources.consignments import consignment_fields
+from backend.resources.income_invoice import income_invoice_fields
+from backend.resources.products import product_fields
+from backend.resources.sale_invoice import sale_invoice_fields
+from backend.stock import get_stock_on_date
+
+from .generator import DataGenerator
+
+
+BENCHMARK_REPEAT = 5
+
+API_BENCHMARK_REQUESTS = 200
+
+API_PAGE_SIZE = 25
+
+HotQuery = Tuple[str, Callable[[], Any]]
+
+# Method, url and json body of request
+ApiRequest = Tuple[str, str, Union[dict, None]]
+
+
+def get_hot_queries() -> List[HotQuery]:
+    """
+    Returns hot paths of API and reports, which are measured.
+    Parameters are taken from data: the product with the most
+    consignments, the latest invoices and the middle month of invoices
+    :return: names and functions of queries
+    """
+    product_id = db.session.scalar(
+        select(Consignment.product_id).
+        group_by(Consignment.product_id).
+        order_by(func.count().desc()).
+        limit(1)
+    )
+    product_ids = list(db.session.scalars(select(Product.id).order_by(Product.id).limit(100)))
+    sale_ids = list(db.session.scalars(select(SaleInvoice.id).order_by(SaleInvoice.id.desc()).limit(25)))
+    first_date, last_date = db.session.execute(select(func.min(SaleInvoice.date), func.max(SaleInvoice.date))).one()
+    middle_date = first_date + (last_date - first_date) / 2
+    month = {'start_time': middle_date, 'end_time': middle_date + datetime.timedelta(days=30)}
+
+    return [
+        ('products page quantity', lambda: db.session.execute(
+            select(Product.id, Product.quantity).order_by(Product.id).limit(100)
+        ).all()),
+        ('product consignments', lambda: Consignment.query.filter(Consignment.product_id == product_id).all()),
+        ('write off plan', lambda: BusinessController.plan_write_off(product_id, to_write_off=10 ** 9)),
+        ('restock plan', lambda: plan_restock(db.session.connection(), product_id, to_add=10 ** 9)),
+        ('last consignment numbers', lambda: BusinessController.get_last_consignment_numbers(product_ids)),
+        ('sale invoices page', lambda: [
+            invoice.total_price
+            for invoice in SaleInvoice.query.options(selectinload(SaleInvoice.items)).
+            order_by(SaleInvoice.date.desc()).
+            limit(25)
+        ]),
+        ('sale invoice items', lambda: SaleInvoice.query.options(
+            selectinload(SaleInvoice.items).joinedload(SaleInvoiceItem.product)
+        ).filter(SaleInvoice.id.in_(sale_ids)).all()),
+        ('sale report month', lambda: list(SaleReport().iterate_rows(**month))),
+        ('income report month', lambda: list(IncomeReport().iterate_rows(**month))),
+        ('stock on date', lambda: get_stock_on_date(middle_date)),
+    ]
+
+
+@contextlib.contextmanager
+def capture_statements() -> Iterator[List[Tuple[str, Any]]]:
+    """
+    Collects SQL statements with parameters, executed inside of block
+    :return:
+    """
+    statements = []
+
+    def collect(connection, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', collect)
+
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', collect)
+
+
+def explain(statement: str, parameters: Any, phase: str) -> List[str]:
+    """
+    Returns query plan of statement
+    :param statement: SQL statement
+    :param parameters: parameters of statement
+    :param phase: name of benchmark phase
+    :return: lines of plan
+    """
+    connection = db.session.connection()
+    # pysqlite caches prepared statements by text, and cached EXPLAIN
+    # isn't prepared again after indexes are dropped, so text must differ
+    explained = f'/* {phase} */ {statement}'
+
+    if connection.dialect.name == 'sqlite':
+        return [row[-1] for row in connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {explained}', parameters)]
+
+    return [row[0] for row in connection.exec_driver_sql(f'EXPLAIN {explained}', parameters)]
+
+
+class QueryBenchmark:
+
+    """
+    Measures hot queries with the designed indexes and without them.
+    Indexes are dropped inside of transaction, which is rolled back,
+    so database is never left without indexes
+    """
+
+    def __init__(self, repeat: int = BENCHMARK_REPEAT):
+        """
+        :param repeat: count of runs of every query, median is reported
+        """
+        self.repeat = repeat
+
+    def measure(self, query: Callable[[], Any]) -> float:
+        """
+        Returns median time of query runs
+        :param query: function, which runs query
+        :return: milliseconds
+        """
+        timings = []
+
+        for _ in range(self.repeat):
+            # Objects of previous run must be loaded again
+            db.session.expunge_all()
+            started = time.perf_counter()
+            query()
+            timings.append((time.perf_counter() - started) * 1000)
+
+        return statistics.median(timings)
+
+    @staticmethod
+    def get_plans(query: Callable[[], Any], phase: str) -> List[List[str]]:
+        with capture_statements() as statements:
+            query()
+
+        # Windowed queries repeat the same statements
+        unique_statements = {}
+
+        for statement, parameters in statements:
+            unique_statements.setdefault(statement, parameters)
+
+        return [explain(statement, parameters, phase) for statement, parameters in unique_statements.items()]
+
+    def run_queries(self, queries: List[HotQuery], phase: str) -> Dict[str, dict]:
+        return {
+            name: {'time': self.measure(query), 'plans': self.get_plans(query, phase)}
+            for name, query in queries
+        }
+
+    def run(self) -> Dict[str, Dict[str, dict]]:
+        """
+        Measures hot queries with indexes and without them
+        :return: time and plans by query name, for `with` and `without` indexes
+        """
+        queries = get_hot_queries()
+        results = {'with': self.run_queries(queries, 'with')}
+        db.session.commit()
+
+        connection = db.session.connection()
+
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.drop(connection, checkfirst=True)
+
+        try:
+            results['without'] = self.run_queries(queries, 'without')
+        finally:
+            db.session.rollback()
+
+        return results
+
+
+@app.cli.command('benchmark-queries')
+@click.option('--products', type=int, default=0, help='Generate products before benchmark')
+@click.option('--income-invoices', type=int, default=0, help='Generate income invoices before benchmark')
+@click.option('--sale-invoices', type=int, default=0, help='Generate sale invoices before benchmark')
+@click.option('--repeat', type=int, default=BENCHMARK_REPEAT)
+@click.option('--plans/--no-plans', default=True, help='Print query plans')
+def benchmark_queries_command(
+        products: int,
+        income_invoices: int,
+        sale_invoices: int,
+        repeat: int,
+        plans: bool,
+) -> None:
+    """
+    Prints timings and plans of hot queries with indexes and without them.
+    Run it against a separate database ( SQLALCHEMY_DATABASE_URI ),
+    data can be generated before run
+    """
+    if products:
+        counts = DataGenerator(
+            products=products,
+            income_invoices=income_invoices,
+            sale_invoices=sale_invoices,
+            start=datetime.datetime(2020, 1, 1),
+            days=3 * 365,
+        ).run()
+        click.echo(f'Generated {counts}')
+
+    results = QueryBenchmark(repeat=repeat).run()
+    click.echo(f'{"query":<28}{"without, ms":>14}{"with, ms":>14}{"speedup":>10}')
+
+    for name, result in results['with'].items():
+        without = results['without'][name]
+        click.echo(f'{name:<28}{without["time"]:>14.2f}{result["time"]:>14.2f}{without["time"] / result["time"]:>9.1f}x')
+
+    if not plans:
+        return
+
+    for name, result in results['with'].items():
+        click.echo(f'\n{name}')
+
+        for title, query_plans in [('without', results['without'][name]['plans']), ('with', result['plans'])]:
+            for plan in query_plans:
+                click.echo(f'  {title}:')
+
+                for line in plan:
+                    click.echo(f'    {line}')
+
+
+def write_off_by_relationship(product: Product, to_write_off: int) -> None:
+    """
+    Write off, which was used before the batched one: all consignments
+    of product are loaded by relationship and changed one by one
+    :param product: product to write off
+    :param to_write_off: quantity to write off
+    :return:
+    """
+    current_to_write_off = to_write_off
+
+    for consignment in product.consignments:
+
+        current_cons_quantity = (
+            0 if consignment.current_quantity <= current_to_write_off
+            else consignment.current_quantity - current_to_write_off
+        )
+
+        if current_cons_quantity == 0:
+            consignment.depreciated = True
+
+        if consignment.current_quantity >= current_to_write_off:
+            current_to_write_off = 0
+
+        elif current_to_write_off > consignment.current_quantity:
+            current_to_write_off -= consignment.current_quantity
+
+        consignment.current_quantity = current_cons_quantity
+
+        if current_to_write_off == 0:
+            break
+
+
+class WriteOffBenchmark:
+
+    """
+    Compares write off over `product.consignments` with the batched
+    `BusinessController.write_off_from_consignments` on the same
+    products and quantities. Every write off is rolled back
+    """
+
+    def __init__(self, write_offs: int, repeat: int = BENCHMARK_REPEAT, seed: int = 0):
+        """
+        :param write_offs: count of products to write off
+        :param repeat: count of runs of every write off, median is reported
+        :param seed: seed of random products and quantities
+        """
+        self.write_offs = write_offs
+        self.repeat = repeat
+        self.seed = seed
+
+    def get_write_offs(self) -> List[Tuple[int, int]]:
+        """
+        Takes random products in stock with random quantity to write off
+        :return: product ids with quantities
+        """
+        rng = random.Random(self.seed)
+        stock = db.session.execute(
+            select(Consignment.product_id, func.sum(Consignment.current_quantity)).
+            where(Consignment.depreciated.is_(False)).
+            group_by(Consignment.product_id).
+            having(func.sum(Consignment.current_quantity) > 0).
+            order_by(Consignment.product_id)
+        ).all()
+        products = rng.sample(stock, min(self.write_offs, len(stock)))
+        return [(product_id, rng.randint(1, quantity)) for product_id, quantity in products]
+
+    @staticmethod
+    def write_off(write_off: Callable[[Product, int], None], product_id: int, quantity: int) -> Tuple[float, int, list]:
+        """
+        Writes off and flushes changes, then rolls them back
+        :param write_off: function, which writes off
+        :param product_id: product to write off
+        :param quantity: quantity to write off
+        :return: milliseconds, count of statements and consignments after write off
+        """
+        statements = []
+
+        def collect(connection, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        db.session.expunge_all()
+        event.listen(db.engine, 'before_cursor_execute', collect)
+
+        try:
+            started = time.perf_counter()
+            write_off(db.session.get(Product, product_id), quantity)
+            db.session.flush()
+            elapsed = (time.perf_counter() - started) * 1000
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', collect)
+
+        consignments = db.session.execute(
+            select(Consignment.id, Consignment.current_quantity, Consignment.depreciated).
+            where(Consignment.product_id == product_id).
+            order_by(Consignment.id)
+        ).all()
+        db.session.rollback()
+        return elapsed, len(statements), consignments
+
+    def run(self) -> Dict[str, Any]:
+        """
+        Runs both write offs
+        :return: total of median times and statements by write off,
+        and equality of consignments after them
+        """
+        write_offs = self.get_write_offs()
+        functions = {
+            'product.consignments': write_off_by_relationship,
+            'batched': BusinessController.write_off_from_consignments,
+        }
+        results = {name: {'time': 0.0, 'statements': 0} for name in functions}
+        identical = True
+
+        for product_id, quantity in write_offs:
+            states = []
+
+            for name, function in functions.items():
+                runs = [self.write_off(function, product_id, quantity) for _ in range(self.repeat)]
+                results[name]['time'] += statistics.median(run[0] for run in runs)
+                results[name]['statements'] += runs[0][1]
+                states.append(runs[0][2])
+
+            identical = identical and states[0] == states[1]
+
+        return {'write_offs': len(write_offs), 'identical': identical, 'results': results}
+
+
+@app.cli.command('benchmark-write-off')
+@click.option('--products', type=int, default=0, help='Generate products before benchmark')
+@click.option('--income-invoices', type=int, default=0, help='Generate income invoices before benchmark')
+@click.option('--sale-invoices', type=int, default=0, help='Generate sale invoices before benchmark')
+@click.option('--write-offs', type=int, default=200, help='Count of products to write off')
+@click.option('--repeat', type=int, default=BENCHMARK_REPEAT)
+@click.option('--seed', type=int, default=0, help='Seed of random products and quantities')
+def benchmark_write_off_command(
+        products: int,
+        income_invoices: int,
+        sale_invoices: int,
+        write_offs: int,
+        repeat: int,
+        seed: int,
+) -> None:
+    """
+    Compares write off over `product.consignments` with the batched one
+    on the same products and quantities and checks, that both leave
+    the same consignments. Run it against a separate database
+    ( SQLALCHEMY_DATABASE_URI ), data can be generated before run
+    """
+    if products:
+        counts = DataGenerator(
+            products=products,
+            income_invoices=income_invoices,
+            sale_invoices=sale_invoices,
+            start=datetime.datetime(2020, 1, 1),
+            days=3 * 365,
+        ).run()
+        click.echo(f'Generated {counts}')
+
+    result = WriteOffBenchmark(write_offs=write_offs, repeat=repeat, seed=seed).run()
+    click.echo(f'{result["write_offs"]} write offs')
+    click.echo(f'{"write off":<24}{"total, ms":>12}{"per product, ms":>18}{"statements":>12}')
+
+    for name, timing in result['results'].items():
+        per_product = timing['time'] / max(result['write_offs'], 1)
+        click.echo(f'{name:<24}{timing["time"]:>12.1f}{per_product:>18.2f}{timing["statements"]:>12}')
+
+    if not result['identical']:
+        raise click.ClickException('Write offs left different consignments')
+
+
+def to_json_time(date: datetime.datetime) -> str:
+    """
+    Help function, which formats date as API expects
+    :param date: date to format
+    :return:
+    """
+    return date.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def get_percentile(timings: List[float], percent: float) -> float:
+    """
+    Returns nearest-rank percentile of timings
+    :param timings: measured timings
+    :param percent: percentile, from 0 to 100
+    :return:
+    """
+    ordered = sorted(timings)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+
+class ApiScenarios:
+
+    """
+    Requests to hot paths of API.
+    Parameters of requests are random, but taken from data,
+    so every request finds something
+    """
+
+    def __init__(self, seed: int = 0):
+        """
+        :param seed: seed of random parameters
+        """
+        self.random = random.Random(seed)
+        self.products_count = Product.query.count()
+        self.product_ids = list(db.session.scalars(select(Product.id)))
+        self.in_stock_ids = list(db.session.scalars(select(Product.id).where(Product.quantity > 0)))
+        self.sale_ids = list(db.session.scalars(select(SaleInvoice.id)))
+        self.income_count = IncomeInvoice.query.count()
+        self.first_date, self.last_date = db.session.execute(
+            select(func.min(SaleInvoice.date), func.max(SaleInvoice.date))
+        ).one()
+
+    def get_page(self, count: int) -> str:
+        start = self.random.randrange(max(count - API_PAGE_SIZE, 1))
+        return f'_start={start}&_end={start + API_PAGE_SIZE}'
+
+    def get_date(self) -> datetime.datetime:
+        return self.first_date + (self.last_date - self.first_date) * self.random.random()
+
+    def create_income_invoice(self) -> ApiRequest:
+        date = to_json_time(self.get_date())
+        items = [
+            {'product_id': product_id, 'quantity': 10, 'total_price': '100.00', 'arrival_date': date}
+            for product_id in self.random.sample(self.product_ids, min(3, len(self.product_ids)))
+        ]
+        return 'POST', '/income_invoices', {'date': date, 'items': items}
+
+    def create_sale_invoice(self) -> ApiRequest:
+        items = [
+            {'product_id': product_id, 'quantity': 1, 'total_price': '15.00'}
+            for product_id in self.random.sample(self.in_stock_ids, min(3, len(self.in_stock_ids)))
+        ]
+        return 'POST', '/sale_invoices', {'date': to_json_time(self.last_date), 'items': items}
+
+    def get_week_report(self) -> ApiRequest:
+        start_time = self.get_date()
+        return 'POST', '/report?report_type=sale&format=csv', {
+            'start_time': to_json_time(start_time),
+            'end_time': to_json_time(start_time + datetime.timedelta(days=7)),
+        }
+
+    def get_period_invoices(self) -> ApiRequest:
+        start_time = self.get_date()
+        end_time = start_time + datetime.timedelta(days=7)
+        return 'GET', (
+            f'/sale_invoices?date_gte={start_time.isoformat()}&date_lte={end_time.isoformat()}'
+            f'&_sort=date&_order=ASC&_start=0&_end={API_PAGE_SIZE}'
+        ), None
+
+    def get_scenarios(self) -> Dict[str, Callable[[], ApiRequest]]:
+        """
+        Returns functions, which make requests of every scenario
+        :return: request makers by scenario name
+        """
+        return {
+            'products page': lambda: (
+                'GET', f'/products?_sort=id&_order=ASC&{self.get_page(self.products_count)}', None
+            ),
+            'product consignments': lambda: (
+                'GET',
+                f'/consignments?product_id={self.random.choice(self.product_ids)}'
+                f'&_sort=arrival_date&_order=ASC&_start=0&_end={API_PAGE_SIZE}',
+                None
+            ),
+            'sale invoices page': lambda: (
+                'GET', f'/sale_invoices?_sort=date&_order=DESC&{self.get_page(len(self.sale_ids))}', None
+            ),
+            'sale invoices of week': self.get_period_invoices,
+            'income invoices page': lambda: (
+                'GET', f'/income_invoices?_sort=date&_order=DESC&{self.get_page(self.income_count)}', None
+            ),
+            'sale invoice': lambda: ('GET', f'/sale_invoices/{self.random.choice(self.sale_ids)}', None),
+            'create income invoice': self.create_income_invoice,
+            'create sale invoice': self.create_sale_invoice,
+            'sale report csv': self.get_week_report,
+        }
+
+
+class ApiBenchmark:
+
+    """
+    Sends requests of scenarios to API and measures
+    latency, throughput and count of SQL queries per request.
+    Requests go through Flask test client, or to running server,
+    if its url is passed ( queries can't be counted then )
+    """
+
+    def __init__(self, requests: int, concurrency: int = 1, url: Union[str, None] = None):
+        """
+        :param requests: count of requests of every scenario
+        :param concurrency: count of threads, which send requests
+        :param url: url of running server
+        """
+        self.requests = requests
+        self.concurrency = concurrency
+        self.url = url
+        self.local = threading.local()
+
+    def count_query(self, *args) -> None:
+        self.local.queries = getattr(self.local, 'queries', 0) + 1
+
+    def send(self, api_request: ApiRequest) -> Tuple[float, bool, Union[int, None]]:
+        """
+        Sends request and reads the whole response
+        :param api_request: request to send
+        :return: milliseconds, success and count of queries
+        """
+        method, url, body = api_request
+        self.local.queries = 0
+        started = time.perf_counter()
+
+        if self.url is None:
+            if not hasattr(self.local, 'client'):
+                self.local.client = app.test_client()
+
+            response = self.local.client.open(url, method=method, json=body)
+            response.get_data()
+            success = response.status_code < 400
+            queries = self.local.queries
+
+        else:
+            data = None if body is None else json.dumps(body).encode()
+            http_request = urllib.request.Request(
+                self.url.rstrip('/') + url,
+                data=data,
+                method=method,
+                headers={'Content-Type': 'application/json'}
+            )
+
+            try:
+                with urllib.request.urlopen(http_request) as response:
+                    response.read()
+                success = True
+            except OSError:
+                success = False
+
+            queries = None
+
+        return (time.perf_counter() - started) * 1000, success, queries
+
+    def run_scenario(self, make_request: Callable[[], ApiRequest]) -> dict:
+        """
+        Sends requests of scenario
+        :param make_request: function, which makes request
+        :return: statistics of requests
+        """
+        # Parameters are made before, so they aren't measured
+        api_requests = [make_request() for _ in range(self.requests)]
+        # Warm up of caches and connections
+        self.send(make_request())
+
+        started = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = list(executor.map(self.send, api_requests))
+
+        duration = time.perf_counter() - started
+        timings = [timing for timing, _, _ in results]
+        queries = [count for _, _, count in results if count is not None]
+
+        return {
+            'requests': len(results),
+            'errors': sum(not success for _, success, _ in results),
+            'p50': get_percentile(timings, 50),
+            'p99': get_percentile(timings, 99),
+            'throughput': len(results) / duration,
+            'queries': statistics.mean(queries) if queries else None,
+        }
+
+    def run(self, scenarios: Dict[str, Callable[[], ApiRequest]]) -> Dict[str, dict]:
+        """
+        Runs all scenarios one by one
+        :param scenarios: request makers by scenario name
+        :return: statistics by scenario name
+        """
+        event.listen(db.engine, 'before_cursor_execute', self.count_query)
+
+        try:
+            return {name: self.run_scenario(make_request) for name, make_request in scenarios.items()}
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', self.count_query)
+
+
+def find_regressions(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """
+    Compares results with saved ones. Latency may grow within tolerance,
+    count of queries doesn't depend on machine, so it must not grow
+    :param results: results of current run
+    :param baseline: results of previous run
+    :param tolerance: allowed relative growth of p99 latency
+    :return: descriptions of regressions
+    """
+    regressions = []
+
+    for name, result in results.items():
+        previous = baseline.get(name)
+
+        if previous is None:
+            continue
+
+        if result['p99'] > previous['p99'] * (1 + tolerance):
+            regressions.append(f'{name}: p99 {previous["p99"]:.2f} ms -> {result["p99"]:.2f} ms')
+
+        if None not in (result['queries'], previous['queries']) and result['queries'] > previous['queries']:
+            regressions.append(f'{name}: queries {previous["queries"]:.1f} -> {result["queries"]:.1f}')
+
+        if result['errors'] > previous['errors']:
+            regressions.append(f'{name}: errors {previous["errors"]} -> {result["errors"]}')
+
+    return regressions
+
+
+@app.cli.command('benchmark-api')
+@click.option('--requests', type=int, default=API_BENCHMARK_REQUESTS, help='Requests of every scenario')
+@click.option('--concurrency', type=int, default=1, help='Count of threads, which send requests')
+@click.option('--url', default=None, help='Url of running server, Flask test client by default')
+@click.option('--scenario', 'only', multiple=True, help='Run only these scenarios')
+@click.option('--seed', type=int, default=0, help='Seed of random parameters')
+@click.option('--save', type=click.Path(dir_okay=False), default=None, help='Save results to JSON file')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Fail, if results are worse than saved ones')
+@click.option('--tolerance', type=float, default=0.25, help='Allowed relative growth of p99 latency')
+def benchmark_api_command(
+        requests: int,
+        concurrency: int,
+        url: Union[str, None],
+        only: Tuple[str],
+        seed: int,
+        save: Union[str, None],
+        baseline: Union[str, None],
+        tolerance: float,
+) -> None:
+    """
+    Measures latency, throughput and SQL queries of API hot paths.
+    Scenarios create invoices, so run it against a separate database
+    with generated data ( see `generate-data` )
+    """
+    scenarios = ApiScenarios(seed=seed).get_scenarios()
+
+    if only:
+        unknown = set(only) - set(scenarios)
+
+        if unknown:
+            raise click.BadParameter(f'Unknown scenarios - {", ".join(sorted(unknown))}', param_hint='--scenario')
+
+        scenarios = {name: scenarios[name] for name in only}
+
+    # Data of scenarios is loaded, so session is free for requests
+    db.session.remove()
+    results = ApiBenchmark(requests=requests, concurrency=concurrency, url=url).run(scenarios)
+
+    click.echo(f'{"scenario":<24}{"p50, ms":>10}{"p99, ms":>10}{"req/s":>10}{"queries":>10}{"errors":>8}')
+
+    for name, result in results.items():
+        queries = '-' if result['queries'] is None else f'{result["queries"]:.1f}'
+        click.echo(
+            f'{name:<24}{result["p50"]:>10.2f}{result["p99"]:>10.2f}'
+            f'{result["throughput"]:>10.1f}{queries:>10}{result["errors"]:>8}'
+        )
+
+    if save:
+        with open(save, 'w') as file:
+            json.dump(results, file, indent=4)
+
+    if baseline:
+        with open(baseline) as file:
+            regressions = find_regressions(results, json.load(file), tolerance)
+
+        if regressions:
+            raise click.ClickException('Regressions found:\n' + '\n'.join(regressions))
+
+
+class SerializerBenchmark:
+
+    """
+    Compares `marshal` with `json.dumps` and compiled `RowEncoder`
+    on the rows of list resources. Rows of columns-only fields
+    are also encoded from selected values, as `with_count` does
+    """
+
+    def __init__(self, limit: int, repeat: int = BENCHMARK_REPEAT):
+        """
+        :param limit: count of encoded rows of every list
+        :param repeat: count of runs of every serializer, median is reported
+        """
+        self.limit = limit
+        self.repeat = repeat
+
+    @staticmethod
+    def get_lists() -> List[Tuple[str, Any, dict, Any]]:
+        """
+        Returns listed models with their fields and base queries
+        :return:
+        """
+        return [
+            ('products', Product, product_fields, Product.query_with_quantity()),
+            ('consignments', Consignment, consignment_fields, Consignment.query),
+            ('sale invoices', SaleInvoice, sale_invoice_fields,
+             SaleInvoice.query.options(selectinload(SaleInvoice.items))),
+            ('income invoices', IncomeInvoice, income_invoice_fields,
+             IncomeInvoice.query.options(selectinload(IncomeInvoice.items))),
+        ]
+
+    def measure(self, serialize: Callable[[], str]) -> Tuple[float, str]:
+        """
+        Returns median time of serializer runs and its output
+        :param serialize: function, which serializes rows
+        :return: milliseconds and output
+        """
+        timings = []
+        output = None
+
+        for _ in range(self.repeat):
+            started = time.perf_counter()
+            output = serialize()
+            timings.append((time.perf_counter() - started) * 1000)
+
+        return statistics.median(timings), output
+
+    def run(self) -> Dict[str, dict]:
+        """
+        Measures serializers of every list
+        :return: timings and equality of outputs by list name
+        """
+        results = {}
+
+        for name, model, model_fields, query in self.get_lists():
+            encoder = RowEncoder(model_fields)
+            query = query.order_by(model.id).limit(self.limit)
+            objects = query.all()
+
+            marshal_time, expected = self.measure(lambda: json.dumps(marshal(objects, model_fields)))
+            encoder_time, encoded = self.measure(lambda: encoder.dumps(objects))
+            result = {
+                'rows': len(objects),
+                'marshal': marshal_time,
+                'encoder': encoder_time,
+                'values': None,
+                'identical': encoded == expected,
+            }
+
+            if encoder.columns is not None:
+                values = query.with_entities(*[getattr(model, column) for column in encoder.columns]).all()
+                result['values'], encoded = self.measure(lambda: encoder.dumps(values, by_position=True))
+                result['identical'] = result['identical'] and encoded == expected
+
+            results[name] = result
+            db.session.expunge_all()
+
+        return results
+
+
+@app.cli.command('benchmark-serializers')
+@click.option('--limit', type=int, default=50000, help='Count of encoded rows of every list')
+@click.option('--repeat', type=int, default=BENCHMARK_REPEAT)
+def benchmark_serializers_command(limit: int, repeat: int) -> None:
+    """
+    Compares time of `marshal` and compiled encoders of list resources
+    and checks, that their output is the same
+    """
+    results = SerializerBenchmark(limit=limit, repeat=repeat).run()
+    click.echo(
+        f'{"list":<18}{"rows":>8}{"marshal, ms":>14}{"encoder, ms":>14}'
+        f'{"values, ms":>14}{"speedup":>10}{"identical":>11}'
+    )
+
+    for name, result in results.items():
+        fastest = result['encoder'] if result['values'] is None else min(result['encoder'], result['values'])
+        values = '-' if result['values'] is None else f'{result["values"]:.2f}'
+        click.echo(
+            f'{name:<18}{result["rows"]:>8}{result["marshal"]:>14.2f}{result["encoder"]:>14.2f}'
+            f'{values:>14}{result["marshal"] / fastest:>9.1f}x{str(result["identical"]):>11}'
+        )
+
+    different = [name for name, result in results.items() if not result['identical']]
+
+    if different:
+        raise click.ClickException(f'Encoded JSON differs from marshal - {", ".join(different)}')
+
+
+class SaleStressTest:
+
+    """
+    Sells the same product from several threads at once
+    and checks, that stock is never oversold: sold and left quantities
+    sum up to the received one and no consignment goes below zero
+    """
+
+    def __init__(self, threads: int, sales: int, stock: int, consignments: int = 10, seed: int = 0):
+        """
+        :param threads: count of threads, which sell
+        :param sales: count of sales of every thread
+        :param stock: received quantity of product
+        :param consignments: count of consignments, which stock is received in
+        :param seed: seed of random quantities
+        """
+        self.threads = threads
+        self.sales = sales
+        self.stock = stock
+        self.consignments = consignments
+        self.random = random.Random(seed)
+
+    def create_product(self) -> int:
+        """
+        Creates product and receives its stock
+        :return: id of product
+        """
+        product = Product(name='Stress test product', cost_price=100)
+        db.session.add(product)
+        db.session.flush()
+        quantities = [self.stock // self.consignments] * self.consignments
+        quantities[-1] += self.stock % self.consignments
+
+        BusinessController.create_invoice(
+            invoice_type=InvoiceType.INCOME,
+            creation_date=datetime.datetime.now(),
+            invoice_items=[
+                IncomeInvoiceItem(
+                    product=product,
+                    quantity=quantity,
+                    arrival_date=datetime.datetime.now() + datetime.timedelta(seconds=number),
+                    total_price=quantity * 100,
+                )
+                for number, quantity in enumerate(quantities)
+            ]
+        )
+        return product.id
+
+    @staticmethod
+    def sell(product_id: int, quantities: List[int]) -> Dict[str, int]:
+        """
+        Sells product by one invoice for every quantity
+        :param product_id: sold product
+        :param quantities: quantities of invoices
+        :return: counts of sold, rejected and failed invoices, and attempts
+        """
+        counts = {'sold': 0, 'sold_quantity': 0, 'rejected': 0, 'failed': 0, 'attempts': 0}
+
+        def create_invoice(quantity: int) -> None:
+            counts['attempts'] += 1
+            BusinessController.create_invoice(
+                invoice_type=InvoiceType.SALE,
+                creation_date=datetime.datetime.now(),
+                invoice_items=BusinessController.create_items_from_json([
+                    {'product_id': product_id, 'quantity': quantity, 'total_price': quantity},
+                ]),
+                commit=False
+            )
+
+        with app.app_context():
+            for quantity in quantities:
+                try:
+                    BusinessController.run_in_transaction(lambda: create_invoice(quantity))
+                    counts['sold'] += 1
+                    counts['sold_quantity'] += quantity
+
+                except ValueError:
+                    # Stock is over
+                    counts['rejected'] += 1
+
+                except Exception:
+                    counts['failed'] += 1
+
+        return counts
+
+    @staticmethod
+    def check(product_id: int) -> Dict[str, int]:
+        """
+        Reads stock of product from database
+        :param product_id: checked product
+        :return: received, sold and left quantities, and count of broken consignments
+        """
+        received, left, broken = db.session.execute(
+            select(
+                func.sum(Consignment.quantity),
+                func.sum(Consignment.current_quantity),
+                func.count().filter(
+                    (Consignment.current_quantity < 0) |
+                    (Consignment.depreciated != (Consignment.current_quantity == 0))
+                ),
+            ).
+            where(Consignment.product_id == product_id)
+        ).one()
+        sold = db.session.scalar(
+            select(func.coalesce(func.sum(SaleInvoiceItem.quantity), 0)).
+            where(SaleInvoiceItem.product_id == product_id)
+        )
+        return {'received': received, 'sold': sold, 'left': left, 'broken': broken}
+
+    def run(self) -> dict:
+        """
+        Sells product from all threads, more than it is in stock
+        :return: counts of sales and stock of product
+        """
+        product_id = self.create_product()
+        # Threads together ask about twice more, than it is in stock
+        max_quantity = max(1, 4 * self.stock // (self.threads * self.sales))
+        quantities = [
+            [self.random.randint(1, max_quantity) for _ in range(self.sales)]
+            for _ in range(self.threads)
+        ]
+        db.session.remove()
+
+        started = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            results = list(executor.map(lambda thread_quantities: self.sell(product_id, thread_quantities), quantities))
+
+        duration = time.perf_counter() - started
+        counts = {key: sum(result[key] for result in results) for key in results[0]}
+
+        return {
+            **counts,
+            'duration': duration,
+            'throughput': (counts['sold'] + counts['rejected'] + counts['failed']) / duration,
+            'stock': self.check(product_id),
+            # Ledger has applied every committed sale or reloaded stock
+            'ledger_differences': stock_ledger.check() if stock_ledger.enabled else [],
+        }
+
+
+@app.cli.command('stress-sales')
+@click.option('--threads', type=int, default=8, help='Count of threads, which sell at once')
+@click.option('--sales', type=int, default=50, help='Count of sales of every thread')
+@click.option('--stock', type=int, default=1000, help='Received quantity of product')
+@click.option('--seed', type=int, default=0, help='Seed of random quantities')
+def stress_sales_command(threads: int, sales: int, stock: int, seed: int) -> None:
+    """
+    Sells one product from several threads and fails, if it is oversold.
+    Product and invoices are created, so run it against a separate database
+    """
+    result = SaleStressTest(threads=threads, sales=sales, stock=stock, seed=seed).run()
+    stock_result = result['stock']
+
+    click.echo(
+        f'sold {result["sold"]} invoices ( {result["sold_quantity"]} items ), '
+        f'rejected {result["rejected"]}, failed {result["failed"]}, '
+        f'{result["attempts"]} attempts in {result["duration"]:.2f} s ( {result["throughput"]:.1f} sales per second )'
+    )
+    click.echo(
+        f'received {stock_result["received"]}, sold {stock_result["sold"]}, '
+        f'left {stock_result["left"]}, broken consignments {stock_result["broken"]}'
+    )
+
+    problems = []
+
+    if stock_result['sold'] + stock_result['left'] != stock_result['received']:
+        problems.append('sold and left quantities don\'t sum up to received one')
+
+    if stock_result['sold'] != result['sold_quantity']:
+        problems.append('sold quantity differs from quantity of successful sales')
+
+    if stock_result['broken']:
+        problems.append('some consignments have negative or inconsistent quantity')
+
+    if result['failed']:
+        problems.append('some sales failed with errors')
+
+    if result['ledger_differences']:
+        problems.append(f'stock ledger differs from database for {len(result["ledger_differences"])} products')
+
+    if problems:
+        raise click.ClickException('Stock is broken: ' + ', '.join(problems))
+
+
+class MoneyBenchmark:
+
+    """
+    Measures cost of one call of price parsers and formatters.
+    Prices are taken from consignments, so formatting cache
+    sees the same repeated prices as list resources do
+    """
+
+    def __init__(self, calls: int, seed: int = 0):
+        """
+        :param calls: count of measured calls of every function
+        :param seed: seed of random prices, when there are no consignments
+        """
+        self.calls = calls
+        self.seed = seed
+
+    def get_prices(self) -> List[int]:
+        prices = db.session.execute(select(Consignment.total_price).limit(self.calls)).scalars().all()
+
+        if not prices:
+            rng = random.Random(self.seed)
+            prices = [rng.randrange(1, 10 ** 7) for _ in range(self.calls)]
+
+        return prices
+
+    @staticmethod
+    def measure(function: Callable[[Any], Any], values: List[Any]) -> float:
+        """
+        Returns time of one call
+        :param function: function to measure
+        :param values: argument of every call
+        :return: nanoseconds
+        """
+        started = time.perf_counter()
+
+        for value in values:
+            function(value)
+
+        return (time.perf_counter() - started) * 1e9 / len(values)
+
+    def run(self) -> Dict[str, Any]:
+        """
+        Measures parsers and formatters
+        :return: nanoseconds per call by function and equality of formatted prices
+        """
+        prices = self.get_prices()
+        texts = [str(Money.to_decimal(price)) for price in prices]
+        numbers = [float(text) for text in texts]
+        amounts = [decimal.Decimal(text) for text in texts]
+        field = MoneyField()
+
+        def format_by_float(price: int) -> str:
+            return f'{price / (10 ** Money.decimals):0{Money.decimals}} {Money.sign}'
+
+        def format_exact(price: int) -> str:
+            return Money.format_price.__wrapped__(Money, price)
+
+        Money.format_price.cache_clear()
+        Money.encode_price.cache_clear()
+        # Lists are rendered again and again, so cached prices are measured warm
+        list(map(Money.encode_price, prices))
+
+        return {
+            'identical': all(format_exact(price) == format_by_float(price) for price in prices),
+            'timings': {
+                'parse str(float(number))': self.measure(lambda number: Money.from_string(str(float(number))), numbers),
+                'parse float': self.measure(Money.from_json, numbers),
+                'parse decimal': self.measure(Money.from_json, amounts),
+                'parse string': self.measure(Money.from_json, texts),
+                'format by float division': self.measure(format_by_float, prices),
+                'format exact': self.measure(format_exact, prices),
+                'format cached': self.measure(Money.format_price, prices),
+                'encode by field': self.measure(lambda price: json.dumps(field.output('price', {'price': price})), prices),
+                'encode cached': self.measure(Money.encode_price, prices),
+            },
+        }
+
+
+@app.cli.command('benchmark-money')
+@click.option('--calls', type=int, default=100000, help='Count of measured calls of every function')
+@click.option('--seed', type=int, default=0, help='Seed of random prices')
+def benchmark_money_command(calls: int, seed: int) -> None:
+    """
+    Measures per-call cost of price parsing and formatting and checks,
+    that exact formatting gives the same text as float division
+    """
+    result = MoneyBenchmark(calls=calls, seed=seed).run()
+    click.echo(f'{"function":<28}{"ns per call":>12}')
+
+    for name, timing in result['timings'].items():
+        click.echo(f'{name:<28}{timing:>12.0f}')
+
+    if not result['identical']:
+        raise click.ClickException('Exact formatting differs from float division')
+
+
+class ReportMemoryBenchmark:
+
+    """
+    Measures peak of memory, allocated while reports of a year
+    are streamed in every format. Peak of rows, loaded at once,
+    is measured for comparison
+    """
+
+    def __init__(self, start: datetime.datetime, days: int = 365):
+        """
+        :param start: first day of reported period
+        :param days: length of reported period
+        """
+        self.start = start
+        self.end = start + datetime.timedelta(days=days)
+
+    @staticmethod
+    def measure(consume: Callable[[], int]) -> Tuple[int, float]:
+        """
+        Runs function under tracemalloc
+        :param consume: function, which streams report and returns its size
+        :return: size of report and peak of allocated memory in MiB
+        """
+        db.session.expunge_all()
+        # Every run fills cache of formatted prices from the scratch
+        Money.format_price.cache_clear()
+        Money.encode_price.cache_clear()
+        tracemalloc.start()
+
+        try:
+            size = consume()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        return size, peak / 1024 / 1024
+
+    def get_reports(self) -> List[Tuple[str, Report, dict]]:
+        period = {'start_time': self.start, 'end_time': self.end}
+        return [
+            ('sale', SaleReport(), period),
+            ('income', IncomeReport(), period),
+            ('product', RestOfProductReport(), {'date': self.end}),
+        ]
+
+    def run(self) -> Dict[str, Dict[str, Tuple[int, float]]]:
+        """
+        Streams every report as PDF text and as table formats
+        :return: size ( strings, bytes or rows ) and peak of memory by report and format
+        """
+        results = {}
+
+        for name, report, arguments in self.get_reports():
+            results[name] = {
+                'pdf text': self.measure(lambda: sum(1 for _ in report.serialize(**arguments))),
+                'loaded rows': self.measure(lambda: len(list(report.iterate_rows(**arguments)))),
+            }
+
+            for export_format, serializer in SERIALIZERS.items():
+                results[name][export_format.value] = self.measure(lambda: sum(
+                    len(chunk) for chunk in serializer.serialize(report.__columns__, report.iterate_rows(**arguments))
+                ))
+
+        return results
+
+
+@app.cli.command('benchmark-report-memory')
+@click.option('--products', type=int, default=0, help='Generate products of a year before benchmark')
+@click.option('--income-invoices', type=int, default=0, help='Generate income invoices of a year before benchmark')
+@click.option('--sale-invoices', type=int, default=0, help='Generate sale invoices of a year before benchmark')
+@click.option('--start', type=click.DateTime(), default='2020-01-01', help='First day of reported year')
+def benchmark_report_memory_command(
+        products: int,
+        income_invoices: int,
+        sale_invoices: int,
+        start: datetime.datetime,
+) -> None:
+    """
+    Prints peak of memory, allocated by reports of a year in every format.
+    Run it against a separate database ( SQLALCHEMY_DATABASE_URI ),
+    synthetic year of data can be generated before run
+    """
+    if products:
+        counts = DataGenerator(
+            products=products,
+            income_invoices=income_invoices,
+            sale_invoices=sale_invoices,
+            start=start,
+            days=365,
+        ).run()
+        click.echo(f'Generated {counts}')
+
+    results = ReportMemoryBenchmark(start=start).run()
+    click.echo(f'{"report":<10}{"format":<14}{"size":>12}{"peak, MiB":>12}')
+
+    for name, formats in results.items():
+        for export_format, (size, peak) in formats.items():
+            click.echo(f'{name:<10}{export_format:<14}{size:>12}{peak:>12.1f}')
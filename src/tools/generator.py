@@ -0,0 +1,301 @@
+import collections
+import datetime
+import random
+from typing import Dict, List
+
+import click
+from sqlalchemy import delete, func, insert, select
+
+from backend.app import app
+from backend.counter import row_counter
+from backend.models import (
+    Consignment,
+    IncomeInvoice,
+    IncomeInvoiceItem,
+    Product,
+    SaleInvoice,
+    SaleInvoiceItem,
+    StockSnapshot,
+    db,
+)
+
+
+GENERATOR_BATCH_SIZE = 5000
+
+# Relative count of invoices from Monday to Sunday
+WEEKDAY_WEIGHTS = (1.0, 1.0, 1.0, 1.0, 1.2, 0.6, 0.3)
+# Invoices are made in working hours, mostly around midday
+WORKING_HOURS = (8, 20)
+
+# Models in order of foreign keys
+GENERATED_MODELS = (
+    Product,
+    IncomeInvoice,
+    IncomeInvoiceItem,
+    SaleInvoice,
+    SaleInvoiceItem,
+    Consignment,
+)
+
+
+class DataGenerator:
+
+    """
+    Generates reproducible synthetic products and invoices
+    for benchmarks. Invoices are generated in order of date,
+    sales are written off from consignments by FIFO, so generated
+    data is the same, as if it was created by `BusinessController`.
+    Every income item makes one consignment.
+
+    Invoices are spread like in a real shop: less on weekends,
+    only in working hours, and their count grows over the period.
+    Rows are inserted with bulk statements by batches
+    """
+
+    def __init__(
+            self,
+            products: int,
+            income_invoices: int,
+            sale_invoices: int,
+            start: datetime.datetime,
+            days: int,
+            max_items: int = 5,
+            growth: float = 1.0,
+            seed: int = 0,
+            batch_size: int = GENERATOR_BATCH_SIZE,
+    ):
+        """
+        :param products: count of products
+        :param income_invoices: count of income invoices
+        :param sale_invoices: count of sale invoices, sales of products
+        without stock are skipped
+        :param start: date of the first invoice
+        :param days: length of period with invoices
+        :param max_items: max count of items in invoice
+        :param growth: how much more invoices are made on the last day,
+        than on the first one ( 1.0 - twice more )
+        :param seed: seed of random generator
+        :param batch_size: count of rows in one insert statement
+        """
+        self.products = products
+        self.income_invoices = income_invoices
+        self.sale_invoices = sale_invoices
+        self.start = start
+        self.days = days
+        self.max_items = max_items
+        self.growth = growth
+        self.random = random.Random(seed)
+        self.batch_size = batch_size
+        self.rows: Dict[type, List[dict]] = collections.defaultdict(list)
+        self.counts: Dict[type, int] = collections.defaultdict(int)
+
+    @staticmethod
+    def get_next_id(model: type) -> int:
+        return (db.session.scalar(select(func.max(model.id))) or 0) + 1
+
+    def add(self, model: type, row: dict) -> None:
+        """
+        Adds row to insert, rows are inserted by batches
+        :param model: model of row
+        :param row: values of row
+        :return:
+        """
+        self.rows[model].append(row)
+        self.counts[model] += 1
+
+        if len(self.rows[model]) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Inserts added rows, parent rows are inserted first
+        :return:
+        """
+        for model in GENERATED_MODELS:
+            if self.rows[model]:
+                db.session.execute(insert(model), self.rows[model])
+                self.rows[model].clear()
+
+    def get_dates(self, count: int) -> List[datetime.datetime]:
+        """
+        Returns random dates of invoices
+        :param count: count of dates
+        :return:
+        """
+        first_day = datetime.datetime(self.start.year, self.start.month, self.start.day)
+        days = range(self.days)
+        weights = [
+            WEEKDAY_WEIGHTS[(first_day + datetime.timedelta(days=day)).weekday()] *
+            (1 + self.growth * day / self.days)
+            for day in days
+        ]
+        start_hour, end_hour = WORKING_HOURS
+        dates = []
+
+        for day in self.random.choices(days, weights=weights, k=count):
+            hour = min(max(self.random.gauss((start_hour + end_hour) / 2, 3), start_hour), end_hour)
+            dates.append(first_day + datetime.timedelta(days=day, seconds=int(hour * 60 * 60)))
+
+        return dates
+
+    def get_invoice_dates(self) -> List[tuple]:
+        """
+        Returns types and dates of all invoices in order of date
+        :return:
+        """
+        return sorted(
+            [(date, 'income') for date in self.get_dates(self.income_invoices)] +
+            [(date, 'sale') for date in self.get_dates(self.sale_invoices)]
+        )
+
+    def generate_products(self) -> Dict[int, int]:
+        """
+        Generates products
+        :return: cost price by product id
+        """
+        product_id = self.get_next_id(Product)
+        prices = {}
+
+        for number in range(self.products):
+            prices[product_id] = self.random.randrange(100, 100000)
+            self.add(Product, {'id': product_id, 'name': f'Product {number + 1}', 'cost_price': prices[product_id]})
+            product_id += 1
+
+        self.flush()
+        return prices
+
+    def run(self) -> Dict[str, int]:
+        """
+        Generates and inserts all data
+        :return: count of inserted rows by table
+        """
+        prices = self.generate_products()
+        product_ids = list(prices)
+        income_invoice_id = self.get_next_id(IncomeInvoice)
+        income_item_id = self.get_next_id(IncomeInvoiceItem)
+        sale_invoice_id = self.get_next_id(SaleInvoice)
+        sale_item_id = self.get_next_id(SaleInvoiceItem)
+        consignment_id = self.get_next_id(Consignment)
+
+        # Consignments are inserted at the end, when their current quantity is known
+        consignments: Dict[int, dict] = {}
+        available: Dict[int, collections.deque] = collections.defaultdict(collections.deque)
+        stock: Dict[int, int] = collections.defaultdict(int)
+        consignment_numbers: Dict[int, int] = collections.defaultdict(int)
+
+        for date, invoice_type in self.get_invoice_dates():
+            items_count = self.random.randint(1, min(self.max_items, len(product_ids)))
+
+            if invoice_type == 'income':
+                self.add(IncomeInvoice, {'id': income_invoice_id, 'date': date})
+
+                for product_id in self.random.sample(product_ids, items_count):
+                    quantity = self.random.randint(1, 100)
+                    total_price = quantity * prices[product_id]
+                    consignment_numbers[product_id] += 1
+
+                    self.add(IncomeInvoiceItem, {
+                        'id': income_item_id,
+                        'product_id': product_id,
+                        'invoice_id': income_invoice_id,
+                        'quantity': quantity,
+                        'arrival_date': date,
+                        'total_price': total_price,
+                    })
+                    consignments[consignment_id] = {
+                        'id': consignment_id,
+                        'consignment_number': consignment_numbers[product_id],
+                        'arrival_date': date,
+                        'product_id': product_id,
+                        'income_invoice_item_id': income_item_id,
+                        'quantity': quantity,
+                        'current_quantity': quantity,
+                        'depreciated': False,
+                        'total_price': total_price,
+                    }
+                    available[product_id].append(consignment_id)
+                    stock[product_id] += quantity
+                    income_item_id += 1
+                    consignment_id += 1
+
+                income_invoice_id += 1
+                continue
+
+            in_stock = [product_id for product_id in self.random.sample(product_ids, items_count) if stock[product_id]]
+
+            if not in_stock:
+                continue
+
+            self.add(SaleInvoice, {'id': sale_invoice_id, 'date': date})
+
+            for product_id in in_stock:
+                quantity = self.random.randint(1, min(stock[product_id], 20))
+                stock[product_id] -= quantity
+
+                self.add(SaleInvoiceItem, {
+                    'id': sale_item_id,
+                    'product_id': product_id,
+                    'sale_id': sale_invoice_id,
+                    'quantity': quantity,
+                    'total_price': quantity * prices[product_id] * self.random.randint(110, 150) // 100,
+                })
+                sale_item_id += 1
+
+                while quantity:
+                    consignment = consignments[available[product_id][0]]
+                    written_off = min(quantity, consignment['current_quantity'])
+                    consignment['current_quantity'] -= written_off
+                    quantity -= written_off
+
+                    if consignment['current_quantity'] == 0:
+                        consignment['depreciated'] = True
+                        available[product_id].popleft()
+
+            sale_invoice_id += 1
+
+        for consignment in consignments.values():
+            self.add(Consignment, consignment)
+
+        self.flush()
+
+        # Snapshots don't know about inserted invoices
+        db.session.execute(delete(StockSnapshot))
+        db.session.commit()
+        row_counter.rebuild(mapper.class_ for mapper in db.Model.registry.mappers)
+
+        return {model.__tablename__: count for model, count in self.counts.items()}
+
+
+@app.cli.command('generate-data')
+@click.option('--products', type=int, default=1000)
+@click.option('--income-invoices', type=int, default=20000)
+@click.option('--sale-invoices', type=int, default=50000)
+@click.option('--start', type=click.DateTime(), default='2020-01-01', help='Date of the first invoice')
+@click.option('--days', type=int, default=3 * 365, help='Length of period with invoices')
+@click.option('--max-items', type=int, default=5, help='Max count of items in invoice')
+@click.option('--seed', type=int, default=0, help='The same seed generates the same data')
+def generate_data_command(
+        products: int,
+        income_invoices: int,
+        sale_invoices: int,
+        start: datetime.datetime,
+        days: int,
+        max_items: int,
+        seed: int,
+) -> None:
+    """
+    Adds synthetic products and invoices for benchmarks,
+    run it against a separate database ( SQLALCHEMY_DATABASE_URI )
+    """
+    counts = DataGenerator(
+        products=products,
+        income_invoices=income_invoices,
+        sale_invoices=sale_invoices,
+        start=start,
+        days=days,
+        max_items=max_items,
+        seed=seed,
+    ).run()
+
+    for table, count in counts.items():
+        click.echo(f'{table}: {count}')